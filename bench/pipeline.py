@@ -0,0 +1,264 @@
+"""End-to-end benchmark of the build pipeline with stand-in avbroot and custota-tool executables
+
+Runs patch -> extract -> publish -> gen-csig -> gen-update-info against a synthetic OTA and reports
+the time, bytes written and peak disk usage of every stage. Needs no network and no keys:
+
+    python3 -m bench.pipeline --ota-size 2G --cpu-passes 1
+"""
+from loguru import logger
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from main import Dependencies, BuildConfig, buildOTA
+from contextlib import nullcontext
+from deps.ota import OTAInfo
+from deps.magisk import MagiskRelease
+from deps.chenxiaolong.avbroot import AvbrootRelease
+from deps.chenxiaolong.afsr import AfsrRelease
+from deps.chenxiaolong.custota import CustotaRelease
+from deps.eviction import parseSize
+from deps.stages import StageRecorder
+
+standins_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standins")
+
+synthetic_metadata = """ota-required-cache=0
+ota-type=AB
+post-build=google/lynx/lynx:15/BENCH.250101.001/1:user/release-keys
+post-build-incremental=1
+post-sdk-level=35
+post-security-patch-level=2025-01-01
+post-timestamp=1735689600
+pre-device=lynx
+"""
+
+def makeSyntheticOTA(path: str, size: int, seed: int = 0) -> str:
+    """A stored zip with a deterministic random payload.bin of roughly size bytes, reused if it exists"""
+    if os.path.exists(path) and abs(os.path.getsize(path) - size) < 1024 * 1024:
+        return path
+    logger.info(f"Generating synthetic OTA of {size / 1024**3:.2f} GiB at {path}")
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path + ".part", 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("META-INF/com/android/metadata", synthetic_metadata)
+        zf.writestr("payload_properties.txt", "FILE_HASH=\nFILE_SIZE=\n")
+        with zf.open("payload.bin", 'w', force_zip64=True) as f:
+            written = 0
+            while written < size:
+                length = min(1024 * 1024, size - written)
+                f.write(rng.randbytes(length))
+                written += length
+    os.replace(path + ".part", path)
+    return path
+
+def _usage(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass # removed while walking
+    return total
+
+class DiskSampler:
+    """Samples the allocated size of a directory in the background and keeps the peaks"""
+
+    def __init__(self, path: str, interval: float = 0.2):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stage_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self) -> int:
+        usage = _usage(self.path)
+        self.peak = max(self.peak, usage)
+        self.stage_peak = max(self.stage_peak, usage)
+        return usage
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+class BenchRecorder(StageRecorder):
+    """StageRecorder that also records the peak disk usage seen during each stage"""
+
+    def __init__(self, sampler: DiskSampler):
+        super().__init__()
+        self.sampler = sampler
+        self.peaks = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        self.sampler.stage_peak = self.sampler.sample()
+        with super().stage(name):
+            yield
+        self.peaks[name] = max(self.sampler.stage_peak, self.sampler.sample())
+
+def standinDependencies(ota_path: str, work_dir: str) -> Dependencies:
+    magisk_path = os.path.join(work_dir, "Magisk-bench.apk")
+    if not os.path.exists(magisk_path):
+        with open(magisk_path, 'wb') as f:
+            f.write(random.Random(1).randbytes(12 * 1024 * 1024))
+    return Dependencies(
+        selected_ota=OTAInfo(
+            android_version="15.0.0",
+            build_id="BENCH.250101.001",
+            build_branch="BENCH",
+            build_date="250101",
+            build_number="001",
+            build_variant=None,
+            carrier=None,
+            device="lynx",
+            url="https://invalid/ota.zip",
+            checksum="",
+        ),
+        ota_path=ota_path,
+        selected_magisk=MagiskRelease("v0.0-bench", "bench", False, False, os.path.basename(magisk_path), "https://invalid/magisk.apk"),
+        magisk_path=magisk_path,
+        selected_avbroot=AvbrootRelease("v0.0-bench", "bench", False, False, "avbroot", "https://invalid/avbroot.zip"),
+        avbroot_path=os.path.join(standins_dir, "avbroot"),
+        selected_afsr=AfsrRelease("v0.0-bench", "bench", False, False, "afsr", "https://invalid/afsr.zip"),
+        afsr_path=os.path.join(standins_dir, "afsr"),
+        selected_custota=CustotaRelease("v0.0-bench", "bench", False, False, "custota-tool", "https://invalid/custota.zip"),
+        custota_path=os.path.join(standins_dir, "custota-tool"),
+    )
+
+def benchKeys(work_dir: str, passphrase: str = "bench") -> dict[str, str]:
+    """Passphrase encrypted RSA keys for the signing helper, generated once per work directory"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    keys_dir = os.path.join(work_dir, "keys")
+    os.makedirs(keys_dir, exist_ok=True)
+    paths = {}
+    for name in ["avb", "ota"]:
+        paths[name] = os.path.join(keys_dir, f"{name}.key")
+        if not os.path.exists(paths[name]):
+            key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+            with open(paths[name], 'wb') as f:
+                f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.BestAvailableEncryption(passphrase.encode())))
+    return paths
+
+def runBenchmark(
+    work_dir: str = "bench_work",
+    ota_size: int = 1024**3,
+    cpu_passes: int = 1,
+    extract_ratio: float = 1.5,
+    zero_fraction: float = 0.7,
+    enable_magisk: bool = True,
+    package_extracted_ota: bool = True,
+    signing_helper: bool = False,
+) -> dict:
+    os.makedirs(work_dir, exist_ok=True)
+    ota_path = makeSyntheticOTA(os.path.join(work_dir, "lynx-ota-BENCH.250101.001.zip"), ota_size)
+    dependencies = standinDependencies(ota_path, work_dir)
+
+    # every run starts from the same state, only the synthetic inputs are kept
+    build_dir = os.path.join(work_dir, "build")
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+
+    os.environ["STANDIN_CPU_PASSES"] = str(cpu_passes)
+    os.environ["STANDIN_EXTRACT_RATIO"] = str(extract_ratio)
+    os.environ["STANDIN_ZERO_FRACTION"] = str(zero_fraction)
+    os.environ.setdefault("PASSPHRASE_AVB", "bench")
+    os.environ.setdefault("PASSPHRASE_OTA", "bench")
+
+    config = BuildConfig(
+        # the module verification cache, artifact index and stage history stay in the work directory
+        download_dir=os.path.join(work_dir, "downloads"),
+        enable_magisk=enable_magisk,
+        package_extracted_ota=package_extracted_ota,
+        patched_dir=os.path.join(build_dir, "patched"),
+        ota_dir=os.path.join(build_dir, "ota"),
+        collect_garbage=False,
+    )
+    signer = None
+    if signing_helper:
+        from deps.signing import SigningHelper
+        keys = benchKeys(work_dir)
+        signer = SigningHelper({"avb": (keys["avb"], "PASSPHRASE_AVB"), "ota": (keys["ota"], "PASSPHRASE_OTA")})
+    sampler = DiskSampler(build_dir)
+    recorder = BenchRecorder(sampler)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        # the helper's startup, where the keys are decrypted, counts towards the wall time
+        with (signer if signer is not None else nullcontext()):
+            buildOTA(dependencies, config, recorder=recorder, signer=signer)
+    finally:
+        sampler.stop()
+    wall = time.perf_counter() - start
+
+    return {
+        "ota_size": os.path.getsize(ota_path),
+        "wall_seconds": wall,
+        "orchestration_seconds": wall - recorder.total(),
+        "peak_disk_bytes": sampler.peak,
+        "final_disk_bytes": _usage(build_dir),
+        "stages": [
+            {
+                "name": record.name,
+                "seconds": record.seconds,
+                "bytes_written": record.bytes_written,
+                "peak_disk_bytes": recorder.peaks.get(record.name, 0),
+            }
+            for record in recorder.records
+        ],
+    }
+
+def printReport(report: dict):
+    print(f"{'stage':<16} {'seconds':>9} {'written MiB':>12} {'peak disk MiB':>14}")
+    for stage in report["stages"]:
+        print(f"{stage['name']:<16} {stage['seconds']:>9.2f} {stage['bytes_written'] / 1024**2:>12.1f} {stage['peak_disk_bytes'] / 1024**2:>14.1f}")
+    print(f"{'total':<16} {report['wall_seconds']:>9.2f} {sum(s['bytes_written'] for s in report['stages']) / 1024**2:>12.1f} {report['peak_disk_bytes'] / 1024**2:>14.1f}")
+    print(f"OTA size {report['ota_size'] / 1024**2:.1f} MiB, outside of stages {report['orchestration_seconds']:.2f}s, final disk usage {report['final_disk_bytes'] / 1024**2:.1f} MiB")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the build pipeline with stand-in tools and a synthetic OTA")
+    parser.add_argument("--work-dir", default="bench_work")
+    parser.add_argument("--ota-size", default="1G", help="size of the synthetic OTA, e.g. 512M or 3G")
+    parser.add_argument("--cpu-passes", type=int, default=1, help="sha256 passes the stand-in tools make over their input")
+    parser.add_argument("--extract-ratio", type=float, default=1.5, help="extracted image size relative to the OTA")
+    parser.add_argument("--zero-fraction", type=float, default=0.7, help="zero filled fraction of the extracted images")
+    parser.add_argument("--rootless", action="store_true")
+    parser.add_argument("--no-package", action="store_true", help="skip packaging the extracted images")
+    parser.add_argument("--signing-helper", action="store_true", help="sign through the signing helper with generated bench keys")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write the reports as JSON")
+    args = parser.parse_args()
+
+    reports = []
+    for run in range(args.runs):
+        report = runBenchmark(
+            work_dir=args.work_dir,
+            ota_size=parseSize(args.ota_size),
+            cpu_passes=args.cpu_passes,
+            extract_ratio=args.extract_ratio,
+            zero_fraction=args.zero_fraction,
+            enable_magisk=not args.rootless,
+            package_extracted_ota=not args.no_package,
+            signing_helper=args.signing_helper,
+        )
+        printReport(report)
+        reports.append(report)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
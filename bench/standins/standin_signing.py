@@ -0,0 +1,49 @@
+"""Signing helper calls for the stand-in tools, with avbtool's `<helper> <algorithm> <public key>` semantics
+
+Each call pads a sha256 digest to the key size, has the helper sign it, and checks the signature against the
+public key, so a benchmark run also proves the helper produces valid raw RSA signatures.
+"""
+import base64
+import hashlib
+import subprocess
+
+def _readDer(der: bytes, pos: int) -> tuple[int, int]:
+    """(start, end) of the value of the DER element at pos"""
+    length = der[pos + 1]
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(der[pos:pos + n], "big")
+        pos += n
+    return pos, pos + length
+
+def readPublicKey(pem_path: str) -> tuple[int, int]:
+    """(modulus, exponent) of an RSA SubjectPublicKeyInfo PEM"""
+    with open(pem_path, 'r') as f:
+        der = base64.b64decode("".join(line for line in f.read().splitlines() if not line.startswith("-----")))
+    pos, _ = _readDer(der, 0) # SubjectPublicKeyInfo
+    _, algorithm_end = _readDer(der, pos) # AlgorithmIdentifier
+    pos, _ = _readDer(der, algorithm_end) # BIT STRING
+    pos, _ = _readDer(der, pos + 1) # RSAPublicKey, after the unused bits byte
+    start, end = _readDer(der, pos)
+    modulus = int.from_bytes(der[start:end], "big")
+    start, end = _readDer(der, end)
+    exponent = int.from_bytes(der[start:end], "big")
+    return modulus, exponent
+
+def sign(helper: str, public_key_path: str, digest: bytes) -> bytes:
+    modulus, exponent = readPublicKey(public_key_path)
+    size = (modulus.bit_length() + 7) // 8
+    data = b"\x00\x01" + b"\xff" * (size - 3 - len(digest)) + b"\x00" + digest
+    result = subprocess.run([helper, f"SHA256_RSA{size * 8}", public_key_path], input=data, stdout=subprocess.PIPE, check=True)
+    signature = result.stdout
+    if len(signature) != size or pow(int.from_bytes(signature, "big"), exponent, modulus) != int.from_bytes(data, "big"):
+        raise ValueError(f"Signing helper returned an invalid signature for {public_key_path}")
+    return signature
+
+def signFile(helper: str, public_key_path: str, path: str) -> bytes:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sign(helper, public_key_path, sha256.digest())
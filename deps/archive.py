@@ -0,0 +1,256 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.auto import tqdm
+import zstandard
+
+# Seekable image archive layout:
+#   header magic | zstd frame per non-zero chunk ... | json index | footer (index offset, index size, footer magic)
+# Every chunk is an independent zstd frame, so any chunk of any file can be decompressed on its own.
+# All-zero chunks are not stored at all and come back as holes when unpacking.
+archive_magic = b"PXOTAZS1"
+footer_magic = b"PXOTAIDX"
+_footer = struct.Struct("<QQ8s")
+archive_version = 1
+
+default_chunk_size = 4 * 1024 * 1024
+default_level = 3
+
+_local = threading.local()
+
+def _compressor(level: int) -> zstandard.ZstdCompressor:
+    # compressor objects aren't thread safe, so every worker gets its own
+    cache = getattr(_local, "compressors", None)
+    if cache is None:
+        cache = _local.compressors = {}
+    if level not in cache:
+        cache[level] = zstandard.ZstdCompressor(level=level, write_content_size=True)
+    return cache[level]
+
+def _decompressor() -> zstandard.ZstdDecompressor:
+    if getattr(_local, "decompressor", None) is None:
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor
+
+def _compressChunk(chunk: bytes, level: int) -> bytes:
+    return _compressor(level).compress(chunk)
+
+def _decompressChunk(frame: bytes, size: int) -> bytes:
+    return _decompressor().decompress(frame, max_output_size=size)
+
+def _listFiles(source_dir: str) -> list[str]:
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(os.path.relpath(path, source_dir))
+    return files
+
+def packImages(source_dir: str, archive_path: str, chunk_size: int = default_chunk_size, level: int = default_level, max_workers: int = None) -> str:
+    """Pack every file in source_dir into a seekable archive, compressing chunks on all cores"""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    files = _listFiles(source_dir)
+    total_size = sum(os.path.getsize(os.path.join(source_dir, name)) for name in files)
+    zero_chunk = bytes(chunk_size)
+    index = {
+        "version": archive_version,
+        "chunk_size": chunk_size,
+        "files": [],
+    }
+
+    logger.info(f"Packing {len(files)} files ({total_size / 1024**3:.2f} GiB) from {source_dir} into {archive_path} with {max_workers} workers")
+    temp_path = archive_path + ".part"
+    with open(temp_path, 'wb') as out, ThreadPoolExecutor(max_workers=max_workers) as pool, \
+            tqdm(total=total_size, unit='B', unit_scale=True, desc=os.path.basename(archive_path)) as pbar:
+        out.write(archive_magic)
+
+        for name in files:
+            path = os.path.join(source_dir, name)
+            entry = {
+                "name": name,
+                "size": os.path.getsize(path),
+                "mode": os.stat(path).st_mode & 0o777,
+                "sha256": None,
+                "chunks": [],
+            }
+            sha256 = hashlib.sha256()
+            # bounded so a huge image doesn't end up in memory all at once
+            in_flight = deque()
+
+            def drain(limit: int):
+                while len(in_flight) > limit:
+                    future, chunk_len = in_flight.popleft()
+                    frame = future.result() if future is not None else None
+                    if frame is None:
+                        entry["chunks"].append(None)
+                    else:
+                        entry["chunks"].append([out.tell(), len(frame)])
+                        out.write(frame)
+                    pbar.update(chunk_len)
+
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(chunk)
+                    # zero runs are free: nothing is compressed or stored for them
+                    if chunk == zero_chunk[:len(chunk)]:
+                        in_flight.append((None, len(chunk)))
+                    else:
+                        in_flight.append((pool.submit(_compressChunk, chunk, level), len(chunk)))
+                    drain(max_workers * 2)
+            drain(0)
+            entry["sha256"] = sha256.hexdigest()
+            index["files"].append(entry)
+
+        index_data = json.dumps(index, separators=(",", ":")).encode()
+        index_offset = out.tell()
+        out.write(index_data)
+        out.write(_footer.pack(index_offset, len(index_data), footer_magic))
+
+    os.replace(temp_path, archive_path)
+    archive_size = os.path.getsize(archive_path)
+    logger.info(f"Packed {total_size / 1024**3:.2f} GiB into {archive_size / 1024**3:.2f} GiB ({archive_path})")
+    return archive_path
+
+def readIndex(archive_path: str) -> dict:
+    with open(archive_path, 'rb') as f:
+        assert f.read(len(archive_magic)) == archive_magic, f"{archive_path} is not an image archive"
+        f.seek(-_footer.size, os.SEEK_END)
+        index_offset, index_size, magic = _footer.unpack(f.read(_footer.size))
+        assert magic == footer_magic, f"{archive_path} has no index, it is probably truncated"
+        f.seek(index_offset)
+        index = json.loads(f.read(index_size))
+    assert index["version"] == archive_version, f"Unsupported archive version {index['version']}"
+    return index
+
+def _findEntry(index: dict, name: str) -> dict:
+    for entry in index["files"]:
+        if entry["name"] == name:
+            return entry
+    raise KeyError(f"{name} is not in the archive")
+
+def readRange(archive_path: str, name: str, offset: int, length: int, index: dict = None) -> bytes:
+    """Random access into one packed file, only the chunks covering the range are decompressed"""
+    if index is None:
+        index = readIndex(archive_path)
+    entry = _findEntry(index, name)
+    chunk_size = index["chunk_size"]
+    end = min(offset + length, entry["size"])
+    if offset >= end:
+        return b""
+
+    data = bytearray()
+    with open(archive_path, 'rb') as f:
+        for chunk_index in range(offset // chunk_size, (end - 1) // chunk_size + 1):
+            chunk_start = chunk_index * chunk_size
+            chunk_len = min(chunk_size, entry["size"] - chunk_start)
+            location = entry["chunks"][chunk_index]
+            if location is None:
+                chunk = bytes(chunk_len)
+            else:
+                f.seek(location[0])
+                chunk = _decompressChunk(f.read(location[1]), chunk_len)
+            data += chunk[max(offset - chunk_start, 0):end - chunk_start]
+    return bytes(data)
+
+def _outputPath(output_dir: str, name: str) -> str:
+    """Where name unpacks to, names from the index are untrusted and must stay inside output_dir"""
+    if os.path.isabs(name):
+        raise ValueError(f"Refusing to unpack {name}, the name is absolute")
+    root = os.path.realpath(output_dir)
+    out_path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, out_path]) != root or out_path == root:
+        raise ValueError(f"Refusing to unpack {name}, it points outside {output_dir}")
+    return out_path
+
+def unpackImages(archive_path: str, output_dir: str, names: list[str] = None, verify: bool = True, max_workers: int = None) -> list[str]:
+    """Unpack an archive into output_dir, zero chunks are left as holes so the output is sparse"""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    index = readIndex(archive_path)
+    chunk_size = index["chunk_size"]
+    entries = index["files"] if names is None else [_findEntry(index, name) for name in names]
+    total_size = sum(entry["size"] for entry in entries)
+    # checked up front, so a bad name doesn't leave a partly unpacked directory behind
+    out_paths = [_outputPath(output_dir, entry["name"]) for entry in entries]
+
+    written = []
+    with open(archive_path, 'rb') as archive, ThreadPoolExecutor(max_workers=max_workers) as pool, \
+            tqdm(total=total_size, unit='B', unit_scale=True, desc=f"Unpacking {os.path.basename(archive_path)}") as pbar:
+        for entry, out_path in zip(entries, out_paths):
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            sha256 = hashlib.sha256() if verify else None
+            in_flight = deque()
+
+            with open(out_path + ".part", 'wb') as out:
+                def drain(limit: int):
+                    while len(in_flight) > limit:
+                        future, chunk_len = in_flight.popleft()
+                        if future is None:
+                            out.seek(chunk_len, os.SEEK_CUR)
+                            if sha256 is not None:
+                                sha256.update(bytes(chunk_len))
+                        else:
+                            chunk = future.result()
+                            out.write(chunk)
+                            if sha256 is not None:
+                                sha256.update(chunk)
+                        pbar.update(chunk_len)
+
+                for chunk_index, location in enumerate(entry["chunks"]):
+                    chunk_len = min(chunk_size, entry["size"] - chunk_index * chunk_size)
+                    if location is None:
+                        in_flight.append((None, chunk_len))
+                    else:
+                        # the frames of one file are stored in order, so this reads the archive sequentially
+                        archive.seek(location[0])
+                        in_flight.append((pool.submit(_decompressChunk, archive.read(location[1]), chunk_len), chunk_len))
+                    drain(max_workers * 2)
+                drain(0)
+                # trailing holes need the size set explicitly
+                out.truncate(entry["size"])
+
+            if sha256 is not None and sha256.hexdigest() != entry["sha256"]:
+                os.remove(out_path + ".part")
+                raise ValueError(f"Checksum mismatch for {entry['name']}: expected {entry['sha256']}, got {sha256.hexdigest()}")
+            os.replace(out_path + ".part", out_path)
+            os.chmod(out_path, entry["mode"] & 0o777)
+            written.append(os.path.join(output_dir, entry["name"]))
+
+    logger.info(f"Unpacked {len(written)} files to {output_dir}")
+    return written
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Pack extracted fastboot images into a seekable zstd archive, or unpack one")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="pack a directory")
+    pack_parser.add_argument("source_dir")
+    pack_parser.add_argument("archive")
+    pack_parser.add_argument("--level", type=int, default=default_level)
+    pack_parser.add_argument("--chunk-size", type=int, default=default_chunk_size)
+    pack_parser.add_argument("--workers", type=int, default=None)
+    unpack_parser = subparsers.add_parser("unpack", help="unpack an archive, writing sparse files")
+    unpack_parser.add_argument("archive")
+    unpack_parser.add_argument("output_dir")
+    unpack_parser.add_argument("names", nargs="*", help="only unpack these files")
+    unpack_parser.add_argument("--workers", type=int, default=None)
+    list_parser = subparsers.add_parser("list", help="list the packed files")
+    list_parser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        packImages(args.source_dir, args.archive, chunk_size=args.chunk_size, level=args.level, max_workers=args.workers)
+    elif args.command == "unpack":
+        unpackImages(args.archive, args.output_dir, names=args.names or None, max_workers=args.workers)
+    elif args.command == "list":
+        for entry in readIndex(args.archive)["files"]:
+            stored = sum(location[1] for location in entry["chunks"] if location is not None)
+            print(f"{entry['size']:>14} {stored:>14} {entry['name']}")
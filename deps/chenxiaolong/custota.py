@@ -1,9 +1,10 @@
 from loguru import logger
 import requests
 import os
-from tqdm.auto import tqdm
 from dataclasses import dataclass
 from .helpers import verifySignature
+from ..transport import getSession, getListing, downloadFile
+from ..remote_cache import publish
 
 @dataclass
 class CustotaRelease:
@@ -14,7 +15,7 @@ class CustotaRelease:
     filename: str
     url: str
 
-    def download(self, download_dir: str, filename: str = None, overwrite: bool = False) -> str:
+    def download(self, download_dir: str, filename: str = None, overwrite: bool = False, session: requests.Session = None) -> str:
         if filename is None:
             filename = self.filename
 
@@ -26,26 +27,15 @@ class CustotaRelease:
             return out_path
 
         logger.info(f"Downloading Custota {self.tag_name} to {out_path}")
+        if session is None:
+            session = getSession()
         temp_path = out_path + ".part"
-        with requests.get(self.url, stream=True) as r:
-            total_size = int(r.headers.get('content-length', 0))
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
-                with open(temp_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-            assert total_size == os.path.getsize(temp_path), f"Downloaded file size {os.path.getsize(temp_path)} does not match expected size {total_size}"
+        downloadFile(self.url, temp_path, desc=filename, session=session, from_cache=True)
 
+        # same session, so the signature reuses the connection from the download above
         signature_path = out_path + ".sig"
         logger.info(f"Downloading Custota signature to {signature_path}")
-        with requests.get(self.url + ".sig", stream=True) as r:
-            total_size = int(r.headers.get('content-length', 0))
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc=self.filename + ".sig") as pbar:
-                with open(signature_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-            assert total_size == os.path.getsize(signature_path), f"Downloaded signature file size {os.path.getsize(signature_path)} does not match expected size {total_size}"
+        downloadFile(self.url + ".sig", signature_path, desc=self.filename + ".sig", session=session, from_cache=True)
 
         # verify the signature
         file_data = open(temp_path, 'rb').read()
@@ -56,19 +46,22 @@ class CustotaRelease:
             os.remove(signature_path)
             raise
 
+        publish(temp_path, url=self.url)
+        publish(signature_path, url=self.url + ".sig")
         os.remove(signature_path)
         os.rename(temp_path, out_path)
 
         return out_path
 
-def fetchCustotaReleases() -> list[CustotaRelease]:
-    with requests.Session() as s:
-        headers = {
-            'X-GitHub-Api-Version': '2022-11-28',
-            'Accept': 'application/vnd.github+json',
-        }
+def fetchCustotaReleases(session: requests.Session = None) -> list[CustotaRelease]:
+    if session is None:
+        session = getSession()
+    headers = {
+        'X-GitHub-Api-Version': '2022-11-28',
+        'Accept': 'application/vnd.github+json',
+    }
 
-        res = s.get("https://api.github.com/repos/chenxiaolong/Custota/releases", headers=headers)
+    res = getListing("https://api.github.com/repos/chenxiaolong/Custota/releases", session=session, headers=headers)
 
     assert res.status_code == 200, f"Failed to fetch releases page: {res.status_code}"
 
@@ -1,12 +1,27 @@
 from loguru import logger
+import threading
 
 
 _chenxiaolong_trusted_key = "chenxiaolong ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIDOe6/tBnO7xZhAWXRj3ApUYgn+XZ0wnQiXM8B7tPgv4"
 
+# verifySignature can be called from several worker threads at once, so the
+# trusted key file must not be truncated while another ssh-keygen is reading it
+_trusted_key_lock = threading.Lock()
+
+def _writeTrustedKey(trusted_key_path: str):
+    with _trusted_key_lock:
+        try:
+            with open(trusted_key_path, 'r') as f:
+                if f.read() == _chenxiaolong_trusted_key + "\n":
+                    return
+        except FileNotFoundError:
+            pass
+        with open(trusted_key_path, 'w') as f:
+            f.write(_chenxiaolong_trusted_key + "\n")
+
 def verifySignature(file_data: bytes, signature_path: str) -> bool:
     trusted_key_path = "chenxiaolong_trusted_key.pub"
-    with open(trusted_key_path, 'w') as f:
-        f.write(_chenxiaolong_trusted_key + "\n")
+    _writeTrustedKey(trusted_key_path)
 
     import subprocess
     verify_cmd = ["ssh-keygen", "-Y", "verify", "-f", trusted_key_path, "-I", "chenxiaolong", "-n", "file", "-s", signature_path]
@@ -17,4 +32,4 @@ def verifySignature(file_data: bytes, signature_path: str) -> bool:
         return False # never reached
     else:
         logger.info(f"Signature verification succeeded: {proc.stdout.decode()}")
-        return True
\ No newline at end of file
+        return True
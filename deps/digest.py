@@ -0,0 +1,9 @@
+import hashlib
+
+def sha256File(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hex sha256 of a file, read in chunks so large artifacts don't have to fit in memory"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,280 @@
+from loguru import logger
+import json
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+
+# per-directory size budgets in bytes, nested directories are accounted separately from their parent
+default_budgets = {
+    "downloads": 20 * 1024**3,
+    "patched": 15 * 1024**3,
+    "patched/extracted": 20 * 1024**3,
+    "ota": 10 * 1024**3,
+}
+default_global_budget = 50 * 1024**3
+default_keep_releases = 2
+
+# access times and pinned releases, the service and the CLI share it when they share a download directory
+index_filename = "artifact_index.json"
+default_index_path = os.path.join("downloads", index_filename)
+
+# bookkeeping files that must never be evicted
+_protected_filenames = {
+    index_filename,
+    "module_verification.json",
+    "stage_history.json",
+}
+
+def tierBudgets(download_dir: str, patched_dir: str, extracted_dir: str | None, ota_dir: str) -> dict[str, int]:
+    """The default budgets applied to wherever the storage tiers actually are
+
+    Without an extracted_dir the extracted images count against the patched budget.
+    """
+    budgets = {
+        download_dir: default_budgets["downloads"],
+        patched_dir: default_budgets["patched"],
+        ota_dir: default_budgets["ota"],
+    }
+    if extracted_dir is not None:
+        budgets[extracted_dir] = default_budgets["patched/extracted"]
+    return budgets
+
+@dataclass
+class Blob:
+    path: str
+    managed_dir: str
+    size: int
+    last_access: float
+
+class ArtifactIndex:
+    """Access times and release history of cached artifacts
+
+    Filesystem atimes are unreliable (relatime/noatime), so accesses are recorded here
+    explicitly. Artifacts referenced by the last N releases are pinned.
+    """
+
+    def __init__(self, index_path: str = default_index_path):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self.access = {}
+        self.releases = []
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    data = json.load(f)
+                self.access = data.get("access", {})
+                self.releases = data.get("releases", [])
+                # older indexes were keyed relative to the working directory, which is the best guess for what they meant
+                self.access = {self._key(k): v for k, v in self.access.items()}
+                for release in self.releases:
+                    release["artifacts"] = sorted(self._key(p) for p in release["artifacts"])
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Ignoring unreadable artifact index {index_path}: {e}")
+
+    @staticmethod
+    def _key(path: str) -> str:
+        # absolute, so the service and the CLI find each other's entries whatever directory they run in
+        return os.path.abspath(path)
+
+    def touch(self, *paths: str):
+        now = time.time()
+        with self._lock:
+            for path in paths:
+                self.access[self._key(path)] = now
+
+    def recordRelease(self, name: str, paths: list[str]):
+        """Record the artifacts a release was built from, they stay pinned for the next few releases"""
+        paths = [p for p in paths if p is not None]
+        self.touch(*paths)
+        with self._lock:
+            self.releases = [r for r in self.releases if r["name"] != name]
+            self.releases.append({
+                "name": name,
+                "time": time.time(),
+                "artifacts": sorted(self._key(p) for p in paths),
+            })
+
+    def extendRelease(self, name: str, paths: list[str]):
+        """Pin more artifacts with an already recorded release"""
+        paths = [p for p in paths if p is not None]
+        self.touch(*paths)
+        with self._lock:
+            for release in self.releases:
+                if release["name"] == name:
+                    release["artifacts"] = sorted(set(release["artifacts"]) | {self._key(p) for p in paths})
+                    return
+        raise KeyError(f"No release {name} in the artifact index")
+
+    def pinned(self, keep_releases: int = default_keep_releases) -> set[str]:
+        with self._lock:
+            recent = self.releases[-keep_releases:] if keep_releases > 0 else []
+            return {path for release in recent for path in release["artifacts"]}
+
+    def lastAccess(self, path: str) -> float | None:
+        with self._lock:
+            return self.access.get(self._key(path))
+
+    def forget(self, path: str):
+        key = self._key(path)
+        with self._lock:
+            self.access = {k: v for k, v in self.access.items() if k != key and not k.startswith(key + os.sep)}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.part"
+            with open(temp_path, 'w') as f:
+                json.dump({"access": self.access, "releases": self.releases}, f, indent=2)
+            os.replace(temp_path, self.index_path)
+
+def parseSize(value: str | int) -> int:
+    """Parse sizes like 500M, 20G or 1.5T into bytes"""
+    if isinstance(value, int):
+        return value
+    value = value.strip().upper().removesuffix("B").removesuffix("I")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def _diskUsage(path: str) -> int:
+    # allocated blocks rather than apparent size, sparse images only cost what they use
+    if os.path.islink(path):
+        return 0
+    if os.path.isfile(path):
+        return os.stat(path).st_blocks * 512
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            if not os.path.islink(file_path):
+                total += os.stat(file_path).st_blocks * 512
+    return total
+
+def _newestTime(path: str) -> float:
+    st = os.stat(path)
+    newest = max(st.st_atime, st.st_mtime)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                newest = max(newest, st.st_atime, st.st_mtime)
+    return newest
+
+def collectBlobs(budgets: dict[str, int], index: ArtifactIndex) -> list[Blob]:
+    """List the top level entries of every managed directory as evictable blobs"""
+    managed_dirs = {os.path.normpath(d) for d in budgets}
+    blobs = []
+    for managed_dir in managed_dirs:
+        if not os.path.isdir(managed_dir):
+            continue
+        for name in os.listdir(managed_dir):
+            path = os.path.join(managed_dir, name)
+            # nested managed directories have their own budget
+            if os.path.normpath(path) in managed_dirs or name in _protected_filenames:
+                continue
+            last_access = index.lastAccess(path)
+            if last_access is None:
+                last_access = _newestTime(path)
+            blobs.append(Blob(path=path, managed_dir=managed_dir, size=_diskUsage(path), last_access=last_access))
+    return blobs
+
+def _isPinned(blob: Blob, pinned: set[str]) -> bool:
+    key = ArtifactIndex._key(blob.path)
+    return any(p == key or p.startswith(key + os.sep) or key.startswith(p + os.sep) for p in pinned)
+
+def _evict(blob: Blob, index: ArtifactIndex, dry_run: bool):
+    logger.info(f"{'Would evict' if dry_run else 'Evicting'} {blob.path} ({blob.size / 1024**2:.1f} MiB, last used {time.ctime(blob.last_access)})")
+    if dry_run:
+        return
+    if os.path.isdir(blob.path) and not os.path.islink(blob.path):
+        shutil.rmtree(blob.path)
+    else:
+        os.remove(blob.path)
+    index.forget(blob.path)
+
+def collectGarbage(
+    budgets: dict[str, int] = None,
+    global_budget: int = default_global_budget,
+    keep_releases: int = default_keep_releases,
+    index: ArtifactIndex = None,
+    dry_run: bool = False,
+) -> list[Blob]:
+    """Evict least recently used blobs until every directory and the total fit their budgets
+
+    Returns the evicted blobs. Blobs pinned by the last keep_releases releases are never evicted,
+    so a budget can stay exceeded if everything left over is pinned.
+    """
+    if budgets is None:
+        budgets = default_budgets
+    budgets = {os.path.normpath(d): b for d, b in budgets.items()}
+    if index is None:
+        index = ArtifactIndex()
+
+    pinned = index.pinned(keep_releases)
+    blobs = collectBlobs(budgets, index)
+    blobs.sort(key=lambda b: b.last_access)
+    evicted = []
+
+    usage = {d: 0 for d in budgets}
+    for blob in blobs:
+        usage[blob.managed_dir] += blob.size
+
+    # per-directory budgets first, then the global budget across everything left
+    for managed_dir, budget in budgets.items():
+        for blob in blobs:
+            if usage[managed_dir] <= budget:
+                break
+            if blob.managed_dir != managed_dir or blob in evicted or _isPinned(blob, pinned):
+                continue
+            _evict(blob, index, dry_run)
+            usage[managed_dir] -= blob.size
+            evicted.append(blob)
+        if usage[managed_dir] > budget:
+            logger.warning(f"{managed_dir} uses {usage[managed_dir] / 1024**3:.2f} GiB, over its {budget / 1024**3:.2f} GiB budget, but the rest is pinned")
+
+    total = sum(usage.values())
+    for blob in blobs:
+        if total <= global_budget:
+            break
+        if blob in evicted or _isPinned(blob, pinned):
+            continue
+        _evict(blob, index, dry_run)
+        total -= blob.size
+        evicted.append(blob)
+    if total > global_budget:
+        logger.warning(f"Total usage {total / 1024**3:.2f} GiB is over the {global_budget / 1024**3:.2f} GiB budget, but the rest is pinned")
+
+    if not dry_run:
+        index.save()
+    logger.info(f"{'Would free' if dry_run else 'Freed'} {sum(b.size for b in evicted) / 1024**3:.2f} GiB from {len(evicted)} blobs, {total / 1024**3:.2f} GiB in use")
+    return evicted
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Evict least recently used downloads and build outputs")
+    parser.add_argument("--budget", action="append", default=[], metavar="DIR=SIZE", help="per-directory budget, e.g. downloads=20G (repeatable, replaces the defaults for that directory)")
+    parser.add_argument("--global-budget", default=str(default_global_budget), help="budget across all managed directories, e.g. 50G")
+    parser.add_argument("--keep-releases", type=int, default=default_keep_releases, help="number of recent releases whose artifacts are pinned")
+    parser.add_argument("--index", help="path to the artifact index, defaults to the one in the download directory")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be evicted")
+    args = parser.parse_args()
+
+    # the tiers may have been moved with the PIXEL_OTA_*_DIR environment variables
+    from .storage import StorageConfig
+    storage = StorageConfig.fromEnv()
+    extract_dir = storage.extract_dir if storage.extract_dir is not None else os.path.join(storage.scratch_dir, "extracted")
+    budgets = tierBudgets(storage.download_dir, storage.scratch_dir, extract_dir, storage.publish_dir)
+    for item in args.budget:
+        directory, size = item.split("=", 1)
+        budgets[directory] = parseSize(size)
+
+    collectGarbage(
+        budgets=budgets,
+        global_budget=parseSize(args.global_budget),
+        keep_releases=args.keep_releases,
+        index=ArtifactIndex(args.index if args.index is not None else os.path.join(storage.download_dir, index_filename)),
+        dry_run=args.dry_run,
+    )
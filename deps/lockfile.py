@@ -0,0 +1,99 @@
+from loguru import logger
+import json
+import os
+import requests
+from dataclasses import dataclass, asdict
+from .ota import OTAInfo
+from .magisk import MagiskRelease
+from .chenxiaolong.avbroot import AvbrootRelease
+from .chenxiaolong.afsr import AfsrRelease
+from .chenxiaolong.custota import CustotaRelease
+from .remote_cache import fetchDigest, publish
+from .digest import sha256File
+
+lock_version = 1
+default_lockfile_path = "pixel-ota.lock.json"
+
+release_types = {
+    "ota": OTAInfo,
+    "magisk": MagiskRelease,
+    "avbroot": AvbrootRelease,
+    "afsr": AfsrRelease,
+    "custota": CustotaRelease,
+}
+
+@dataclass
+class LockedArtifact:
+    release: OTAInfo | MagiskRelease | AvbrootRelease | AfsrRelease | CustotaRelease
+    sha256: str
+
+def writeLockfile(artifacts: dict[str, tuple[object, str]], lockfile_path: str = default_lockfile_path) -> str:
+    """Pin resolved releases to a lockfile, artifacts maps a dependency name to (release, downloaded path)"""
+    assert set(artifacts) == set(release_types), f"Lockfile needs exactly these dependencies: {', '.join(release_types)}"
+    lock = {
+        "version": lock_version,
+    }
+    for name, (release, path) in artifacts.items():
+        assert isinstance(release, release_types[name]), f"Expected {release_types[name].__name__} for {name}, got {type(release).__name__}"
+        # the OTA checksum was already verified against Google's published one on download
+        digest = release.checksum if isinstance(release, OTAInfo) else sha256File(path)
+        lock[name] = {
+            "release": asdict(release),
+            "sha256": digest,
+        }
+
+    temp_path = lockfile_path + ".part"
+    with open(temp_path, 'w') as f:
+        json.dump(lock, f, indent=2)
+        f.write("\n")
+    os.replace(temp_path, lockfile_path)
+    logger.info(f"Lockfile written to {lockfile_path}")
+    return lockfile_path
+
+def readLockfile(lockfile_path: str = default_lockfile_path) -> dict[str, LockedArtifact]:
+    with open(lockfile_path, 'r') as f:
+        lock = json.load(f)
+    assert lock.get("version") == lock_version, f"Unsupported lockfile version {lock.get('version')} in {lockfile_path}"
+
+    locked = {}
+    for name, release_type in release_types.items():
+        assert name in lock, f"Lockfile {lockfile_path} has no entry for {name}"
+        locked[name] = LockedArtifact(
+            release=release_type(**lock[name]["release"]),
+            sha256=lock[name]["sha256"],
+        )
+    return locked
+
+def fetchLocked(locked: LockedArtifact, download_dir: str, session: requests.Session = None) -> str:
+    """Get a pinned artifact from the download cache, or from its pinned URL if it is missing or corrupt
+
+    No listing requests are made, and nothing at all is fetched when the cached copy matches the pin.
+    """
+    release = locked.release
+    if isinstance(release, OTAInfo):
+        # OTAInfo.download checks the cached copy against the pinned checksum itself
+        assert release.checksum == locked.sha256, f"Lockfile OTA checksum {locked.sha256} does not match the release checksum {release.checksum}"
+        return release.download(download_dir=download_dir, overwrite=False, session=session)
+
+    out_path = os.path.join(download_dir, release.filename)
+    if os.path.exists(out_path):
+        if sha256File(out_path) == locked.sha256:
+            logger.info(f"Using cached {out_path}, digest matches the lockfile")
+            return out_path
+        logger.warning(f"Cached {out_path} does not match the lockfile digest, downloading it again")
+
+    # the pinned digest is all the remote cache needs, it checks the content against it
+    os.makedirs(download_dir, exist_ok=True)
+    if fetchDigest(locked.sha256, out_path + ".part"):
+        os.replace(out_path + ".part", out_path)
+        return out_path
+
+    out_path = release.download(download_dir, overwrite=True, session=session)
+    digest = sha256File(out_path)
+    if digest != locked.sha256:
+        os.remove(out_path)
+        raise ValueError(f"Digest mismatch for {out_path}: expected {locked.sha256}, got {digest}")
+    # the signed releases published themselves on download, Magisk is only verified now that it matched its pin
+    if isinstance(release, MagiskRelease):
+        publish(out_path, digest=digest)
+    return out_path
@@ -1,8 +1,8 @@
 from loguru import logger
 import requests
 import os
-from tqdm.auto import tqdm
 from dataclasses import dataclass
+from .transport import getSession, getListing, downloadFile
 
 preinit_device_map = {
     "oriole": "metadata", # Pixel 6"
@@ -30,7 +30,7 @@ class MagiskRelease:
     filename: str
     url: str
 
-    def download(self, download_dir: str, filename: str = None, overwrite: bool = False) -> str:
+    def download(self, download_dir: str, filename: str = None, overwrite: bool = False, session: requests.Session = None) -> str:
         if filename is None:
             filename = self.filename
 
@@ -43,27 +43,23 @@ class MagiskRelease:
 
         logger.info(f"Downloading magisk {self.tag_name} to {out_path}")
         temp_path = out_path + ".part"
-        with requests.get(self.url, stream=True) as r:
-            total_size = int(r.headers.get('content-length', 0))
-            with tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
-                with open(temp_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-            assert total_size == os.path.getsize(temp_path), f"Downloaded file size {os.path.getsize(temp_path)} does not match expected size {total_size}"
+        # Magisk isn't signed, nothing vouches for what was downloaded, so it goes to and comes from the remote cache
+        # only by a lockfile digest
+        downloadFile(self.url, temp_path, desc=filename, session=session)
 
         os.rename(temp_path, out_path)
 
         return out_path
 
-def fetchMagiskReleases() -> list[MagiskRelease]:
-    with requests.Session() as s:
-        headers = {
-            'X-GitHub-Api-Version': '2022-11-28',
-            'Accept': 'application/vnd.github+json',
-        }
+def fetchMagiskReleases(session: requests.Session = None) -> list[MagiskRelease]:
+    if session is None:
+        session = getSession()
+    headers = {
+        'X-GitHub-Api-Version': '2022-11-28',
+        'Accept': 'application/vnd.github+json',
+    }
 
-        res = s.get("https://api.github.com/repos/topjohnwu/Magisk/releases", headers=headers)
+    res = getListing("https://api.github.com/repos/topjohnwu/Magisk/releases", session=session, headers=headers)
 
     assert res.status_code == 200, f"Failed to fetch releases page: {res.status_code}"
 
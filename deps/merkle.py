@@ -0,0 +1,140 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.auto import tqdm
+from .transport import getSession
+
+default_chunk_size = 4 * 1024 * 1024
+sidecar_version = 1
+sidecar_suffix = ".merkle.json"
+
+def sidecarPath(path: str) -> str:
+    return path + sidecar_suffix
+
+def _hashChunk(data: bytes) -> str:
+    # hashlib releases the GIL for large buffers, so chunks hash in parallel on plain threads
+    return hashlib.sha256(data).hexdigest()
+
+def _readAndHashChunk(path: str, offset: int, length: int) -> str:
+    with open(path, 'rb') as f:
+        return _hashChunk(os.pread(f.fileno(), length, offset))
+
+def merkleRoot(chunk_hashes: list[str]) -> str:
+    """Binary sha256 tree over the chunk hashes, an odd node out is carried up as is"""
+    if not chunk_hashes:
+        return hashlib.sha256(b"").hexdigest()
+    level = [bytes.fromhex(h) for h in chunk_hashes]
+    while len(level) > 1:
+        next_level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+def hashFile(path: str, chunk_size: int = default_chunk_size, max_workers: int = None, desc: str = "Verifying checksum") -> tuple[str, list[str]]:
+    """Full file sha256 and the chunk hashes in a single read pass
+
+    The whole-file hash is inherently serial, the chunk hashes are computed on a thread pool next to it.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    sha256 = hashlib.sha256()
+    chunk_hashes = []
+    in_flight = deque()
+    with open(path, 'rb') as f, ThreadPoolExecutor(max_workers=max_workers) as pool, \
+            tqdm(total=os.path.getsize(path), unit='B', unit_scale=True, desc=desc) as pbar:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            in_flight.append(pool.submit(_hashChunk, chunk))
+            sha256.update(chunk)
+            pbar.update(len(chunk))
+            while len(in_flight) > max_workers * 2:
+                chunk_hashes.append(in_flight.popleft().result())
+        chunk_hashes.extend(future.result() for future in in_flight)
+    return sha256.hexdigest(), chunk_hashes
+
+def writeSidecar(path: str, sha256: str, chunk_hashes: list[str], chunk_size: int = default_chunk_size) -> str:
+    sidecar = {
+        "version": sidecar_version,
+        "size": os.path.getsize(path),
+        "sha256": sha256,
+        "chunk_size": chunk_size,
+        "root": merkleRoot(chunk_hashes),
+        "chunks": chunk_hashes,
+    }
+    out_path = sidecarPath(path)
+    with open(out_path + ".part", 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(out_path + ".part", out_path)
+    return out_path
+
+def readSidecar(path: str, sha256: str) -> dict | None:
+    """The sidecar of path, or None if it's missing, unreadable or was made for other content"""
+    try:
+        with open(sidecarPath(path), 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if sidecar.get("version") != sidecar_version or sidecar.get("sha256") != sha256:
+        return None
+    if sidecar.get("size") != os.path.getsize(path):
+        return None
+    # a sidecar whose chunk list doesn't match its own root can't be trusted
+    if merkleRoot(sidecar["chunks"]) != sidecar["root"]:
+        logger.warning(f"Sidecar {sidecarPath(path)} is inconsistent, ignoring it")
+        return None
+    return sidecar
+
+def _chunkRange(sidecar: dict, index: int) -> tuple[int, int]:
+    offset = index * sidecar["chunk_size"]
+    return offset, min(sidecar["chunk_size"], sidecar["size"] - offset)
+
+def verifyChunks(path: str, sidecar: dict, indexes: list[int] = None, max_workers: int = None) -> list[int]:
+    """Check chunks against the sidecar in parallel, returns the indexes of the corrupted ones"""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if indexes is None:
+        indexes = list(range(len(sidecar["chunks"])))
+    bad = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool, \
+            tqdm(total=sum(_chunkRange(sidecar, i)[1] for i in indexes), unit='B', unit_scale=True, desc="Verifying chunks") as pbar:
+        futures = [(i, pool.submit(_readAndHashChunk, path, *_chunkRange(sidecar, i))) for i in indexes]
+        for i, future in futures:
+            if future.result() != sidecar["chunks"][i]:
+                bad.append(i)
+            pbar.update(_chunkRange(sidecar, i)[1])
+    return bad
+
+def _coalesce(indexes: list[int]) -> list[tuple[int, int]]:
+    """Turn sorted chunk indexes into (first, last) runs so neighbouring chunks share one request"""
+    runs = []
+    for i in sorted(indexes):
+        if runs and runs[-1][1] == i - 1:
+            runs[-1] = (runs[-1][0], i)
+        else:
+            runs.append((i, i))
+    return runs
+
+def repairChunks(path: str, url: str, sidecar: dict, indexes: list[int], session: requests.Session = None) -> int:
+    """Re-fetch the given chunks with range requests and write them in place, returns the bytes fetched"""
+    if session is None:
+        session = getSession()
+    fetched = 0
+    with open(path, 'r+b') as f:
+        for first, last in _coalesce(indexes):
+            start = _chunkRange(sidecar, first)[0]
+            end = sum(_chunkRange(sidecar, last)) - 1
+            logger.info(f"Re-fetching bytes {start}-{end} of {path}")
+            with session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True) as r:
+                if r.status_code != 206:
+                    raise ValueError(f"Server did not honour the range request for {url}: {r.status_code}")
+                offset = start
+                for data in r.iter_content(chunk_size=1024 * 1024):
+                    os.pwrite(f.fileno(), data, offset)
+                    offset += len(data)
+            assert offset == end + 1, f"Range request for {url} returned {offset - start} bytes, expected {end + 1 - start}"
+            fetched += offset - start
+    return fetched
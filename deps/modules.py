@@ -0,0 +1,175 @@
+from loguru import logger
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from .chenxiaolong.helpers import verifySignature
+from .digest import sha256File
+
+# where the bundled artifacts live and how they get installed on the device
+module_sources = {
+    "modules": "magisk",  # flashed from the Magisk app (or `magisk --install-module`)
+    "lsposed": "lsposed", # installed as a regular apk and enabled in LSPosed
+}
+
+module_extensions = {
+    "magisk": ".zip",
+    "lsposed": ".apk",
+}
+
+# successful signature checks, remembered across builds alongside the downloads they were made for
+verification_cache_filename = "module_verification.json"
+default_cache_path = os.path.join("downloads", verification_cache_filename)
+
+@dataclass
+class ModuleArtifact:
+    name: str
+    install_type: str
+    filename: str
+    path: str
+    size: int
+    sha256: str
+    signature_path: str | None
+    verified: bool
+
+    @property
+    def signed(self) -> bool:
+        return self.signature_path is not None
+
+def discoverModules(base_dir: str = ".") -> list[tuple[str, str, str | None]]:
+    """Find every bundled module artifact, returns (install_type, path, signature_path) tuples"""
+    found = []
+    for source_dir, install_type in module_sources.items():
+        source_path = os.path.join(base_dir, source_dir)
+        if not os.path.isdir(source_path):
+            logger.debug(f"Module source directory {source_path} does not exist, skipping")
+            continue
+        for filename in sorted(os.listdir(source_path)):
+            if not filename.endswith(module_extensions[install_type]):
+                continue
+            path = os.path.join(source_path, filename)
+            signature_path = path + ".sig"
+            if not os.path.isfile(signature_path):
+                signature_path = None
+            found.append((install_type, path, signature_path))
+    logger.info(f"Discovered {len(found)} module artifacts")
+    return found
+
+class VerificationCache:
+    """Verification results keyed by the digests of the artifact and its signature
+
+    Only successful verifications are stored, so a cache hit means the exact same
+    bytes were already checked against the trusted key.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Ignoring unreadable verification cache {cache_path}: {e}")
+
+    @staticmethod
+    def key(file_digest: str, signature_digest: str) -> str:
+        return f"{file_digest}:{signature_digest}"
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def add(self, key: str, filename: str):
+        with self._lock:
+            self._entries[key] = {"filename": filename}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            temp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.part"
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f, indent=2)
+            os.replace(temp_path, self.cache_path)
+
+def _verifyModule(install_type: str, path: str, signature_path: str | None, cache: VerificationCache) -> ModuleArtifact:
+    file_digest = sha256File(path)
+    verified = False
+    if signature_path is not None:
+        key = VerificationCache.key(file_digest, sha256File(signature_path))
+        if cache.contains(key):
+            logger.info(f"Signature for {path} already verified (cached)")
+        else:
+            with open(path, 'rb') as f:
+                file_data = f.read()
+            verifySignature(file_data, signature_path)
+            cache.add(key, os.path.basename(path))
+        verified = True
+    else:
+        logger.warning(f"{path} has no signature, bundling it unverified")
+
+    filename = os.path.basename(path)
+    return ModuleArtifact(
+        name=os.path.splitext(filename)[0],
+        install_type=install_type,
+        filename=filename,
+        path=path,
+        size=os.path.getsize(path),
+        sha256=file_digest,
+        signature_path=signature_path,
+        verified=verified,
+    )
+
+def verifyModules(base_dir: str = ".", cache_path: str = default_cache_path, max_workers: int = None) -> list[ModuleArtifact]:
+    """Hash and verify all bundled modules concurrently, raises ValueError if any signature is bad"""
+    found = discoverModules(base_dir)
+    cache = VerificationCache(cache_path)
+    if max_workers is None:
+        max_workers = min(len(found), os.cpu_count() or 1) or 1
+
+    # hashing and ssh-keygen both release the GIL, so threads are enough here
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_verifyModule, install_type, path, signature_path, cache) for install_type, path, signature_path in found]
+        artifacts = []
+        errors = []
+        for (install_type, path, signature_path), future in zip(found, futures):
+            try:
+                artifacts.append(future.result())
+            except ValueError as e:
+                logger.error(f"Verification failed for {path}: {e}")
+                errors.append(path)
+
+    # save whatever succeeded so a retry after fixing one module is still cheap
+    cache.save()
+    if errors:
+        raise ValueError(f"Signature verification failed for: {', '.join(errors)}")
+    logger.info(f"Verified {sum(a.verified for a in artifacts)} signed and {sum(not a.verified for a in artifacts)} unsigned modules")
+    return artifacts
+
+def bundleModules(bundle_dir: str, base_dir: str = ".", cache_path: str = default_cache_path, max_workers: int = None) -> str:
+    """Verify all bundled modules and stage them with a manifest in bundle_dir, returns the manifest path"""
+    artifacts = verifyModules(base_dir=base_dir, cache_path=cache_path, max_workers=max_workers)
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    manifest = {
+        "modules": [],
+    }
+    for artifact in artifacts:
+        out_path = os.path.join(bundle_dir, artifact.filename)
+        # copy2 keeps the mtime, so an unchanged artifact is not copied again on the next run
+        if not (os.path.exists(out_path) and os.path.getsize(out_path) == artifact.size and os.path.getmtime(out_path) == os.path.getmtime(artifact.path)):
+            shutil.copy2(artifact.path, out_path)
+        entry = asdict(artifact)
+        del entry["path"]
+        del entry["signature_path"]
+        entry["signed"] = artifact.signed
+        manifest["modules"].append(entry)
+
+    manifest_path = os.path.join(bundle_dir, "manifest.json")
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f"Module bundle with {len(artifacts)} artifacts written to {bundle_dir}")
+    return manifest_path
@@ -2,8 +2,10 @@ from loguru import logger
 import requests
 import re
 import os
-from tqdm.auto import tqdm
 from dataclasses import dataclass
+from .transport import getSession, getListing, downloadFile
+from .remote_cache import fetchDigest, publish
+from .merkle import hashFile, readSidecar, writeSidecar, verifyChunks, repairChunks, sidecarPath
 
 @dataclass
 class OTAInfo:
@@ -22,7 +24,7 @@ class OTAInfo:
     def filename(self) -> str:
         return f"{self.device}-ota-{self.build_id}.zip"
 
-    def download(self, download_dir: str, filename: str = None, overwrite: bool = False) -> str:
+    def download(self, download_dir: str, filename: str = None, overwrite: bool = False, session: requests.Session = None) -> str:
         if filename is None:
             filename = self.filename
 
@@ -31,45 +33,50 @@ class OTAInfo:
 
         if not overwrite and os.path.exists(out_path):
             logger.warning(f"File {out_path} already exists, skipping download.")
+            # a cached copy with a sidecar is checked chunk by chunk in parallel, and repaired in place if it rotted
+            sidecar = readSidecar(out_path, self.checksum)
+            if sidecar is not None:
+                bad_chunks = verifyChunks(out_path, sidecar)
+                if not bad_chunks:
+                    logger.info(f"Checksum verified for {out_path} (merkle root {sidecar['root'][:16]})")
+                    return out_path
+                logger.warning(f"{len(bad_chunks)} corrupted chunks in {out_path}, re-fetching only those")
+                repairChunks(out_path, self.url, sidecar, bad_chunks, session=session)
+                if verifyChunks(out_path, sidecar, bad_chunks):
+                    os.remove(out_path)
+                    os.remove(sidecarPath(out_path))
+                    raise ValueError(f"Repairing {out_path} failed, removed it so the next run downloads it again")
         else:
             logger.info(f"Downloading OTA {self.android_version}, {self.build_id} for {self.device} to {out_path}")
             temp_path = out_path + ".part"
-            with requests.get(self.url, stream=True) as r:
-                total_size = int(r.headers.get('content-length', 0))
-                with tqdm(total=total_size, unit='B', unit_scale=True, desc=filename) as pbar:
-                    with open(temp_path, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-                assert total_size == os.path.getsize(temp_path), f"Downloaded file size {os.path.getsize(temp_path)} does not match expected size {total_size}"
+            if not fetchDigest(self.checksum, temp_path):
+                downloadFile(self.url, temp_path, desc=filename, session=session)
 
             os.rename(temp_path, out_path)
         
-        # verify checksum
-        import hashlib
-        sha256 = hashlib.sha256()
-        with open(out_path, 'rb') as f:
-            with tqdm(total=os.path.getsize(out_path), unit='B', unit_scale=True, desc="Verifying checksum") as pbar:
-                for chunk in iter(lambda: f.read(8192), b''):
-                    sha256.update(chunk)
-                    pbar.update(len(chunk))
-        calculated_checksum = sha256.hexdigest()
+        # verify checksum, the chunk hashes for the sidecar are computed in the same pass
+        calculated_checksum, chunk_hashes = hashFile(out_path)
         if calculated_checksum != self.checksum:
             logger.error(f"Checksum mismatch for {out_path}: expected {self.checksum}, got {calculated_checksum}")
             os.remove(out_path)
+            if os.path.exists(sidecarPath(out_path)):
+                os.remove(sidecarPath(out_path))
             raise ValueError(f"Checksum mismatch for {out_path}: expected {self.checksum}, got {calculated_checksum}")
         else:
             logger.info(f"Checksum verified for {out_path}")
+            writeSidecar(out_path, calculated_checksum, chunk_hashes)
+            publish(out_path, url=self.url, digest=calculated_checksum)
         return out_path
 
-def fetchAllOTA() -> list[OTAInfo]:
-    with requests.Session() as s:
-        cookies = {
-            "devsite_wall_acks": "nexus-ota-tos",
-        }
+def fetchAllOTA(session: requests.Session = None) -> list[OTAInfo]:
+    if session is None:
+        session = getSession()
+    # passed per request so the terms of service cookie doesn't leak into the shared session
+    cookies = {
+        "devsite_wall_acks": "nexus-ota-tos",
+    }
 
-        s.cookies.update(cookies)
-        res = s.get("https://developers.google.com/android/ota")
+    res = getListing("https://developers.google.com/android/ota", session=session, cookies=cookies)
 
     assert res.status_code == 200, f"Failed to fetch OTA page: {res.status_code}"
 
@@ -0,0 +1,185 @@
+from loguru import logger
+import os
+import requests
+from dataclasses import dataclass, asdict
+from .magisk import MagiskRelease
+from .ota import OTAInfo
+from .remote_cache import cachedSize
+from .stages import StageHistory, history_filename
+from .storage import StorageConfig, buildSpace, default_reserve, groupByVolume, remoteSize, volumeOf
+
+# assumed transfer rates in bytes per second, downloads aren't timed yet
+origin_rate = 30 * 1024**2
+remote_cache_rate = 200 * 1024**2
+
+# rough seconds per GiB of OTA for stages that never ran on this host, replaced by the stage history once they did
+default_stage_rates = {
+    "patch": 40.0,
+    "extract": 30.0,
+    "sparsify": 5.0,
+    "package": 25.0,
+    "publish": 3.0,
+    "gen-csig": 8.0,
+}
+# seconds, for stages that don't depend on the OTA size
+default_stage_seconds = {
+    "modules": 1.0,
+    "gen-update-info": 0.1,
+    "gc": 0.5,
+}
+
+@dataclass
+class TransferPlan:
+    name: str
+    url: str
+    path: str
+    source: str # local, remote-cache or origin
+    size: int | None # None when the server doesn't send a content-length
+
+@dataclass
+class StagePlan:
+    name: str
+    seconds: float
+    from_history: bool
+
+@dataclass
+class VolumePlan:
+    device: int
+    paths: list[str]
+    required: int
+    free: int
+    fits: bool
+
+@dataclass
+class BuildPlan:
+    releases: dict[str, str]
+    variants: list[str]
+    ota_size: int | None
+    transfers: list[TransferPlan]
+    download_bytes: int
+    download_seconds: float
+    disk: dict[str, int]
+    volumes: list[VolumePlan]
+    stages: list[StagePlan]
+    build_seconds: float
+
+    @property
+    def estimated_seconds(self) -> float:
+        return self.download_seconds + self.build_seconds
+
+    @property
+    def fits(self) -> bool:
+        return all(volume.fits for volume in self.volumes)
+
+    def diskByVolume(self) -> dict[int, int]:
+        return {volume.device: volume.required for volume in self.volumes}
+
+    def toDict(self) -> dict:
+        return dict(asdict(self), estimated_seconds=self.estimated_seconds, fits=self.fits)
+
+def _releaseName(release) -> str:
+    if isinstance(release, OTAInfo):
+        return f"{release.device} {release.android_version} {release.build_id}"
+    return release.tag_name
+
+def _planTransfer(name: str, release, download_dir: str, session: requests.Session) -> TransferPlan:
+    path = os.path.join(download_dir, release.filename)
+    if os.path.exists(path):
+        return TransferPlan(name=name, url=release.url, path=path, source="local", size=os.path.getsize(path))
+    # the OTA is looked up by its published digest, the signed tools by the URL they were cached for, and Magisk is
+    # never taken from the cache without a lockfile digest
+    if isinstance(release, OTAInfo):
+        size = cachedSize(digest=release.checksum)
+    elif isinstance(release, MagiskRelease):
+        size = None
+    else:
+        size = cachedSize(url=release.url)
+    if size is not None:
+        return TransferPlan(name=name, url=release.url, path=path, source="remote-cache", size=size)
+    return TransferPlan(name=name, url=release.url, path=path, source="origin", size=remoteSize(release.url, session=session))
+
+def _planStage(name: str, ota_size: int, history: StageHistory) -> StagePlan:
+    seconds = history.estimate(name, ota_size)
+    if seconds is not None:
+        return StagePlan(name=name, seconds=seconds, from_history=True)
+    if name in default_stage_seconds:
+        return StagePlan(name=name, seconds=default_stage_seconds[name], from_history=False)
+    return StagePlan(name=name, seconds=default_stage_rates[name] * ota_size / 1024**3, from_history=False)
+
+def planBuild(
+    releases: dict,
+    storage: StorageConfig = None,
+    variants: list[str] = None,
+    extract: bool = True,
+    package: bool = True,
+    modules: bool = True,
+    variant_magisk: dict[str, MagiskRelease] = None,
+    session: requests.Session = None,
+) -> BuildPlan:
+    """Estimate what building releases will download, write and take, without downloading or building anything
+
+    releases are resolved releases by name, from main.resolveDependencies or a lockfile. variants are the variant
+    names of a multi-variant build, by default a single build. Every variant is assumed to run after the other,
+    so build_seconds is an upper bound when they overlap. modules is False for rootless builds, they skip the bundle.
+    variant_magisk are the Magisk releases of variants that don't use releases["magisk"], by variant name, from
+    main.resolveVariantMagisk. They are downloaded on top of releases.
+    """
+    if storage is None:
+        storage = StorageConfig()
+    if not variants:
+        variants = [None]
+
+    all_releases = dict(releases)
+    for variant, release in (variant_magisk or {}).items():
+        all_releases[f"magisk:{variant}"] = release
+    transfers = [_planTransfer(name, release, storage.download_dir, session) for name, release in all_releases.items()]
+    ota_transfer = next(t for t in transfers if t.name == "ota")
+    ota_size = ota_transfer.size
+    if ota_size is None:
+        logger.warning(f"No content-length for {ota_transfer.url}, disk and time estimates leave out the OTA")
+    pending = [t for t in transfers if t.source != "local"]
+    download_bytes = sum(t.size or 0 for t in pending)
+    download_seconds = sum((t.size or 0) / (remote_cache_rate if t.source == "remote-cache" else origin_rate) for t in pending)
+
+    # downloads stay in the cache, every variant has its own scratch and extract directories and shares the publish one
+    disk = {storage.download_dir: download_bytes}
+    for variant in variants:
+        scratch_dir = storage.scratch_dir if variant is None else os.path.join(storage.scratch_dir, variant)
+        if not extract:
+            extract_dir = None
+        elif storage.extract_dir is None:
+            extract_dir = os.path.join(scratch_dir, "extracted")
+        else:
+            extract_dir = storage.extract_dir if variant is None else os.path.join(storage.extract_dir, variant)
+        for path, size in buildSpace(ota_size or 0, scratch_dir, extract_dir, storage.publish_dir, package=package).items():
+            disk[path] = disk.get(path, 0) + size
+
+    volumes = [
+        VolumePlan(device=volumeOf(paths[0]), paths=paths, required=required, free=free, fits=required + default_reserve <= free)
+        for paths, required, free in groupByVolume(disk)
+    ]
+
+    stage_names = ["patch"]
+    if extract:
+        stage_names += ["extract", "sparsify"] + (["package"] if package else [])
+    stage_names += (["modules"] if modules else []) + ["publish", "gen-csig", "gen-update-info", "gc"]
+    history = StageHistory(os.path.join(storage.download_dir, history_filename))
+    stages = [_planStage(name, ota_size or 0, history) for name in stage_names]
+
+    plan = BuildPlan(
+        releases={name: _releaseName(release) for name, release in all_releases.items()},
+        variants=[variant or "default" for variant in variants],
+        ota_size=ota_size,
+        transfers=transfers,
+        download_bytes=download_bytes,
+        download_seconds=download_seconds,
+        disk=disk,
+        volumes=volumes,
+        stages=stages,
+        build_seconds=sum(stage.seconds for stage in stages) * len(variants),
+    )
+    logger.info(f"Plan: download {download_bytes / 1024**3:.2f} GiB, write {sum(disk.values()) / 1024**3:.2f} GiB, about {plan.estimated_seconds / 60:.1f} minutes")
+    for volume in volumes:
+        if not volume.fits:
+            logger.warning(f"{', '.join(volume.paths)} need {volume.required / 1024**3:.1f} GiB but only {volume.free / 1024**3:.1f} GiB is free")
+    return plan
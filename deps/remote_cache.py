@@ -0,0 +1,263 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from .digest import sha256File
+
+# Remote artifact cache shared by a fleet of runners, configured with PIXEL_OTA_REMOTE_CACHE:
+#   s3://bucket/prefix     any S3 compatible store (boto3 needed, AWS_ENDPOINT_URL for MinIO and friends)
+#   file:///mnt/cache      a shared filesystem such as NFS, a plain path works too
+# Layout, the same on every backend:
+#   sha256/<ab>/<digest>   artifact content, keyed by its sha256
+#   urls/<sha256 of url>   {"url", "sha256", "size"}, so signed artifacts without a published digest can be found by URL
+# Only verified artifacts are written: the OTA against Google's checksum, signed tools after their signature check, and
+# Magisk, which is unsigned, only once it matches a lockfile digest. Everything read is checked against its digest again.
+remote_cache_env = "PIXEL_OTA_REMOTE_CACHE"
+
+default_part_size = 64 * 1024 * 1024
+default_max_workers = 8
+
+def _blobKey(digest: str) -> str:
+    return f"sha256/{digest[:2]}/{digest}"
+
+def _refKey(url: str) -> str:
+    return f"urls/{hashlib.sha256(url.encode()).hexdigest()}"
+
+def _copyPart(src: str, dst: str, offset: int, length: int):
+    with open(src, 'rb') as fin, open(dst, 'r+b') as fout:
+        end = offset + length
+        while offset < end:
+            data = os.pread(fin.fileno(), min(8 * 1024 * 1024, end - offset), offset)
+            if not data:
+                raise EOFError(f"{src} is shorter than expected")
+            os.pwrite(fout.fileno(), data, offset)
+            offset += len(data)
+
+def _parallelCopy(src: str, dst: str, part_size: int, max_workers: int):
+    """Copy in parts on a thread pool, a network filesystem only gets to full speed with several requests in flight"""
+    size = os.path.getsize(src)
+    with open(dst, 'wb') as f:
+        f.truncate(size)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_copyPart, src, dst, offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+        for future in futures:
+            future.result()
+
+class FilesystemCache:
+    """Cache on a directory shared between runners"""
+
+    def __init__(self, root: str, part_size: int = default_part_size, max_workers: int = default_max_workers):
+        self.root = root
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+    def __repr__(self) -> str:
+        return f"FilesystemCache({self.root})"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def size(self, key: str) -> int | None:
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str, out_path: str):
+        _parallelCopy(self._path(key), out_path, self.part_size, self.max_workers)
+
+    def put(self, key: str, path: str):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # other runners may be reading, only complete files get the final name
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.part"
+        _parallelCopy(path, temp_path, self.part_size, self.max_workers)
+        os.replace(temp_path, target)
+
+    def getBytes(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def putBytes(self, key: str, data: bytes):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, target)
+
+class S3Cache:
+    """Cache in an S3 compatible bucket, large artifacts move as parallel multipart transfers"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None, part_size: int = default_part_size, max_workers: int = default_max_workers):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError as e:
+            raise ImportError("The S3 remote cache needs boto3, install it with pip install boto3") from e
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # boto3 also picks up AWS_ENDPOINT_URL by itself
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_workers,
+            use_threads=True,
+        )
+
+    def __repr__(self) -> str:
+        return f"S3Cache(s3://{self.bucket}/{self.prefix})"
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _isMissing(self, e: Exception) -> bool:
+        response = getattr(e, "response", None) or {}
+        return response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def size(self, key: str) -> int | None:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except Exception as e:
+            if self._isMissing(e):
+                return None
+            raise
+
+    def get(self, key: str, out_path: str):
+        self.client.download_file(self.bucket, self._key(key), out_path, Config=self.transfer_config)
+
+    def put(self, key: str, path: str):
+        self.client.upload_file(path, self.bucket, self._key(key), Config=self.transfer_config)
+
+    def getBytes(self, key: str) -> bytes | None:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+        except Exception as e:
+            if self._isMissing(e):
+                return None
+            raise
+
+    def putBytes(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+def openRemoteCache(url: str) -> FilesystemCache | S3Cache:
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3Cache(parsed.netloc, parsed.path)
+    if parsed.scheme in ("", "file"):
+        return FilesystemCache(parsed.path if parsed.scheme == "file" else url)
+    raise ValueError(f"Unsupported remote cache {url}, expected s3://bucket/prefix or file:///path")
+
+_remote_cache = None
+_remote_cache_configured = False
+_remote_cache_lock = threading.Lock()
+
+def setRemoteCache(cache: FilesystemCache | S3Cache | None):
+    global _remote_cache, _remote_cache_configured
+    with _remote_cache_lock:
+        _remote_cache = cache
+        _remote_cache_configured = True
+
+def getRemoteCache() -> FilesystemCache | S3Cache | None:
+    """The process wide remote cache from PIXEL_OTA_REMOTE_CACHE, None if there is none"""
+    global _remote_cache, _remote_cache_configured
+    with _remote_cache_lock:
+        if not _remote_cache_configured:
+            url = os.getenv(remote_cache_env)
+            _remote_cache = openRemoteCache(url) if url else None
+            _remote_cache_configured = True
+            if _remote_cache is not None:
+                logger.info(f"Using remote artifact cache {_remote_cache}")
+        return _remote_cache
+
+def cachedSize(url: str = None, digest: str = None) -> int | None:
+    """Size of an artifact in the remote cache, looked up by digest or by the URL it was published for, None on a miss"""
+    cache = getRemoteCache()
+    if cache is None:
+        return None
+    try:
+        if digest is None:
+            ref = cache.getBytes(_refKey(url))
+            if ref is None:
+                return None
+            digest = json.loads(ref)["sha256"]
+        return cache.size(_blobKey(digest))
+    except Exception as e:
+        logger.warning(f"Remote cache lookup of {digest or url} failed: {e}")
+        return None
+
+def fetchDigest(digest: str, out_path: str) -> bool:
+    """Fetch the artifact with this sha256 into out_path, returns False if the cache doesn't have it
+
+    A cache that is unreachable or holds a corrupt copy counts as a miss, the caller then downloads as usual.
+    """
+    cache = getRemoteCache()
+    if cache is None:
+        return False
+    key = _blobKey(digest)
+    try:
+        if cache.size(key) is None:
+            logger.debug(f"Remote cache miss for {digest}")
+            return False
+        logger.info(f"Fetching {os.path.basename(out_path)} from remote cache {cache}")
+        cache.get(key, out_path)
+    except Exception as e:
+        logger.warning(f"Remote cache fetch of {digest} failed: {e}")
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return False
+    calculated = sha256File(out_path)
+    if calculated != digest:
+        logger.warning(f"Remote cache copy of {digest} is corrupt (got {calculated}), ignoring it")
+        os.remove(out_path)
+        return False
+    return True
+
+def fetchURL(url: str, out_path: str) -> bool:
+    """Fetch the artifact last published for url into out_path, returns False if the cache doesn't have it
+
+    The digest comes from the cache itself here, so the result is only as trustworthy as the cache. Only use it for
+    artifacts that are verified against a signature afterwards, everything else goes through fetchDigest with a
+    digest from a trusted source.
+    """
+    cache = getRemoteCache()
+    if cache is None:
+        return False
+    try:
+        ref = cache.getBytes(_refKey(url))
+    except Exception as e:
+        logger.warning(f"Remote cache lookup of {url} failed: {e}")
+        return False
+    if ref is None:
+        logger.debug(f"Remote cache miss for {url}")
+        return False
+    return fetchDigest(json.loads(ref)["sha256"], out_path)
+
+def publish(path: str, url: str = None, digest: str = None) -> bool:
+    """Write a verified artifact through to the remote cache, optionally findable by the URL it came from
+
+    Failures are logged and otherwise ignored, the cache must never break a build.
+    """
+    cache = getRemoteCache()
+    if cache is None:
+        return False
+    if digest is None:
+        digest = sha256File(path)
+    key = _blobKey(digest)
+    try:
+        if cache.size(key) != os.path.getsize(path):
+            logger.info(f"Uploading {os.path.basename(path)} to remote cache {cache}")
+            cache.put(key, path)
+        if url is not None:
+            cache.putBytes(_refKey(url), json.dumps({"url": url, "sha256": digest, "size": os.path.getsize(path)}).encode())
+    except Exception as e:
+        logger.warning(f"Remote cache upload of {path} failed: {e}")
+        return False
+    return True
@@ -0,0 +1,310 @@
+from loguru import logger
+import base64
+import ctypes
+import hmac
+import json
+import os
+import resource
+import secrets
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+# Signing helper for avbroot and custota-tool, so the encrypted keys are decrypted once per run instead of
+# once per tool invocation, and the passphrases never reach the tools.
+#
+# The server runs in its own process with its memory locked and core dumps disabled. It gets the passphrases on
+# stdin and serves raw RSA signatures over a unix socket in a private directory. The tools run
+# signing_client.py with avbtool's signing helper semantics, `<program> <algorithm> <public key>`, padded data
+# on stdin and the signature on stdout. Every build gets its own token, revoked when the build is done.
+socket_env = "PIXEL_OTA_SIGNING_SOCKET"
+token_env = "PIXEL_OTA_SIGNING_TOKEN"
+client_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "signing_client.py")
+
+_MCL_CURRENT = 1
+_MCL_FUTURE = 2
+_PR_SET_PDEATHSIG = 1
+_PR_SET_DUMPABLE = 4
+
+@dataclass
+class _LoadedKey:
+    name: str
+    public_key_path: str
+    size: int # bytes
+    n: int
+    p: int
+    q: int
+    dmp1: int
+    dmq1: int
+    iqmp: int
+
+    def sign(self, data: bytes) -> bytes:
+        """Raw RSA private key operation, the data is already padded by the tool"""
+        if len(data) != self.size:
+            raise ValueError(f"Expected {self.size} bytes to sign with {self.name}, got {len(data)}")
+        m = int.from_bytes(data, "big")
+        if m >= self.n:
+            raise ValueError("Data to sign is not smaller than the modulus")
+        # CRT is about four times faster than a plain pow(m, d, n)
+        s1 = pow(m, self.dmp1, self.p)
+        s2 = pow(m, self.dmq1, self.q)
+        h = (self.iqmp * (s1 - s2)) % self.p
+        return (s2 + h * self.q).to_bytes(self.size, "big")
+
+def _harden():
+    libc = ctypes.CDLL(None, use_errno=True)
+    # keys must not end up in a core dump, and nothing else may ptrace us
+    libc.prctl(_PR_SET_DUMPABLE, 0, 0, 0, 0)
+    # don't outlive the build that started us
+    libc.prctl(_PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0)
+
+def _lockMemory():
+    """Keep the loaded keys out of swap
+
+    Called once the keys are loaded. MCL_FUTURE is only asked for without a memlock limit, with one every later
+    allocation that crosses it would fail with ENOMEM instead of just going unlocked.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    flags = _MCL_CURRENT
+    if resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] == resource.RLIM_INFINITY:
+        flags |= _MCL_FUTURE
+    if libc.mlockall(flags) != 0:
+        logger.warning(f"mlockall failed: {os.strerror(ctypes.get_errno())}, raise RLIMIT_MEMLOCK to keep keys out of swap")
+
+def _loadKey(name: str, key_path: str, passphrase: str, public_dir: str) -> _LoadedKey:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    with open(key_path, 'rb') as f:
+        key = serialization.load_pem_private_key(f.read(), password=passphrase.encode() if passphrase else None)
+    assert isinstance(key, rsa.RSAPrivateKey), f"{key_path} is not an RSA key"
+    # the tools take the public half in place of the private key when a signing helper is used
+    public_key_path = os.path.join(public_dir, f"{name}.pub.pem")
+    with open(public_key_path, 'wb') as f:
+        f.write(key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    numbers = key.private_numbers()
+    return _LoadedKey(
+        name=name,
+        public_key_path=public_key_path,
+        size=(key.key_size + 7) // 8,
+        n=numbers.public_numbers.n,
+        p=numbers.p,
+        q=numbers.q,
+        dmp1=numbers.dmp1,
+        dmq1=numbers.dmq1,
+        iqmp=numbers.iqmp,
+    )
+
+class _SigningRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+            # only once the reply is out, the process exits as soon as serve_forever returns
+            if self.server.shutdown_requested:
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+class _SigningServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, keys: dict[str, _LoadedKey], admin_token: str):
+        self.keys_by_path = {key.public_key_path: key for key in keys.values()}
+        self.admin_token = admin_token
+        self.tokens = set()
+        self.tokens_lock = threading.Lock()
+        self.shutdown_requested = False
+        super().__init__(socket_path, _SigningRequestHandler)
+
+    def _authorized(self, token: str) -> bool:
+        with self.tokens_lock:
+            return any(hmac.compare_digest(token, t) for t in self.tokens)
+
+    def dispatch(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "sign":
+            if not self._authorized(str(request.get("token", ""))):
+                return {"error": "token is not authorized"}
+            key = self.keys_by_path.get(os.path.abspath(request["public_key"]))
+            if key is None:
+                return {"error": f"no key for public key {request['public_key']}"}
+            algorithm = request.get("algorithm", "")
+            # avbtool algorithm names end in the key size, e.g. SHA256_RSA4096
+            if "_RSA" in algorithm and algorithm.rsplit("_RSA", 1)[1] != str(key.size * 8):
+                return {"error": f"algorithm {algorithm} does not match the {key.size * 8} bit key {key.name}"}
+            signature = key.sign(base64.b64decode(request["data"]))
+            logger.debug(f"Signed {key.size} bytes with {key.name} ({algorithm})")
+            return {"signature": base64.b64encode(signature).decode()}
+
+        if not hmac.compare_digest(str(request.get("admin", "")), self.admin_token):
+            return {"error": "admin token is not valid"}
+        if op == "authorize":
+            with self.tokens_lock:
+                self.tokens.add(request["token"])
+            return {"ok": True}
+        if op == "revoke":
+            with self.tokens_lock:
+                self.tokens.discard(request["token"])
+            return {"ok": True}
+        if op == "shutdown":
+            self.shutdown_requested = True
+            return {"ok": True}
+        return {"error": f"unknown op {op}"}
+
+def serve(socket_path: str):
+    """Server process entry point, the key paths and passphrases arrive as JSON on stdin"""
+    _harden()
+    os.umask(0o077)
+    config = json.loads(sys.stdin.read())
+    public_dir = os.path.dirname(socket_path)
+    keys = {name: _loadKey(name, spec["path"], spec["passphrase"], public_dir) for name, spec in config["keys"].items()}
+    admin_token = config["admin_token"]
+    del config
+    _lockMemory()
+    server = _SigningServer(socket_path, keys, admin_token)
+    # the parent waits for this line before it starts any tool
+    print(json.dumps({name: key.public_key_path for name, key in keys.items()}), flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+class SigningHelper:
+    """Owns a signing server for the lifetime of a with block
+
+        with SigningHelper({"avb": ("keys/avb.key", "PASSPHRASE_AVB"), "ota": ("keys/ota.key", "PASSPHRASE_OTA")}) as signer:
+            with signer.authorized() as env:
+                subprocess.run([..., "--signing-helper", signer.client_path], env=env)
+
+    A process that only builds through the helper should call dropPassphrases() right after start().
+    """
+
+    client_path = client_path
+
+    def __init__(self, keys: dict[str, tuple[str, str]]):
+        self.keys = keys
+        self.public_keys: dict[str, str] = {}
+        self._dir = None
+        self._process = None
+        self._admin_token = None
+        self._lock = threading.Lock()
+
+    @property
+    def socket_path(self) -> str:
+        return os.path.join(self._dir, "signing.sock")
+
+    def start(self) -> "SigningHelper":
+        self._dir = tempfile.mkdtemp(prefix="pixel-ota-signing-")
+        self._admin_token = secrets.token_hex(32)
+        # the server gets the passphrases and its admin token through a pipe, never through its environment or arguments
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "deps.signing", "serve", self.socket_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=self._baseEnv(),
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        config = {"keys": {}, "admin_token": self._admin_token}
+        for name, (key_path, env_var) in self.keys.items():
+            passphrase = os.getenv(env_var)
+            assert passphrase is not None, f"{env_var} environment variable is not set"
+            config["keys"][name] = {"path": os.path.abspath(key_path), "passphrase": passphrase}
+        self._process.stdin.write(json.dumps(config).encode())
+        self._process.stdin.close()
+        ready = self._process.stdout.readline()
+        if not ready:
+            self.stop()
+            raise RuntimeError("Signing helper failed to start, check the key paths and passphrases")
+        self.public_keys = json.loads(ready)
+        logger.info(f"Signing helper ready with keys {', '.join(self.public_keys)}")
+        return self
+
+    def dropPassphrases(self):
+        """Remove the passphrases from this process' environment once the server has them
+
+        After this no child process can inherit them, whether or not it's started with childEnv.
+        """
+        for _, env_var in self.keys.values():
+            os.environ.pop(env_var, None)
+
+    def _baseEnv(self) -> dict[str, str]:
+        passphrase_vars = {env_var for _, env_var in self.keys.values()}
+        return {k: v for k, v in os.environ.items() if k not in passphrase_vars}
+
+    def _request(self, request: dict) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.socket_path)
+            s.sendall(json.dumps(request).encode() + b"\n")
+            line = s.makefile('rb').readline()
+        if not line:
+            raise RuntimeError("Signing helper closed the connection without replying")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Signing helper: {response['error']}")
+        return response
+
+    def authorize(self) -> str:
+        """A new token for one build"""
+        token = secrets.token_hex(32)
+        self._request({"admin": self._admin_token, "op": "authorize", "token": token})
+        return token
+
+    def revoke(self, token: str):
+        self._request({"admin": self._admin_token, "op": "revoke", "token": token})
+
+    @contextmanager
+    def authorized(self):
+        """Tool environment with a token that is only valid inside the with block"""
+        token = self.authorize()
+        try:
+            yield self.childEnv(token)
+        finally:
+            self.revoke(token)
+
+    def publicKeyPath(self, name: str) -> str:
+        return self.public_keys[name]
+
+    def childEnv(self, token: str) -> dict[str, str]:
+        """Environment for a tool that signs through the helper, without any of the passphrases"""
+        env = self._baseEnv()
+        env[socket_env] = self.socket_path
+        env[token_env] = token
+        return env
+
+    def stop(self):
+        with self._lock:
+            if self._process is not None:
+                if self._process.poll() is None:
+                    try:
+                        self._request({"admin": self._admin_token, "op": "shutdown"})
+                        self._process.wait(timeout=10)
+                    except (OSError, RuntimeError, subprocess.TimeoutExpired):
+                        self._process.kill()
+                        self._process.wait()
+                self._process.stdout.close()
+                self._process = None
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+        logger.info("Signing helper stopped")
+
+    def __enter__(self) -> "SigningHelper":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    assert len(sys.argv) == 3 and sys.argv[1] == "serve", "usage: python3 -m deps.signing serve SOCKET"
+    serve(sys.argv[2])
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Signing helper client run by avbroot and custota-tool, see deps/signing.py
+
+Invoked as `signing_client.py <algorithm> <public key path>` with the data to sign on stdin, writes the
+signature to stdout. Standard library only, the tools may run it with any python3.
+"""
+import base64
+import json
+import os
+import socket
+import sys
+
+def main() -> int:
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} <algorithm> <public key path>", file=sys.stderr)
+        return 2
+    socket_path = os.getenv("PIXEL_OTA_SIGNING_SOCKET")
+    token = os.getenv("PIXEL_OTA_SIGNING_TOKEN")
+    if socket_path is None or token is None:
+        print("PIXEL_OTA_SIGNING_SOCKET and PIXEL_OTA_SIGNING_TOKEN must be set", file=sys.stderr)
+        return 2
+    request = {
+        "op": "sign",
+        "token": token,
+        "algorithm": sys.argv[1],
+        "public_key": os.path.abspath(sys.argv[2]),
+        "data": base64.b64encode(sys.stdin.buffer.read()).decode(),
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode() + b"\n")
+        response = json.loads(s.makefile('rb').readline())
+    if "error" in response:
+        print(f"signing helper: {response['error']}", file=sys.stderr)
+        return 1
+    sys.stdout.buffer.write(base64.b64decode(response["signature"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
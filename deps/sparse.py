@@ -0,0 +1,237 @@
+from loguru import logger
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import struct
+
+default_block_size = 4096
+_scan_size = 1024 * 1024
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = None
+
+def _punchHole(fd: int, offset: int, length: int) -> bool:
+    """Deallocate a range of a file without changing its size, returns False if the filesystem can't"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    ret = _libc.fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length)
+    return ret == 0
+
+def dataSegments(fd: int, size: int):
+    """Yield (offset, length) of the allocated parts of a file, or the whole file if holes can't be queried"""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO: # no data after offset
+                return
+            # SEEK_DATA not supported here, treat everything as data
+            yield offset, size - offset
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, min(end, size) - start
+        offset = end
+
+def _zeroRuns(data: bytes, base: int, block_size: int):
+    """Yield (offset, length) of block aligned zero runs in data, which starts at file offset base"""
+    zero_block = bytes(block_size)
+    run_start = None
+    for pos in range(0, len(data), block_size):
+        block = data[pos:pos + block_size]
+        if len(block) == block_size and block == zero_block:
+            if run_start is None:
+                run_start = pos
+        elif run_start is not None:
+            yield base + run_start, pos - run_start
+            run_start = None
+    if run_start is not None:
+        yield base + run_start, len(data) - len(data) % block_size - run_start
+
+def sparsifyFile(path: str, block_size: int = default_block_size) -> int:
+    """Punch holes over zero filled blocks of a file in place, returns the number of bytes released"""
+    before = os.stat(path).st_blocks * 512
+    size = os.path.getsize(path)
+    zero_scan = bytes(_scan_size)
+    with open(path, 'r+b') as f:
+        fd = f.fileno()
+        for segment_start, segment_length in list(dataSegments(fd, size)):
+            # scan from a block aligned offset so holes line up with filesystem blocks
+            offset = segment_start - segment_start % block_size
+            segment_end = segment_start + segment_length
+            while offset < segment_end:
+                data = os.pread(fd, min(_scan_size, segment_end - offset), offset)
+                if not data:
+                    break
+                if data == zero_scan[:len(data)]:
+                    runs = [(offset, len(data) - len(data) % block_size)]
+                else:
+                    runs = _zeroRuns(data, offset, block_size)
+                for run_offset, run_length in runs:
+                    if run_length > 0 and not _punchHole(fd, run_offset, run_length):
+                        logger.debug(f"Filesystem does not support hole punching, leaving {path} as is")
+                        return 0
+                offset += len(data)
+    released = before - os.stat(path).st_blocks * 512
+    if released > 0:
+        logger.debug(f"Released {released / 1024**2:.1f} MiB of zeros from {path}")
+    return max(released, 0)
+
+def sparsifyTree(directory: str, block_size: int = default_block_size) -> int:
+    released = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                released += sparsifyFile(path, block_size)
+    logger.info(f"Released {released / 1024**2:.1f} MiB of zero blocks in {directory}")
+    return released
+
+def copySparse(src: str, dst: str) -> int:
+    """Copy a file preserving its holes, returns the number of bytes actually copied"""
+    size = os.path.getsize(src)
+    copied = 0
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        for offset, length in dataSegments(src_fd, size):
+            end = offset + length
+            while offset < end:
+                try:
+                    n = os.copy_file_range(src_fd, dst_fd, end - offset, offset, offset)
+                except OSError:
+                    # cross filesystem copies fail on older kernels
+                    data = os.pread(src_fd, min(_scan_size, end - offset), offset)
+                    n = os.pwrite(dst_fd, data, offset)
+                if n == 0:
+                    break
+                offset += n
+                copied += n
+        fdst.truncate(size)
+    shutil.copymode(src, dst)
+    return copied
+
+# Android sparse image format, as read by fastboot
+_SPARSE_HEADER_MAGIC = 0xed26ff3a
+_sparse_header = struct.Struct("<IHHHHIIII")
+_chunk_header = struct.Struct("<HHII")
+_CHUNK_TYPE_RAW = 0xCAC1
+_CHUNK_TYPE_FILL = 0xCAC2
+# keeps raw chunk sizes well within their 32 bit length field
+_max_raw_chunk = 64 * 1024 * 1024
+
+def _blockKind(block: bytes) -> bytes | None:
+    """The 4 byte fill pattern if the whole block repeats it, otherwise None"""
+    pattern = block[:4]
+    if block == pattern * (len(block) // 4):
+        return pattern
+    return None
+
+def writeAndroidSparse(src: str, dst: str, block_size: int = default_block_size) -> str:
+    """Convert a raw image into an Android sparse image, zero and repeating blocks become fill chunks
+
+    Fill chunks are a few bytes on the wire, so fastboot only transfers blocks that hold data.
+    """
+    assert block_size % 4 == 0
+    size = os.path.getsize(src)
+    total_blocks = (size + block_size - 1) // block_size
+    chunks = 0
+
+    with open(src, 'rb') as fsrc, open(dst + ".part", 'wb') as fdst:
+        fdst.write(bytes(_sparse_header.size))
+
+        raw_blocks = []
+        fill_pattern = None
+        fill_count = 0
+
+        def flushRaw():
+            nonlocal chunks
+            if raw_blocks:
+                data = b"".join(raw_blocks)
+                fdst.write(_chunk_header.pack(_CHUNK_TYPE_RAW, 0, len(raw_blocks), _chunk_header.size + len(data)))
+                fdst.write(data)
+                raw_blocks.clear()
+                chunks += 1
+
+        def flushFill():
+            nonlocal chunks, fill_pattern, fill_count
+            if fill_count:
+                fdst.write(_chunk_header.pack(_CHUNK_TYPE_FILL, 0, fill_count, _chunk_header.size + 4))
+                fdst.write(fill_pattern)
+                chunks += 1
+            fill_pattern = None
+            fill_count = 0
+
+        segments = list(dataSegments(fsrc.fileno(), size))
+        segment_index = 0
+        block_index = 0
+        zero_pattern = bytes(4)
+        while block_index < total_blocks:
+            offset = block_index * block_size
+            # holes are zero, skip reading them block by block
+            while segment_index < len(segments) and segments[segment_index][0] + segments[segment_index][1] <= offset:
+                segment_index += 1
+            if segment_index >= len(segments) or segments[segment_index][0] > offset:
+                hole_end = segments[segment_index][0] if segment_index < len(segments) else size
+                hole_blocks = (hole_end - offset) // block_size
+                if hole_blocks > 0:
+                    if fill_pattern != zero_pattern:
+                        flushRaw()
+                        flushFill()
+                        fill_pattern = zero_pattern
+                    fill_count += hole_blocks
+                    block_index += hole_blocks
+                    continue
+
+            block = os.pread(fsrc.fileno(), block_size, offset)
+            if len(block) < block_size:
+                block += bytes(block_size - len(block))
+            pattern = _blockKind(block)
+            if pattern is None:
+                flushFill()
+                raw_blocks.append(block)
+                if len(raw_blocks) * block_size >= _max_raw_chunk:
+                    flushRaw()
+            else:
+                if pattern != fill_pattern:
+                    flushRaw()
+                    flushFill()
+                    fill_pattern = pattern
+                fill_count += 1
+            block_index += 1
+        flushRaw()
+        flushFill()
+
+        fdst.seek(0)
+        fdst.write(_sparse_header.pack(_SPARSE_HEADER_MAGIC, 1, 0, _sparse_header.size, _chunk_header.size, block_size, total_blocks, chunks, 0))
+
+    os.replace(dst + ".part", dst)
+    logger.debug(f"Wrote Android sparse image {dst} with {chunks} chunks ({os.path.getsize(dst) / 1024**2:.1f} MiB for {size / 1024**2:.1f} MiB raw)")
+    return dst
+
+def isAndroidSparse(path: str) -> bool:
+    with open(path, 'rb') as f:
+        header = f.read(4)
+    return len(header) == 4 and struct.unpack("<I", header)[0] == _SPARSE_HEADER_MAGIC
+
+def convertTreeToAndroidSparse(directory: str, block_size: int = default_block_size) -> list[str]:
+    """Replace every .img in directory with an Android sparse image where that makes it smaller"""
+    converted = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith(".img") or not os.path.isfile(path) or isAndroidSparse(path):
+            continue
+        sparse_path = path + ".sparse"
+        writeAndroidSparse(path, sparse_path, block_size)
+        if os.path.getsize(sparse_path) < os.path.getsize(path):
+            os.replace(sparse_path, path)
+            converted.append(path)
+        else:
+            os.remove(sparse_path)
+    logger.info(f"Converted {len(converted)} images in {directory} to Android sparse format")
+    return converted
@@ -0,0 +1,103 @@
+from loguru import logger
+import json
+import os
+import resource
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+@dataclass
+class StageRecord:
+    name: str
+    seconds: float
+    bytes_written: int
+
+def bytesWritten() -> int:
+    """Bytes written to storage by this process and its reaped children so far"""
+    # on Linux ru_oublock is the task's write_bytes in 512 byte units
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_oublock
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock
+    return (own + children) * 512
+
+class StageRecorder:
+    """Wall time and bytes written per pipeline stage
+
+    The write counters are process wide, so they are only exact when one build runs at a time.
+    """
+
+    def __init__(self):
+        self.records: list[StageRecord] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        written = bytesWritten()
+        try:
+            yield
+        finally:
+            record = StageRecord(name=name, seconds=time.perf_counter() - start, bytes_written=bytesWritten() - written)
+            self.records.append(record)
+            logger.debug(f"Stage {name} took {record.seconds:.2f}s and wrote {record.bytes_written / 1024**2:.1f} MiB")
+
+    def total(self) -> float:
+        return sum(record.seconds for record in self.records)
+
+# how many past runs of each stage are kept to estimate the next one from
+history_length = 50
+history_filename = "stage_history.json"
+# stages whose time doesn't depend on the OTA size
+fixed_stages = {"modules", "gen-update-info", "gc"}
+
+class StageHistory:
+    """Stage timings of past builds, persisted next to the download cache so the planner can estimate new ones
+
+    Stages that handle the OTA are modelled as seconds per byte of OTA, the others as a fixed time.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.stages: dict[str, list[dict]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.stages = json.load(f).get("stages", {})
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Ignoring unreadable stage history {path}: {e}")
+
+    def add(self, records: list[StageRecord], ota_size: int):
+        with self._lock:
+            for record in records:
+                runs = self.stages.setdefault(record.name, [])
+                runs.append({"seconds": record.seconds, "ota_size": ota_size, "time": time.time()})
+                del runs[:-history_length]
+
+    def estimate(self, name: str, ota_size: int) -> float | None:
+        """Median of the past runs scaled to ota_size, None if the stage never ran"""
+        with self._lock:
+            runs = self.stages.get(name, [])
+            if not runs:
+                return None
+            if name in fixed_stages:
+                return statistics.median(run["seconds"] for run in runs)
+            return statistics.median(run["seconds"] / max(run["ota_size"], 1) for run in runs) * ota_size
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"stages": self.stages})
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+_history_lock = threading.Lock()
+
+def recordHistory(path: str, records: list[StageRecord], ota_size: int):
+    """Add one build's stage timings to the history at path, concurrent builds in this process don't lose updates"""
+    with _history_lock:
+        history = StageHistory(path)
+        history.add(records, ota_size)
+        history.save()
@@ -0,0 +1,128 @@
+from loguru import logger
+import errno
+import os
+import requests
+from dataclasses import dataclass, fields
+from .sparse import copySparse
+from .transport import getSession
+
+# every tier can be moved to its own volume, e.g. the download cache on bulk disk and scratch on NVMe or tmpfs
+storage_env = {
+    "download_dir": "PIXEL_OTA_DOWNLOAD_DIR",
+    "scratch_dir": "PIXEL_OTA_SCRATCH_DIR",
+    "extract_dir": "PIXEL_OTA_EXTRACT_DIR",
+    "publish_dir": "PIXEL_OTA_PUBLISH_DIR",
+}
+
+# headroom left on every volume so a build never fills a disk completely
+default_reserve = 512 * 1024**2
+# extracted partition images relative to the OTA size, after sparsifying
+extract_space_ratio = 2.0
+
+@dataclass
+class StorageConfig:
+    download_dir: str = "downloads"
+    # patched OTA, packaged images and bundled modules
+    scratch_dir: str = "patched"
+    # extracted fastboot images, None keeps them in <scratch_dir>/extracted
+    extract_dir: str | None = None
+    publish_dir: str = "ota"
+
+    @classmethod
+    def fromEnv(cls, **overrides) -> "StorageConfig":
+        """Defaults, overridden by the PIXEL_OTA_*_DIR environment variables, overridden by non-None keyword arguments"""
+        values = {}
+        for f in fields(cls):
+            value = overrides.get(f.name)
+            if value is None:
+                value = os.getenv(storage_env[f.name])
+            if value:
+                values[f.name] = value
+        return cls(**values)
+
+    def log(self):
+        for f in fields(self):
+            path = getattr(self, f.name)
+            if path is not None:
+                logger.info(f"Storage {f.name}: {path} ({freeSpace(path) / 1024**3:.1f} GiB free)")
+
+def _existingParent(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+def freeSpace(path: str) -> int:
+    """Bytes available to us on the volume path is, or will be, on"""
+    stat = os.statvfs(_existingParent(path))
+    return stat.f_bavail * stat.f_frsize
+
+def volumeOf(path: str) -> int:
+    """Device id of the volume path is, or will be, on"""
+    return os.stat(_existingParent(path)).st_dev
+
+def sameVolume(a: str, b: str) -> bool:
+    return volumeOf(a) == volumeOf(b)
+
+def remoteSize(url: str, session: requests.Session = None) -> int | None:
+    """The content-length of url from a HEAD request, None if the server doesn't say"""
+    if session is None:
+        session = getSession()
+    try:
+        res = session.head(url, allow_redirects=True)
+    except requests.RequestException as e:
+        logger.warning(f"HEAD request for {url} failed: {e}")
+        return None
+    if res.status_code != 200 or "content-length" not in res.headers:
+        return None
+    return int(res.headers["content-length"])
+
+def groupByVolume(required: dict[str, int]) -> list[tuple[list[str], int, int]]:
+    """(paths, bytes required, bytes free) for every volume the paths are on"""
+    volumes = {}
+    for path, size in required.items():
+        if not size:
+            continue
+        paths, total = volumes.get(volumeOf(path), ([], 0))
+        volumes[volumeOf(path)] = (paths + [path], total + size)
+    return [(paths, total, freeSpace(paths[0])) for paths, total in volumes.values()]
+
+def checkFreeSpace(required: dict[str, int], reserve: int = default_reserve):
+    """Fail before any work starts if the bytes about to be written to each path don't fit
+
+    Paths on the same volume are added up, so tiers sharing a disk are checked together.
+    """
+    for paths, total, available in groupByVolume(required):
+        if total + reserve > available:
+            raise OSError(errno.ENOSPC, f"Need {total / 1024**3:.1f} GiB (+{reserve / 1024**3:.1f} GiB reserve) for {', '.join(paths)} but only {available / 1024**3:.1f} GiB is free")
+        logger.debug(f"{total / 1024**3:.1f} GiB needed for {', '.join(paths)}, {available / 1024**3:.1f} GiB free")
+
+def buildSpace(ota_size: int, patched_dir: str, extracted_dir: str | None, ota_dir: str, package: bool = True) -> dict[str, int]:
+    """Bytes a build writes to each of its directories, the patched OTA and its published copy are each about as large as the input"""
+    required = {patched_dir: ota_size}
+    required[ota_dir] = required.get(ota_dir, 0) + ota_size
+    if extracted_dir is not None:
+        required[extracted_dir] = required.get(extracted_dir, 0) + int(ota_size * extract_space_ratio)
+        if package:
+            required[patched_dir] += ota_size
+    return required
+
+def stageFile(src: str, dst: str, move: bool = False) -> str:
+    """Put src at dst atomically, readers of dst only ever see the old or the complete new file
+
+    A move on the same volume is a plain rename. Otherwise the data is copied into a temporary file next to dst,
+    which is then renamed over it. Copies are never hard links, a rebuild rewriting src must not change dst.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    if move and sameVolume(src, dst):
+        os.replace(src, dst)
+        return dst
+    temp_path = dst + ".part"
+    # copy_file_range lets filesystems that support it share extents instead of copying
+    copySparse(src, temp_path)
+    with open(temp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, dst)
+    if move:
+        os.remove(src)
+    return dst
@@ -0,0 +1,119 @@
+from loguru import logger
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tqdm.auto import tqdm
+from .remote_cache import fetchURL
+
+# (connect, read) timeouts in seconds, the read timeout is per chunk rather than for the whole download
+default_timeout = (10, 60)
+
+# keep-alive connection pool size per host, sized by how many parallel requests each host sees
+host_pool_sizes = {
+    "developers.google.com": 2,
+    "dl.google.com": 8,
+    "api.github.com": 4,
+    "github.com": 4,
+    "objects.githubusercontent.com": 8,
+    "release-assets.githubusercontent.com": 8,
+}
+default_pool_size = 4
+
+default_retry = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD"],
+    respect_retry_after_header=True,
+)
+
+class _TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request that doesn't set one"""
+
+    def __init__(self, timeout=default_timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+def createSession(timeout=default_timeout, retry: Retry = default_retry) -> requests.Session:
+    session = requests.Session()
+    default_adapter = _TimeoutAdapter(timeout=timeout, max_retries=retry, pool_connections=len(host_pool_sizes), pool_maxsize=default_pool_size)
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+    # requests picks the adapter with the longest matching prefix, so these take precedence
+    for host, pool_size in host_pool_sizes.items():
+        session.mount(f"https://{host}/", _TimeoutAdapter(timeout=timeout, max_retries=retry, pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+def getSession() -> requests.Session:
+    """The process wide session, so every fetch and download reuses the same warm connections"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = createSession()
+        return _shared_session
+
+# release listings barely change, a long running process can reuse them for a while
+listing_cache_ttl = 0
+_listing_cache = {}
+_listing_cache_lock = threading.Lock()
+
+def setListingCacheTTL(seconds: float):
+    global listing_cache_ttl
+    with _listing_cache_lock:
+        listing_cache_ttl = seconds
+        _listing_cache.clear()
+
+def getListing(url: str, session: requests.Session = None, headers: dict = None, cookies: dict = None) -> requests.Response:
+    """GET a release listing, served from memory if it was fetched less than listing_cache_ttl seconds ago"""
+    if session is None:
+        session = getSession()
+    key = (url, tuple(sorted((headers or {}).items())), tuple(sorted((cookies or {}).items())))
+    with _listing_cache_lock:
+        cached = _listing_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < listing_cache_ttl:
+            logger.debug(f"Using cached listing for {url}")
+            return cached[1]
+
+    res = session.get(url, headers=headers, cookies=cookies)
+    if res.status_code == 200 and listing_cache_ttl > 0:
+        with _listing_cache_lock:
+            _listing_cache[key] = (time.monotonic(), res)
+    return res
+
+def downloadFile(url: str, out_path: str, desc: str = None, session: requests.Session = None, from_cache: bool = False) -> int:
+    """Stream url into out_path, returns the number of bytes written
+
+    from_cache lets the remote cache serve url by the URL alone. Anyone who can write to the cache can change what
+    it serves for a URL, so only callers that verify the result against a signature may set it.
+    """
+    if desc is None:
+        desc = os.path.basename(out_path)
+    # another runner may already have paid for this download
+    if from_cache and fetchURL(url, out_path):
+        return os.path.getsize(out_path)
+    if session is None:
+        session = getSession()
+
+    with session.get(url, stream=True) as r:
+        r.raise_for_status()
+        total_size = int(r.headers.get('content-length', 0))
+        with tqdm(total=total_size, unit='B', unit_scale=True, desc=desc) as pbar:
+            with open(out_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    pbar.update(len(chunk))
+    size = os.path.getsize(out_path)
+    assert total_size == size, f"Downloaded file size {size} does not match expected size {total_size}"
+    logger.debug(f"Downloaded {size} bytes from {url}")
+    return size
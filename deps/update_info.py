@@ -0,0 +1,186 @@
+from loguru import logger
+import json
+import mmap
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+
+# In process replacement for custota-tool gen-update-info, plus the release info next to it.
+# The structure is the one Custota reads: version 2 and a full entry with location_ota and location_csig.
+# It's laid out the way serde_json's pretty printer, which custota-tool uses, writes it: two space indents, raw UTF-8
+# rather than \u escapes and a trailing newline. That follows serde_json's formatter, it was not diffed against a
+# custota-tool binary.
+update_info_version = 2
+metadata_entry = "META-INF/com/android/metadata"
+
+_eocd = struct.Struct("<4sHHHHIIH")
+_eocd64_locator = struct.Struct("<4sIQI")
+_eocd64 = struct.Struct("<4sQHHIIQQQQ")
+_central_header = struct.Struct("<4sHHHHHHIIIHHHHHII")
+_local_header = struct.Struct("<4sHHHHHIIIHH")
+
+def _findEndOfCentralDirectory(data: mmap.mmap) -> tuple[int, int, int]:
+    """(central directory offset, size, entry count), the EOCD sits in the last 64 KiB + 22 bytes"""
+    start = max(0, len(data) - 0xFFFF - _eocd.size)
+    position = data.rfind(b"PK\x05\x06", start)
+    if position < 0:
+        raise ValueError("Not a zip file, no end of central directory record")
+    _, _, _, _, entries, cd_size, cd_offset, _ = _eocd.unpack_from(data, position)
+    if 0xFFFFFFFF in (cd_size, cd_offset) or entries == 0xFFFF:
+        locator = position - _eocd64_locator.size
+        signature, _, eocd64_offset, _ = _eocd64_locator.unpack_from(data, locator)
+        if signature != b"PK\x06\x07":
+            raise ValueError("Zip64 end of central directory locator is missing")
+        signature, _, _, _, _, _, _, entries, cd_size, cd_offset = _eocd64.unpack_from(data, eocd64_offset)
+        if signature != b"PK\x06\x06":
+            raise ValueError("Zip64 end of central directory record is corrupt")
+    return cd_offset, cd_size, entries
+
+def _zip64Fields(extra: bytes, wanted: list[str]) -> dict[str, int]:
+    """The 64 bit values from a zip64 extra field, they are only present for the fields that overflowed"""
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, position)
+        if header_id == 0x0001:
+            values = struct.unpack_from(f"<{len(wanted)}Q", extra, position + 4)
+            return dict(zip(wanted, values))
+        position += 4 + length
+    raise ValueError("Zip64 extra field is missing")
+
+def readZipEntry(path: str, name: str) -> bytes:
+    """One entry of a zip, located through the central directory of the memory mapped file
+
+    Only the directory and the entry itself are touched, no matter how large the payload next to them is.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        cd_offset, cd_size, entries = _findEndOfCentralDirectory(data)
+        position = cd_offset
+        wanted = name.encode()
+        for _ in range(entries):
+            (signature, _, _, flags, method, _, _, _, compressed_size, uncompressed_size,
+                name_length, extra_length, comment_length, _, _, _, local_offset) = _central_header.unpack_from(data, position)
+            if signature != b"PK\x01\x02":
+                raise ValueError(f"Corrupt central directory in {path}")
+            name_start = position + _central_header.size
+            entry_name = data[name_start:name_start + name_length]
+            if entry_name == wanted:
+                overflowed = [key for key, value in (
+                    ("uncompressed_size", uncompressed_size),
+                    ("compressed_size", compressed_size),
+                    ("local_offset", local_offset),
+                ) if value == 0xFFFFFFFF]
+                if overflowed:
+                    extra = data[name_start + name_length:name_start + name_length + extra_length]
+                    values = _zip64Fields(extra, overflowed)
+                    compressed_size = values.get("compressed_size", compressed_size)
+                    local_offset = values.get("local_offset", local_offset)
+                if flags & 0x1:
+                    raise ValueError(f"{name} in {path} is encrypted")
+                signature, *_, local_name_length, local_extra_length = _local_header.unpack_from(data, local_offset)
+                if signature != b"PK\x03\x04":
+                    raise ValueError(f"Corrupt local header for {name} in {path}")
+                start = local_offset + _local_header.size + local_name_length + local_extra_length
+                content = data[start:start + compressed_size]
+                if method == 0:
+                    return content
+                if method == 8:
+                    return zlib.decompress(content, -15)
+                raise ValueError(f"Unsupported compression method {method} for {name} in {path}")
+            position = name_start + name_length + extra_length + comment_length
+    raise KeyError(f"{name} not found in {path}")
+
+def readOtaMetadata(path: str) -> dict[str, str]:
+    """The key=value pairs of the OTA's META-INF/com/android/metadata"""
+    metadata = {}
+    for line in readZipEntry(path, metadata_entry).decode().splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            metadata[key] = value
+    return metadata
+
+def metadataReleaseInfo(metadata: dict[str, str]) -> dict[str, str]:
+    """Release info fields that come from the OTA itself rather than from the OTA listing"""
+    return {
+        "fingerprint": metadata.get("post-build", ""),
+        "security_patch_level": metadata.get("post-security-patch-level", ""),
+        "timestamp": metadata.get("post-timestamp", ""),
+        "sdk_level": metadata.get("post-sdk-level", ""),
+    }
+
+def renderUpdateInfo(location: str, csig_location: str = None) -> str:
+    if csig_location is None:
+        csig_location = location + ".csig"
+    update_info = {
+        "version": update_info_version,
+        "full": {
+            "location_ota": location,
+            "location_csig": csig_location,
+        },
+    }
+    return json.dumps(update_info, indent=2, ensure_ascii=False) + "\n"
+
+def _writeAtomic(path: str, text: str) -> str:
+    # Custota clients may be polling the published directory
+    with open(path + ".part", 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + ".part", path)
+    return path
+
+def writeUpdateInfo(path: str, location: str, csig_location: str = None) -> str:
+    return _writeAtomic(path, renderUpdateInfo(location, csig_location))
+
+def writeReleaseInfo(path: str, fields: dict[str, str]) -> str:
+    """key=value lines, the release workflow loads them straight into its environment"""
+    return _writeAtomic(path, "".join(f"{key}={value}\n" for key, value in fields.items()))
+
+@dataclass
+class PublishedOTA:
+    ota_path: str
+    update_info_path: str
+    release_info_path: str
+    # where Custota fetches the OTA from, relative to the update info, defaults to ota_path
+    location: str | None = None
+    # written before the fields read from the OTA metadata
+    release_fields: dict[str, str] = field(default_factory=dict)
+
+def generateBatch(published: list[PublishedOTA]) -> list[PublishedOTA]:
+    """Write the update info and release info of every OTA in one pass, without spawning custota-tool"""
+    for entry in published:
+        metadata = readOtaMetadata(entry.ota_path)
+        location = entry.location if entry.location is not None else entry.ota_path
+        writeUpdateInfo(entry.update_info_path, location)
+        writeReleaseInfo(entry.release_info_path, {**entry.release_fields, **metadataReleaseInfo(metadata)})
+    logger.debug(f"Generated update info for {len(published)} OTAs")
+    return published
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write <device>.json and release_info-<device> for patched OTAs")
+    parser.add_argument("otas", nargs="+", metavar="OTA", help="patched OTA zips, the newest one per device wins")
+    parser.add_argument("--output-dir", help="where to write the files, defaults to the directory of each OTA")
+    args = parser.parse_args()
+
+    # the device and the build come from the OTA metadata, so any number of devices is handled in one pass
+    newest = {}
+    for ota_path in args.otas:
+        metadata = readOtaMetadata(ota_path)
+        device = metadata["pre-device"].split(",")[0]
+        timestamp = int(metadata.get("post-timestamp", 0))
+        if device not in newest or timestamp > newest[device][0]:
+            newest[device] = (timestamp, ota_path)
+
+    published = []
+    for device, (_, ota_path) in sorted(newest.items()):
+        output_dir = args.output_dir if args.output_dir is not None else os.path.dirname(ota_path)
+        os.makedirs(output_dir, exist_ok=True)
+        published.append(PublishedOTA(
+            ota_path=ota_path,
+            update_info_path=os.path.join(output_dir, f"{device}.json"),
+            release_info_path=os.path.join(output_dir, f"release_info-{device}"),
+            location=os.path.relpath(ota_path, output_dir),
+            release_fields={"device": device, "ota": os.path.basename(ota_path)},
+        ))
+    generateBatch(published)
+    for entry in published:
+        logger.info(f"Wrote {entry.update_info_path} and {entry.release_info_path}")
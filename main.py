@@ -14,6 +14,10 @@ from deps.chenxiaolong.afsr import fetchAfsrReleases, AfsrRelease
 from deps.chenxiaolong.custota import fetchCustotaReleases, CustotaRelease
 from deps.magisk import fetchMagiskReleases, MagiskRelease
 from deps.ota import fetchAllOTA, OTAInfo
+from deps.transport import getSession
+from deps.stages import StageRecorder
+from deps.update_info import PublishedOTA
+import requests
 from loguru import logger
 
 logger.debug("Debug log test")
@@ -34,9 +38,56 @@ class Dependencies:
     afsr_path: str
     selected_custota: CustotaRelease
     custota_path: str
+    # the downloaded release zips the tools above were unpacked from
+    avbroot_archive_path: str = None
+    afsr_archive_path: str = None
+    custota_archive_path: str = None
+
+def unpackTool(archive_path: str, download_dir: str, name: str, executable: str) -> str:
+    """Decompress a downloaded tool zip into download_dir/name and make it executable, returns the executable path"""
+    # So we can run the tool, it needs to be decompressed and made executable
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        # skip it if it's already unpacked, rewriting an executable another build is running fails
+        unpacked = all(
+            os.path.isfile(os.path.join(download_dir, name, info.filename)) and os.path.getsize(os.path.join(download_dir, name, info.filename)) == info.file_size
+            for info in zip_ref.infolist() if not info.is_dir()
+        )
+        if not unpacked:
+            zip_ref.extractall(os.path.join(download_dir, name))
+
+    assert os.path.exists(os.path.join(download_dir, name)) and os.path.isdir(os.path.join(download_dir, name))
+    assert os.path.exists(os.path.join(download_dir, name, executable)) and os.path.isfile(os.path.join(download_dir, name, executable))
+    tool_path = os.path.join(download_dir, name, executable)
+
+    if not os.access(tool_path, os.X_OK):
+        # make it executable
+        subprocess.run(["chmod", "+x", tool_path], check=True)
+    if not os.access(tool_path, os.X_OK):
+        raise Exception(f"{name} is not executable: {tool_path}")
+    return tool_path
+
+def selectMagisk(magisk_releases: list[MagiskRelease], magisk_version: str = None, magisk_debug: bool = False, magisk_prerelease: bool = False) -> MagiskRelease:
+    magisk_df = pd.DataFrame(magisk_releases)
+    magisk_df['obj'] = magisk_releases
+    magisk_df.fillna(value="", inplace=True)
+    logger.info(f"Fetched {len(magisk_releases)} Magisk releases")
+
+    filtered_magisk_mask = np.ones(len(magisk_df), dtype=bool)
+    if magisk_version is not None:
+        filtered_magisk_mask &= (magisk_df['tag_name'] == magisk_version) | (magisk_df['tag_name'] == f"v{magisk_version}")
+    if magisk_debug is not None:
+        filtered_magisk_mask &= magisk_df['debug'] == magisk_debug
+    if magisk_prerelease is not None:
+        filtered_magisk_mask &= magisk_df['prerelease'] == magisk_prerelease
+    
+    filtered_magisk_releases = magisk_df[filtered_magisk_mask]
 
-def fetchDependencies(
-    download_dir: str = "downloads",
+    assert len(filtered_magisk_releases) > 0, f"No matching Magisk releases found for criteria: version {magisk_version}, debug {magisk_debug}, prerelease {magisk_prerelease}"
+    logger.info(f"{len(filtered_magisk_releases)} Magisk releases found for the specified criteria, selecting the first one (should be the latest)")
+
+    return filtered_magisk_releases.iloc[0].obj
+
+def resolveDependencies(
     ota_android_version: str = None,
     ota_build_id: str = None,
     ota_build_branch: str = None,
@@ -58,13 +109,18 @@ def fetchDependencies(
     custota_version: str = None,
     custota_debug: bool = False,
     custota_prerelease: bool = False,
-) -> Dependencies:
-    
-    os.makedirs(download_dir, exist_ok=True)
+    session: requests.Session = None,
+) -> dict:
+    """Pick the OTA, Magisk and tool releases matching the criteria from the release listings, without downloading any of them
+
+    Returns the releases by name, the same names the lockfile uses.
+    """
+    if session is None:
+        session = getSession()
 
-    # download ota
+    # select ota
     if True:
-        otas = fetchAllOTA()
+        otas = fetchAllOTA(session=session)
         ota_df = pd.DataFrame(otas)
         ota_df['obj'] = otas
         ota_df.fillna(value="", inplace=True)
@@ -98,37 +154,17 @@ def fetchDependencies(
         logger.info(f"{len(filtered_releases)} OTA releases found for the specified criteria, selecting the latest one")
 
         selected_ota = filtered_releases.iloc[0].obj
-        ota_path = selected_ota.download(download_dir=download_dir, overwrite=False)
         logger.info(f"Selected OTA: {selected_ota.android_version}, {selected_ota.build_id}, {selected_ota.device}, {selected_ota.url}")
 
-    # download magisk
+    # select magisk
     if True:
-        magisk_releases = fetchMagiskReleases()
-        magisk_df = pd.DataFrame(magisk_releases)
-        magisk_df['obj'] = magisk_releases
-        magisk_df.fillna(value="", inplace=True)
-        logger.info(f"Fetched {len(magisk_releases)} Magisk releases")
-
-        filtered_magisk_mask = np.ones(len(magisk_df), dtype=bool)
-        if magisk_version is not None:
-            filtered_magisk_mask &= (magisk_df['tag_name'] == magisk_version) | (magisk_df['tag_name'] == f"v{magisk_version}")
-        if magisk_debug is not None:
-            filtered_magisk_mask &= magisk_df['debug'] == magisk_debug
-        if magisk_prerelease is not None:
-            filtered_magisk_mask &= magisk_df['prerelease'] == magisk_prerelease
-        
-        filtered_magisk_releases = magisk_df[filtered_magisk_mask]
-
-        assert len(filtered_magisk_releases) > 0, f"No matching Magisk releases found for criteria: version {magisk_version}, debug {magisk_debug}, prerelease {magisk_prerelease}"
-        logger.info(f"{len(filtered_magisk_releases)} Magisk releases found for the specified criteria, selecting the first one (should be the latest)")
-
-        selected_magisk = filtered_magisk_releases.iloc[0].obj
-        magisk_path = selected_magisk.download(download_dir=download_dir, overwrite=False)
+        magisk_releases = fetchMagiskReleases(session=session)
+        selected_magisk = selectMagisk(magisk_releases, magisk_version, magisk_debug, magisk_prerelease)
         logger.info(f"Selected Magisk: {selected_magisk.tag_name}, {selected_magisk.url}")
 
-    # download avbroot
+    # select avbroot
     if True:
-        avbroot_releases = fetchAvbrootReleases()
+        avbroot_releases = fetchAvbrootReleases(session=session)
         avbroot_df = pd.DataFrame(avbroot_releases)
         avbroot_df['obj'] = avbroot_releases
         avbroot_df.fillna(value="", inplace=True)
@@ -152,29 +188,11 @@ def fetchDependencies(
         logger.info(f"{len(filtered_avbroot)} Avbroot releases found for the specified criteria, selecting the first one (should be the latest)")
 
         selected_avbroot = filtered_avbroot.iloc[0].obj
-        download_dir = os.path.join(os.getcwd(), 'downloads')
-        avbroot_path = selected_avbroot.download(download_dir, overwrite=False)
         logger.info(f"Selected Avbroot: {selected_avbroot.tag_name}, {selected_avbroot.url}")
 
-        # So we can run avbroot, it needs to be decompressed and made executable
-        # decompress avbroot so that it can be used
-        with zipfile.ZipFile(avbroot_path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.join(download_dir, "avbroot"))
-
-        assert os.path.exists(os.path.join(download_dir, "avbroot")) and os.path.isdir(os.path.join(download_dir, "avbroot"))
-        assert os.path.exists(os.path.join(download_dir, "avbroot", "avbroot")) and os.path.isfile(os.path.join(download_dir, "avbroot", "avbroot"))
-        avbroot_path = os.path.join(download_dir, "avbroot", "avbroot")
-
-        import subprocess
-        if not os.access(avbroot_path, os.X_OK):
-            # make it executable
-            subprocess.run(["chmod", "+x", avbroot_path], check=True)
-        if not os.access(avbroot_path, os.X_OK):
-            raise Exception(f"avbroot is not executable: {avbroot_path}")
-        
-    # download custota
+    # select custota
     if True:
-        custota_releases = fetchCustotaReleases()
+        custota_releases = fetchCustotaReleases(session=session)
         custota_df = pd.DataFrame(custota_releases)
         custota_df['obj'] = custota_releases
         custota_df.fillna(value="", inplace=True)
@@ -198,29 +216,11 @@ def fetchDependencies(
         logger.info(f"{len(filtered_custota)} Custota releases found for the specified criteria, selecting the first one (should be the latest)")
 
         selected_custota = filtered_custota.iloc[0].obj
-        download_dir = os.path.join(os.getcwd(), 'downloads')
-        custota_path = selected_custota.download(download_dir, overwrite=False)
         logger.info(f"Selected Custota: {selected_custota.tag_name}, {selected_custota.url}")
 
-        # So we can run custota, it needs to be decompressed and made executable
-        # decompress custota so that it can be used
-        with zipfile.ZipFile(custota_path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.join(download_dir, "custota"))
-
-        assert os.path.exists(os.path.join(download_dir, "custota")) and os.path.isdir(os.path.join(download_dir, "custota"))
-        assert os.path.exists(os.path.join(download_dir, "custota", "custota-tool")) and os.path.isfile(os.path.join(download_dir, "custota", "custota-tool"))
-        custota_path = os.path.join(download_dir, "custota", "custota-tool")
-
-        import subprocess
-        if not os.access(custota_path, os.X_OK):
-            # make it executable
-            subprocess.run(["chmod", "+x", custota_path], check=True)
-        if not os.access(custota_path, os.X_OK):
-            raise Exception(f"custota is not executable: {custota_path}")
-
-    # download afsr
+    # select afsr
     if True:
-        afsr_releases = fetchAfsrReleases()
+        afsr_releases = fetchAfsrReleases(session=session)
         afsr_df = pd.DataFrame(afsr_releases)
         afsr_df['obj'] = afsr_releases
         afsr_df.fillna(value="", inplace=True)
@@ -243,25 +243,36 @@ def fetchDependencies(
         logger.info(f"{len(filtered_afsr)} Afsr releases found for the specified criteria, selecting the first one (should be the latest)")
 
         selected_afsr = filtered_afsr.iloc[0].obj
-        download_dir = os.path.join(os.getcwd(), 'downloads')
-        afsr_path = selected_afsr.download(download_dir, overwrite=False)
         logger.info(f"Selected Afsr: {selected_afsr.tag_name}, {selected_afsr.url}")
 
-        # So we can run afsr, it needs to be decompressed and made executable
-        # decompress afsr so that it can be used
-        with zipfile.ZipFile(afsr_path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.join(download_dir, "afsr"))
-
-        assert os.path.exists(os.path.join(download_dir, "afsr")) and os.path.isdir(os.path.join(download_dir, "afsr"))
-        assert os.path.exists(os.path.join(download_dir, "afsr", "afsr")) and os.path.isfile(os.path.join(download_dir, "afsr", "afsr"))
-        afsr_path = os.path.join(download_dir, "afsr", "afsr")
+    return {
+        "ota": selected_ota,
+        "magisk": selected_magisk,
+        "avbroot": selected_avbroot,
+        "afsr": selected_afsr,
+        "custota": selected_custota,
+    }
 
-        import subprocess
-        if not os.access(afsr_path, os.X_OK):
-            # make it executable
-            subprocess.run(["chmod", "+x", afsr_path], check=True)
-        if not os.access(afsr_path, os.X_OK):
-            raise Exception(f"afsr is not executable: {afsr_path}")
+def downloadDependencies(releases: dict, download_dir: str = "downloads", session: requests.Session = None) -> Dependencies:
+    """Download resolved releases into download_dir and unpack the tools"""
+    os.makedirs(download_dir, exist_ok=True)
+    # one pooled session for every download, so connections to the same hosts are reused
+    if session is None:
+        session = getSession()
+
+    selected_ota = releases["ota"]
+    if not os.path.exists(os.path.join(download_dir, selected_ota.filename)):
+        # fail now rather than with a half downloaded multi-GB OTA
+        from deps.storage import checkFreeSpace, remoteSize
+        checkFreeSpace({download_dir: remoteSize(selected_ota.url, session=session)})
+    ota_path = selected_ota.download(download_dir=download_dir, overwrite=False, session=session)
+    magisk_path = releases["magisk"].download(download_dir=download_dir, overwrite=False, session=session)
+    avbroot_archive_path = releases["avbroot"].download(download_dir, overwrite=False, session=session)
+    avbroot_path = unpackTool(avbroot_archive_path, download_dir, "avbroot", "avbroot")
+    custota_archive_path = releases["custota"].download(download_dir, overwrite=False, session=session)
+    custota_path = unpackTool(custota_archive_path, download_dir, "custota", "custota-tool")
+    afsr_archive_path = releases["afsr"].download(download_dir, overwrite=False, session=session)
+    afsr_path = unpackTool(afsr_archive_path, download_dir, "afsr", "afsr")
 
     logger.info("All dependencies downloaded successfully")
     logger.info(f"OTA path: {ota_path}")
@@ -273,59 +284,228 @@ def fetchDependencies(
     return Dependencies(
         selected_ota=selected_ota,
         ota_path=ota_path,
-        selected_magisk=selected_magisk,
+        selected_magisk=releases["magisk"],
         magisk_path=magisk_path,
-        selected_avbroot=selected_avbroot,
+        selected_avbroot=releases["avbroot"],
         avbroot_path=avbroot_path,
-        selected_afsr=selected_afsr,
+        selected_afsr=releases["afsr"],
         afsr_path=afsr_path,
-        selected_custota=selected_custota,
-        custota_path=custota_path
+        selected_custota=releases["custota"],
+        custota_path=custota_path,
+        avbroot_archive_path=avbroot_archive_path,
+        afsr_archive_path=afsr_archive_path,
+        custota_archive_path=custota_archive_path,
     )
 
+def fetchDependencies(
+    download_dir: str = "downloads",
+    ota_android_version: str = None,
+    ota_build_id: str = None,
+    ota_build_branch: str = None,
+    ota_build_date: str = None,
+    ota_build_number: str = None,
+    ota_build_variant: str = None,
+    ota_carrier: str = None,
+    ota_device: str = None,
+    ota_checksum: str = None,
+    magisk_version: str = None,
+    magisk_debug: bool = False,
+    magisk_prerelease: bool = False,
+    avbroot_version: str = None,
+    avbroot_debug: bool = False,
+    avbroot_prerelease: bool = False,
+    afsr_version: str = None,
+    afsr_debug: bool = False,
+    afsr_prerelease: bool = False,
+    custota_version: str = None,
+    custota_debug: bool = False,
+    custota_prerelease: bool = False,
+    session: requests.Session = None,
+) -> Dependencies:
+    if session is None:
+        session = getSession()
+    releases = resolveDependencies(
+        ota_android_version=ota_android_version,
+        ota_build_id=ota_build_id,
+        ota_build_branch=ota_build_branch,
+        ota_build_date=ota_build_date,
+        ota_build_number=ota_build_number,
+        ota_build_variant=ota_build_variant,
+        ota_carrier=ota_carrier,
+        ota_device=ota_device,
+        ota_checksum=ota_checksum,
+        magisk_version=magisk_version,
+        magisk_debug=magisk_debug,
+        magisk_prerelease=magisk_prerelease,
+        avbroot_version=avbroot_version,
+        avbroot_debug=avbroot_debug,
+        avbroot_prerelease=avbroot_prerelease,
+        afsr_version=afsr_version,
+        afsr_debug=afsr_debug,
+        afsr_prerelease=afsr_prerelease,
+        custota_version=custota_version,
+        custota_debug=custota_debug,
+        custota_prerelease=custota_prerelease,
+        session=session,
+    )
+    return downloadDependencies(releases, download_dir=download_dir, session=session)
+
+def lockDependencies(dependencies: Dependencies, lockfile_path: str) -> str:
+    from deps.lockfile import writeLockfile
+    return writeLockfile({
+        "ota": (dependencies.selected_ota, dependencies.ota_path),
+        "magisk": (dependencies.selected_magisk, dependencies.magisk_path),
+        "avbroot": (dependencies.selected_avbroot, dependencies.avbroot_archive_path),
+        "afsr": (dependencies.selected_afsr, dependencies.afsr_archive_path),
+        "custota": (dependencies.selected_custota, dependencies.custota_archive_path),
+    }, lockfile_path)
+
+def fetchLockedDependencies(
+    lockfile_path: str,
+    download_dir: str = "downloads",
+    session: requests.Session = None,
+) -> Dependencies:
+    """Same as fetchDependencies but with every release pinned by a lockfile, no release listings are fetched"""
+    from deps.lockfile import readLockfile, fetchLocked
 
-if __name__ == "__main__":
-    KEY_AVB = "keys/avb.key"
-    PASSPHRASE_AVB = os.getenv("PASSPHRASE_AVB")
-    assert PASSPHRASE_AVB is not None, "PASSPHRASE_AVB environment variable is not set"
-    KEY_OTA = "keys/ota.key"
-    PASSPHRASE_OTA = os.getenv("PASSPHRASE_OTA")
-    assert PASSPHRASE_OTA is not None, "PASSPHRASE_OTA environment variable is not set"
-    CERT_OTA = "keys/ota.crt"
-    AVB_PK = "keys/avb_pkmd.bin"
-
-    extract_patched_ota = True
-    enable_magisk = True
-
-    dependencies = fetchDependencies(
-        # ota_android_version="15.0.0",
-        ota_device="lynx", # Pixel 7a
-        ota_carrier="", # global
-        magisk_version="29.0",
-        avbroot_version="3.22.0",
-        afsr_version="1.0.3",
-        custota_version="5.17",
+    os.makedirs(download_dir, exist_ok=True)
+    locked = readLockfile(lockfile_path)
+    logger.info(f"Using pinned dependencies from {lockfile_path}")
 
+    ota_path = fetchLocked(locked["ota"], download_dir, session=session)
+    magisk_path = fetchLocked(locked["magisk"], download_dir, session=session)
+    avbroot_archive_path = fetchLocked(locked["avbroot"], download_dir, session=session)
+    afsr_archive_path = fetchLocked(locked["afsr"], download_dir, session=session)
+    custota_archive_path = fetchLocked(locked["custota"], download_dir, session=session)
+
+    return Dependencies(
+        selected_ota=locked["ota"].release,
+        ota_path=ota_path,
+        selected_magisk=locked["magisk"].release,
+        magisk_path=magisk_path,
+        selected_avbroot=locked["avbroot"].release,
+        avbroot_path=unpackTool(avbroot_archive_path, download_dir, "avbroot", "avbroot"),
+        selected_afsr=locked["afsr"].release,
+        afsr_path=unpackTool(afsr_archive_path, download_dir, "afsr", "afsr"),
+        selected_custota=locked["custota"].release,
+        custota_path=unpackTool(custota_archive_path, download_dir, "custota", "custota-tool"),
+        avbroot_archive_path=avbroot_archive_path,
+        afsr_archive_path=afsr_archive_path,
+        custota_archive_path=custota_archive_path,
     )
 
-    patched_dir = "patched"
+
+KEY_AVB = "keys/avb.key"
+KEY_OTA = "keys/ota.key"
+CERT_OTA = "keys/ota.crt"
+AVB_PK = "keys/avb_pkmd.bin"
+
+@dataclass
+class BuildConfig:
+    enable_magisk: bool = True
+    extract_patched_ota: bool = True
+    package_extracted_ota: bool = True
+    android_sparse_images: bool = False # fastboot accepts them and skips empty blocks, but not every image needs it
+    patched_dir: str = "patched"
+    ota_dir: str = "ota"
+    # concurrent builds share the download cache, so eviction is left to whoever runs them
+    collect_garbage: bool = True
+    # set for multi-variant builds, the update info and release info get the variant in their name
+    variant: str | None = None
+    # write the update info in process instead of running custota-tool gen-update-info
+    native_update_info: bool = True
+    # None keeps the extracted images in <patched_dir>/extracted
+    extracted_dir: str | None = None
+    check_free_space: bool = True
+    # leave writing the native update info to the caller, which does it for several builds in one generateBatch
+    batch_update_info: bool = False
+    # the artifact index, module verification cache and stage history live next to the downloads
+    download_dir: str = "downloads"
+
+    @classmethod
+    def fromStorage(cls, storage, **kwargs) -> "BuildConfig":
+        """Build config with its directories taken from a deps.storage.StorageConfig"""
+        return cls(
+            download_dir=storage.download_dir,
+            patched_dir=storage.scratch_dir,
+            extracted_dir=storage.extract_dir,
+            ota_dir=storage.publish_dir,
+            **kwargs,
+        )
+
+@dataclass
+class BuildResult:
+    output_path: str
+    ota_path: str
+    csig_path: str
+    update_info_path: str
+    release_info_path: str
+    extracted_dir: str | None
+    package_path: str | None
+    modules_manifest_path: str | None
+    # the update info and release info to write, already written unless batch_update_info was set
+    published: PublishedOTA
+
+def signingHelper():
+    """Signing helper for the AVB and OTA keys, decrypts them once for every build in its with block"""
+    from deps.signing import SigningHelper
+    return SigningHelper({"avb": (KEY_AVB, "PASSPHRASE_AVB"), "ota": (KEY_OTA, "PASSPHRASE_OTA")})
+
+def buildOTA(dependencies: Dependencies, config: BuildConfig = None, artifact_index = None, recorder: StageRecorder = None, signer = None) -> BuildResult:
+    """Patch, extract and publish an OTA
+
+    The tools sign through signer (a started deps.signing.SigningHelper) if given, otherwise they decrypt the keys
+    themselves with the passphrases from PASSPHRASE_AVB and PASSPHRASE_OTA.
+    """
+    if config is None:
+        config = BuildConfig()
+    if recorder is None:
+        recorder = StageRecorder()
+    if signer is None:
+        assert os.getenv("PASSPHRASE_AVB") is not None, "PASSPHRASE_AVB environment variable is not set"
+        assert os.getenv("PASSPHRASE_OTA") is not None, "PASSPHRASE_OTA environment variable is not set"
+    from contextlib import nullcontext
+
+    patched_dir = config.patched_dir
     os.makedirs(patched_dir, exist_ok=True)
+    ota_dir = config.ota_dir
+    os.makedirs(ota_dir, exist_ok=True)
+    extracted_dir = config.extracted_dir if config.extracted_dir is not None else os.path.join(patched_dir, "extracted")
+
+    ota_size = os.path.getsize(dependencies.ota_path)
+    if config.check_free_space:
+        from deps.storage import checkFreeSpace, buildSpace
+        checkFreeSpace(buildSpace(
+            ota_size,
+            patched_dir,
+            extracted_dir if config.extract_patched_ota else None,
+            ota_dir,
+            package=config.package_extracted_ota,
+        ))
 
-    os.environ["PASSPHRASE_AVB"] = PASSPHRASE_AVB
-    os.environ["PASSPHRASE_OTA"] = PASSPHRASE_OTA
     command = [
         dependencies.avbroot_path,
         "ota",
         "patch",
         "--input", dependencies.ota_path,
-        "--key-avb", KEY_AVB,
-        "--pass-avb-env-var", "PASSPHRASE_AVB",
-        "--key-ota", KEY_OTA,
-        "--pass-ota-env-var", "PASSPHRASE_OTA",
         "--cert-ota", CERT_OTA,
         ]
+    if signer is None:
+        command.extend([
+            "--key-avb", KEY_AVB,
+            "--pass-avb-env-var", "PASSPHRASE_AVB",
+            "--key-ota", KEY_OTA,
+            "--pass-ota-env-var", "PASSPHRASE_OTA",
+        ])
+    else:
+        # with a signing helper the tools only get the public keys
+        command.extend([
+            "--key-avb", signer.publicKeyPath("avb"),
+            "--key-ota", signer.publicKeyPath("ota"),
+            "--signing-helper", signer.client_path,
+        ])
     
-    if enable_magisk:
+    if config.enable_magisk:
         from deps.magisk import preinit_device_map
         preinit_partition = preinit_device_map.get(dependencies.selected_ota.device)
         assert preinit_partition is not None, f"Device {dependencies.selected_ota.device} is not supported for Magisk preinit"
@@ -342,7 +522,7 @@ if __name__ == "__main__":
 
     output_filename = f"{os.path.splitext(os.path.basename(dependencies.ota_path))[0]}"
 
-    if enable_magisk:
+    if config.enable_magisk:
         output_filename += f"-magisk-{dependencies.selected_magisk.tag_name}.zip"
     else:
         output_filename += f"-rootless.zip"
@@ -357,15 +537,17 @@ if __name__ == "__main__":
     ### DEBUG
     # command = ["python3", "-c", "import os; print(os.environ)"]
 
-    logger.info(f"Running command: {' '.join(command)}")
-    subprocess.run(command, check=True)
-    shutil.copyfile(AVB_PK, os.path.join(patched_dir, "avb_pkmd.bin"))
+    with recorder.stage("patch"), (nullcontext() if signer is None else signer.authorized()) as tool_env:
+        logger.info(f"Running command: {' '.join(command)}")
+        subprocess.run(command, check=True, env=tool_env)
+        shutil.copyfile(AVB_PK, os.path.join(patched_dir, "avb_pkmd.bin"))
 
     logger.info(f"Patched OTA created at {output_path}")
 
-    if extract_patched_ota:
-
-        extracted_dir = os.path.join(patched_dir, "extracted")
+    package_path = None
+    if not config.extract_patched_ota:
+        extracted_dir = None
+    else:
         command = [
             dependencies.avbroot_path,
             "ota",
@@ -376,9 +558,25 @@ if __name__ == "__main__":
             "--all"
         ]
 
-        logger.info(f"Extracting patched OTA with command: {' '.join(command)}")
-        subprocess.run(command, check=True)
-        logger.info(f"Patched OTA extracted to {extracted_dir}")
+        with recorder.stage("extract"):
+            logger.info(f"Extracting patched OTA with command: {' '.join(command)}")
+            subprocess.run(command, check=True)
+            logger.info(f"Patched OTA extracted to {extracted_dir}")
+
+        # most partition images are largely zeros, don't keep those on disk
+        from deps.sparse import sparsifyTree, convertTreeToAndroidSparse
+        with recorder.stage("sparsify"):
+            sparsifyTree(extracted_dir)
+            if config.android_sparse_images:
+                convertTreeToAndroidSparse(extracted_dir)
+
+        if config.package_extracted_ota:
+            # much smaller and faster to move around than the raw images, unpacks straight to sparse files
+            from deps.archive import packImages
+            package_path = os.path.join(patched_dir, f"{os.path.splitext(output_filename)[0]}-fastboot.zpack")
+            with recorder.stage("package"):
+                packImages(extracted_dir, package_path)
+            logger.info(f"Extracted images packaged at {package_path}, unpack with: python3 -m deps.archive unpack {package_path} <directory>")
 
         # the commands needed to install the extracted files via fastboot
         logger.info(f"""To install the extracted files via fastboot, use the following commands:
@@ -390,50 +588,381 @@ fastboot flash avb_custom_key {os.path.join(patched_dir, 'avb_pkmd.bin')}
 fastboot flashing lock
 """)
 
-        logger.info("Since I didn't want to add modules to the ota updates, please install the modules manually")
+    # bundle the modules so they can be installed after flashing, they all need root
+    modules_dir = None
+    manifest_path = None
+    if config.enable_magisk:
+        from deps.modules import bundleModules, verification_cache_filename
+        modules_dir = os.path.join(patched_dir, "modules")
+        with recorder.stage("modules"):
+            manifest_path = bundleModules(modules_dir, cache_path=os.path.join(config.download_dir, verification_cache_filename))
+        logger.info(f"""Modules are not part of the OTA, install them after flashing (manifest: {manifest_path}):
+adb push {modules_dir} /sdcard/Download/modules
+adb shell su -c 'for m in /sdcard/Download/modules/*.zip; do magisk --install-module "$m"; done'
+adb install {os.path.join(modules_dir, '<lsposed module>.apk')}
+""")
+    else:
+        logger.info("Skipping the module bundle, rootless builds can't install modules")
     
 
     # make an ota
-    ota_dir = "ota"
-    os.makedirs(ota_dir, exist_ok=True)
-    # move the patched ota to ota directory
+    # copy the patched ota to ota directory, possibly on another volume, clients never see a partial file
     ota_path = os.path.join(ota_dir, os.path.basename(output_path))
-    shutil.copyfile(output_path, ota_path)
+    from deps.storage import stageFile
+    with recorder.stage("publish"):
+        stageFile(output_path, ota_path)
 
     # prepare custota signature
     command = [
         dependencies.custota_path,
         "gen-csig",
         "--input", ota_path,
-        "--key", KEY_OTA,
         "--cert", CERT_OTA,
-        "--passphrase-env-var", "PASSPHRASE_OTA",
     ]
+    if signer is None:
+        command.extend(["--key", KEY_OTA, "--passphrase-env-var", "PASSPHRASE_OTA"])
+    else:
+        command.extend(["--key", signer.publicKeyPath("ota"), "--signing-helper", signer.client_path])
 
-    logger.info(f"Generating Custota signature with command: {' '.join(command)}")
-    subprocess.run(command, check=True)
-    logger.info(f"Custota signature generated at {output_path}.csig")
+    with recorder.stage("gen-csig"), (nullcontext() if signer is None else signer.authorized()) as tool_env:
+        logger.info(f"Generating Custota signature with command: {' '.join(command)}")
+        subprocess.run(command, check=True, env=tool_env)
+    logger.info(f"Custota signature generated at {ota_path}.csig")
 
     # making update info
-    command = [
-        dependencies.custota_path,
-        "gen-update-info",
-        "--file", os.path.join(ota_dir, f"{dependencies.selected_ota.device}.json"),
-        "--location", ota_path,
-        # "--csig-location", ota_path + ".csig",
-    ]
-    logger.info(f"Generating Custota update info with command: {' '.join(command)}")
-    subprocess.run(command, check=True)
-    logger.info(f"Custota update info generated at {os.path.join(ota_dir, f'{dependencies.selected_ota.device}.json')}")
-    with open(os.path.join(ota_dir, f"release_info"), 'w') as f:
-        f.write(f"device={dependencies.selected_ota.device}\n")
-        f.write(f"android_version={dependencies.selected_ota.android_version}\n")
-        f.write(f"build_id={dependencies.selected_ota.build_id}\n")
-        f.write(f"build_branch={dependencies.selected_ota.build_branch}\n")
-        f.write(f"build_date={dependencies.selected_ota.build_date}\n")
-        f.write(f"build_number={dependencies.selected_ota.build_number}\n")
-        f.write(f"build_variant={dependencies.selected_ota.build_variant}\n")
-        f.write(f"ota={os.path.basename(ota_path)}\n")
-        f.write(f"magisk_enabled={enable_magisk}\n")
-    logger.info(f"Release info written to {os.path.join(ota_dir, 'release_info')}")
+    update_info_name = dependencies.selected_ota.device if config.variant is None else f"{dependencies.selected_ota.device}-{config.variant}"
+    update_info_path = os.path.join(ota_dir, f"{update_info_name}.json")
+    release_info_path = os.path.join(ota_dir, f"release_info-{update_info_name}")
+    release_fields = {
+        "device": dependencies.selected_ota.device,
+        "android_version": dependencies.selected_ota.android_version,
+        "build_id": dependencies.selected_ota.build_id,
+        "build_branch": dependencies.selected_ota.build_branch,
+        "build_date": dependencies.selected_ota.build_date,
+        "build_number": dependencies.selected_ota.build_number,
+        "build_variant": dependencies.selected_ota.build_variant,
+        "ota": os.path.basename(ota_path),
+        "magisk_enabled": config.enable_magisk,
+    }
+    if config.variant is not None:
+        release_fields["variant"] = config.variant
+    from deps.update_info import generateBatch, metadataReleaseInfo, readOtaMetadata, writeReleaseInfo
+    published = PublishedOTA(
+        ota_path=ota_path,
+        update_info_path=update_info_path,
+        release_info_path=release_info_path,
+        location=ota_path,
+        release_fields=release_fields,
+    )
+    with recorder.stage("gen-update-info"):
+        if config.native_update_info:
+            if not config.batch_update_info:
+                generateBatch([published])
+        else:
+            command = [
+                dependencies.custota_path,
+                "gen-update-info",
+                "--file", update_info_path,
+                "--location", ota_path,
+                # "--csig-location", ota_path + ".csig",
+            ]
+            logger.info(f"Generating Custota update info with command: {' '.join(command)}")
+            subprocess.run(command, check=True)
+            writeReleaseInfo(release_info_path, {**release_fields, **metadataReleaseInfo(readOtaMetadata(ota_path))})
+        if config.variant is None:
+            # the release workflow reads ota/release_info
+            shutil.copyfile(release_info_path, os.path.join(ota_dir, "release_info"))
+    if not (config.native_update_info and config.batch_update_info):
+        logger.info(f"Custota update info generated at {update_info_path}, release info written to {release_info_path}")
+
+
+    # keep downloads and build outputs within their size budgets, this release's artifacts stay pinned
+    from deps.eviction import ArtifactIndex, collectGarbage, index_filename, tierBudgets
+    from deps.merkle import sidecarPath
+    if artifact_index is None:
+        artifact_index = ArtifactIndex(os.path.join(config.download_dir, index_filename))
+    # keyed by where the OTA was published, so builds of the same OTA into other directories keep their own pins
+    artifact_index.recordRelease(os.path.abspath(ota_path), [
+        dependencies.ota_path,
+        sidecarPath(dependencies.ota_path),
+        dependencies.magisk_path,
+        dependencies.avbroot_archive_path,
+        os.path.dirname(dependencies.avbroot_path),
+        dependencies.custota_archive_path,
+        os.path.dirname(dependencies.custota_path),
+        dependencies.afsr_archive_path,
+        os.path.dirname(dependencies.afsr_path),
+        output_path,
+        extracted_dir,
+        package_path,
+        modules_dir,
+        os.path.join(patched_dir, "avb_pkmd.bin"),
+        ota_path,
+        ota_path + ".csig",
+        update_info_path,
+        release_info_path,
+        os.path.join(ota_dir, "release_info") if config.variant is None else None,
+    ])
+    with recorder.stage("gc"):
+        if config.collect_garbage:
+            budgets = tierBudgets(
+                config.download_dir,
+                patched_dir,
+                config.extracted_dir if config.extracted_dir is not None else os.path.join(patched_dir, "extracted"),
+                ota_dir,
+            )
+            collectGarbage(budgets=budgets, index=artifact_index)
+        else:
+            artifact_index.save()
+
+    # the planner estimates future builds from these
+    from deps.stages import recordHistory, history_filename
+    recordHistory(os.path.join(config.download_dir, history_filename), recorder.records, ota_size)
+
+    logger.info(f"Build finished in {recorder.total():.1f}s: " + ", ".join(f"{r.name} {r.seconds:.1f}s" for r in recorder.records))
+
+    return BuildResult(
+        output_path=output_path,
+        ota_path=ota_path,
+        csig_path=ota_path + ".csig",
+        update_info_path=update_info_path,
+        release_info_path=release_info_path,
+        extracted_dir=extracted_dir,
+        package_path=package_path,
+        modules_manifest_path=manifest_path,
+        published=published,
+    )
+
+@dataclass
+class Variant:
+    name: str
+    enable_magisk: bool
+    magisk_version: str | None = None
+    magisk_prerelease: bool = False
+
+def parseVariant(spec: str) -> Variant:
+    """Parse rootless, magisk, magisk:<version> or magisk:<version>:prerelease"""
+    parts = spec.split(":")
+    if parts == ["rootless"]:
+        return Variant(name="rootless", enable_magisk=False)
+    assert parts[0] == "magisk" and len(parts) <= 3, f"Unknown variant {spec}, expected rootless, magisk, magisk:<version> or magisk:<version>:prerelease"
+    if len(parts) == 1:
+        return Variant(name="magisk", enable_magisk=True)
+    prerelease = len(parts) == 3
+    assert not prerelease or parts[2] == "prerelease", f"Unknown variant option {parts[2]} in {spec}"
+    return Variant(
+        name=f"magisk-{parts[1].removeprefix('v')}" + ("-prerelease" if prerelease else ""),
+        enable_magisk=True,
+        magisk_version=parts[1],
+        magisk_prerelease=prerelease,
+    )
+
+def resolveVariantMagisk(selected_magisk: MagiskRelease, variants: list[Variant], session: requests.Session = None) -> dict[str, MagiskRelease]:
+    """The Magisk release of every variant that needs one other than selected_magisk, by variant name
+
+    Nothing is downloaded, the release listing is fetched once and only if a variant asks for another version.
+    """
+    magisk_releases = None
+    variant_magisk = {}
+    for variant in variants:
+        wanted = variant.magisk_version
+        if not variant.enable_magisk or wanted is None or selected_magisk.tag_name in (wanted, f"v{wanted}"):
+            continue
+        if magisk_releases is None:
+            magisk_releases = fetchMagiskReleases(session=session)
+        variant_magisk[variant.name] = selectMagisk(magisk_releases, wanted, False, variant.magisk_prerelease)
+        logger.info(f"Selected Magisk {variant_magisk[variant.name].tag_name} for variant {variant.name}")
+    return variant_magisk
+
+def buildVariants(
+    dependencies: Dependencies,
+    variants: list[Variant],
+    config: BuildConfig = None,
+    session: requests.Session = None,
+    max_workers: int = None,
+    signer = None,
+) -> dict[str, BuildResult]:
+    """Build several variants from the one already downloaded and verified OTA, concurrently
+
+    Variants without a Magisk version use the Magisk release in dependencies, others are resolved
+    from a single release listing. Every variant is published as <device>-<variant>.json. The first variant is the
+    default, it's also published as the plain <device>.json existing Custota clients poll and ota/release_info.
+    """
+    if config is None:
+        config = BuildConfig()
+    assert len({v.name for v in variants}) == len(variants), f"Duplicate variants in {[v.name for v in variants]}"
+    from concurrent.futures import ThreadPoolExecutor
+    from dataclasses import replace
+    from deps.eviction import ArtifactIndex, collectGarbage, default_keep_releases, index_filename, tierBudgets
+
+    download_dir = config.download_dir
+    variant_magisk = resolveVariantMagisk(dependencies.selected_magisk, variants, session=session)
+    variant_dependencies = {}
+    for variant in variants:
+        if variant.name not in variant_magisk:
+            variant_dependencies[variant.name] = dependencies
+            continue
+        selected_magisk = variant_magisk[variant.name]
+        magisk_path = selected_magisk.download(download_dir=download_dir, overwrite=False, session=session)
+        variant_dependencies[variant.name] = replace(dependencies, selected_magisk=selected_magisk, magisk_path=magisk_path)
+
+    # the patched OTA is named after the Magisk release, two variants with the same release would overwrite each other
+    outputs = [(v.enable_magisk, variant_dependencies[v.name].selected_magisk.tag_name if v.enable_magisk else None) for v in variants]
+    assert len(set(outputs)) == len(outputs), f"Variants {[v.name for v in variants]} resolve to the same build"
+
+    # every variant reads the same input OTA, only the outputs are separate
+    variant_configs = {
+        variant.name: replace(
+            config,
+            enable_magisk=variant.enable_magisk,
+            patched_dir=os.path.join(config.patched_dir, variant.name),
+            extracted_dir=os.path.join(config.extracted_dir, variant.name) if config.extracted_dir is not None else None,
+            variant=variant.name,
+            collect_garbage=False,
+            batch_update_info=True,
+            check_free_space=False,
+        )
+        for variant in variants
+    }
+    # the variants run at the same time, so their space is checked once, added up, instead of each against the same free space
+    if config.check_free_space:
+        from deps.storage import checkFreeSpace, buildSpace
+        ota_size = os.path.getsize(dependencies.ota_path)
+        required = {}
+        for variant_config in variant_configs.values():
+            extracted_dir = variant_config.extracted_dir if variant_config.extracted_dir is not None else os.path.join(variant_config.patched_dir, "extracted")
+            for path, size in buildSpace(
+                ota_size,
+                variant_config.patched_dir,
+                extracted_dir if variant_config.extract_patched_ota else None,
+                variant_config.ota_dir,
+                package=variant_config.package_extracted_ota,
+            ).items():
+                required[path] = required.get(path, 0) + size
+        checkFreeSpace(required)
+
+    artifact_index = ArtifactIndex(os.path.join(download_dir, index_filename))
+    if max_workers is None:
+        max_workers = len(variants)
+    logger.info(f"Building variants {', '.join(v.name for v in variants)} from {dependencies.ota_path}")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            variant.name: pool.submit(buildOTA, variant_dependencies[variant.name], variant_configs[variant.name], artifact_index, signer=signer)
+            for variant in variants
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    # the update info of every variant in one pass, custota-tool already wrote it otherwise
+    if config.native_update_info:
+        from deps.update_info import generateBatch
+        generateBatch([result.published for result in results.values()])
+
+    # existing clients poll <device>.json and the release workflow reads ota/release_info, both get the default variant
+    from deps.storage import stageFile
+    default = results[variants[0].name]
+    default_update_info_path = os.path.join(config.ota_dir, f"{dependencies.selected_ota.device}.json")
+    default_release_info_path = os.path.join(config.ota_dir, "release_info")
+    stageFile(default.update_info_path, default_update_info_path)
+    stageFile(default.release_info_path, default_release_info_path)
+    artifact_index.extendRelease(os.path.abspath(default.ota_path), [default_update_info_path, default_release_info_path])
+    logger.info(f"Variant {variants[0].name} is the default, published as {default_update_info_path}")
+
+    # every variant is recorded as its own release, keep all of them pinned
+    if config.collect_garbage:
+        budgets = tierBudgets(
+            download_dir,
+            config.patched_dir,
+            config.extracted_dir,
+            config.ota_dir,
+        )
+        collectGarbage(budgets=budgets, index=artifact_index, keep_releases=default_keep_releases * len(variants))
+    else:
+        artifact_index.save()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Patch a Pixel OTA with avbroot and publish it for Custota")
+    parser.add_argument("--lock", metavar="LOCKFILE", help="resolve and download all dependencies, pin them in LOCKFILE and exit")
+    parser.add_argument("--lockfile", help="build from the dependencies pinned in LOCKFILE without fetching any release listings")
+    parser.add_argument("--variant", action="append", default=[], help="build this variant from the same OTA, repeatable, the first one is published as the default: rootless, magisk, magisk:<version> or magisk:<version>:prerelease")
+    parser.add_argument("--signing-helper", action="store_true", help="decrypt the keys once in a locked memory helper process instead of in every tool")
+    parser.add_argument("--plan", action="store_true", help="print the download, disk and time estimates of the build as JSON and exit without building, exits 1 if it won't fit on disk")
+    parser.add_argument("--download-dir", help="download cache, overrides PIXEL_OTA_DOWNLOAD_DIR (default downloads)")
+    parser.add_argument("--scratch-dir", help="patch scratch space, overrides PIXEL_OTA_SCRATCH_DIR (default patched)")
+    parser.add_argument("--extract-dir", help="extracted images, overrides PIXEL_OTA_EXTRACT_DIR (default <scratch-dir>/extracted)")
+    parser.add_argument("--publish-dir", help="published OTA and update info, overrides PIXEL_OTA_PUBLISH_DIR (default ota)")
+    args = parser.parse_args()
+
+    from deps.storage import StorageConfig
+    storage = StorageConfig.fromEnv(
+        download_dir=args.download_dir,
+        scratch_dir=args.scratch_dir,
+        extract_dir=args.extract_dir,
+        publish_dir=args.publish_dir,
+    )
+    storage.log()
 
+    dependency_criteria = dict(
+        # ota_android_version="15.0.0",
+        ota_device="lynx", # Pixel 7a
+        ota_carrier="", # global
+        magisk_version="29.0",
+        avbroot_version="3.22.0",
+        afsr_version="1.0.3",
+        custota_version="5.17",
+    )
+
+    if args.lock is not None:
+        # resolving doesn't need the signing keys
+        lockDependencies(fetchDependencies(download_dir=storage.download_dir, **dependency_criteria), args.lock)
+        sys.exit(0)
+
+    config = BuildConfig.fromStorage(
+        storage,
+        extract_patched_ota=True,
+        package_extracted_ota=True,
+        android_sparse_images=False,
+        enable_magisk=True,
+    )
+    variants = [parseVariant(spec) for spec in args.variant]
+
+    if args.plan:
+        # dry run, nothing is downloaded or built and no keys are needed
+        import json
+        from deps.planner import planBuild
+        if args.lockfile is not None:
+            from deps.lockfile import readLockfile
+            releases = {name: locked.release for name, locked in readLockfile(args.lockfile).items()}
+        else:
+            releases = resolveDependencies(**dependency_criteria)
+        plan = planBuild(
+            releases,
+            storage,
+            variants=[variant.name for variant in variants],
+            variant_magisk=resolveVariantMagisk(releases["magisk"], variants),
+            extract=config.extract_patched_ota,
+            package=config.package_extracted_ota,
+            modules=config.enable_magisk or any(variant.enable_magisk for variant in variants),
+        )
+        print(json.dumps(plan.toDict(), indent=2))
+        sys.exit(0 if plan.fits else 1)
+
+    assert os.getenv("PASSPHRASE_AVB") is not None, "PASSPHRASE_AVB environment variable is not set"
+    assert os.getenv("PASSPHRASE_OTA") is not None, "PASSPHRASE_OTA environment variable is not set"
+
+    if args.lockfile is not None:
+        dependencies = fetchLockedDependencies(args.lockfile, download_dir=storage.download_dir)
+    else:
+        dependencies = fetchDependencies(download_dir=storage.download_dir, **dependency_criteria)
+
+    from contextlib import nullcontext
+    with (signingHelper() if args.signing_helper else nullcontext()) as signer:
+        if signer is not None:
+            # extract, verification and custota-tool runs don't go through childEnv, they must not inherit the passphrases either
+            signer.dropPassphrases()
+        if args.variant:
+            buildVariants(dependencies, variants, config, signer=signer)
+        else:
+            buildOTA(dependencies, config, signer=signer)
@@ -0,0 +1,416 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import shutil
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from main import resolveDependencies, downloadDependencies, buildOTA, BuildConfig, BuildResult, signingHelper
+from deps.eviction import ArtifactIndex, collectGarbage, default_budgets, index_filename, parseSize
+from deps.planner import BuildPlan, planBuild
+from deps.storage import StorageConfig, default_reserve, freeSpace
+from deps.transport import setListingCacheTTL
+
+@dataclass
+class BuildRequest:
+    device: str
+    carrier: str = ""
+    root: str = "magisk" # "magisk" or "rootless"
+    magisk_version: str = "29.0"
+    avbroot_version: str = "3.22.0"
+    afsr_version: str = "1.0.3"
+    custota_version: str = "5.17"
+    extract: bool = True
+
+    def __post_init__(self):
+        assert self.root in ("magisk", "rootless"), f"Unknown root mode {self.root}, expected magisk or rootless"
+
+    @property
+    def key(self) -> str:
+        """Identical requests have identical keys, so they can share one build"""
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()
+
+@dataclass
+class Job:
+    id: str
+    request: BuildRequest
+    work_dir: str
+    status: str = "planning" # planning, queued, running, succeeded or failed
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    error: str | None = None
+    result: BuildResult | None = None
+    # resolved on submit, the build downloads exactly what was planned
+    releases: dict | None = None
+    plan: BuildPlan | None = None
+
+    def artifacts(self) -> dict[str, str]:
+        if self.result is None:
+            return {}
+        files = {
+            "ota": self.result.ota_path,
+            "csig": self.result.csig_path,
+            "update_info": self.result.update_info_path,
+            "release_info": self.result.release_info_path,
+            "package": self.result.package_path,
+            "modules_manifest": self.result.modules_manifest_path,
+        }
+        return {name: path for name, path in files.items() if path is not None and os.path.isfile(path)}
+
+    def toDict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "request": asdict(self.request),
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "artifacts": {name: f"/builds/{self.id}/artifacts/{name}" for name in self.artifacts()},
+            "plan": None if self.plan is None else {
+                "estimated_seconds": self.plan.estimated_seconds,
+                "download_bytes": self.plan.download_bytes,
+                "disk_bytes": sum(self.plan.disk.values()),
+                "fits": self.plan.fits,
+            },
+        }
+
+class BuildService:
+    """Queue of OTA builds run on a bounded worker pool inside one warm process
+
+    Release listings, the HTTP session and the download cache are shared between builds.
+    Identical requests that are still queued or running are merged into one job.
+    Every job is planned when it's submitted. Workers take the longest queued build whose disk needs fit next to the
+    running ones, so long builds don't end up last and builds never race each other for the same free space.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        builds_dir: str = "builds",
+        listing_cache_ttl: float = 600,
+        builds_budget: int = 30 * 1024**3,
+        download_dir: str = None,
+        signer = None,
+        finished_job_ttl: float = 24 * 3600,
+        max_finished_jobs: int = 1000,
+    ):
+        self.builds_dir = builds_dir
+        # finished jobs are forgotten after a while, their outputs are left to the builds budget
+        self.finished_job_ttl = finished_job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        # a started deps.signing.SigningHelper shared by every build, so the keys are decrypted only once
+        self.signer = signer
+        if download_dir is None:
+            download_dir = StorageConfig.fromEnv().download_dir
+        self.download_dir = download_dir
+        # planning only fetches listings and sizes, one at a time keeps it off the origins' rate limits
+        self._planner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plan")
+        self.jobs: dict[str, Job] = {}
+        self.in_flight: dict[str, str] = {}
+        self.running = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._queue: list[Job] = []
+        # bytes the running builds are still going to write, by volume
+        self._reserved: dict[int, int] = {}
+        self._stopping = False
+        # no build may start while the caches are being evicted
+        self._collecting = False
+        # downloading and unpacking write to the shared downloads directory, so only one build resolves at a time
+        self._resolve_lock = threading.Lock()
+        self.index = ArtifactIndex(os.path.join(download_dir, index_filename))
+        # the service only writes to these two, the CLI's scratch and publish directories are none of its business
+        self.budgets = {
+            download_dir: default_budgets["downloads"],
+            builds_dir: builds_budget,
+        }
+        setListingCacheTTL(listing_cache_ttl)
+        self._workers = [threading.Thread(target=self._work, name=f"build_{i}", daemon=True) for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        logger.info(f"Build service started with {workers} workers")
+
+    def submit(self, request: BuildRequest) -> tuple[Job, bool]:
+        """Queue a build, returns the job and whether it was merged into an identical in-flight one"""
+        with self._lock:
+            self._pruneJobs()
+            job_id = self.in_flight.get(request.key)
+            if job_id is not None:
+                logger.info(f"Request for {request.device} is already in flight as job {job_id}")
+                return self.jobs[job_id], True
+            job_id = uuid.uuid4().hex[:12]
+            job = Job(id=job_id, request=request, work_dir=os.path.join(self.builds_dir, job_id))
+            self.jobs[job_id] = job
+            self.in_flight[request.key] = job_id
+        self._planner.submit(self._plan, job)
+        logger.info(f"Planning job {job.id} for {request.device} ({request.root})")
+        return job, False
+
+    def _pruneJobs(self):
+        """Forget finished jobs that expired, and the oldest ones beyond max_finished_jobs, called with the lock held"""
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values() if job.finished is not None), key=lambda job: job.finished)
+        expired = [job for job in finished if now - job.finished > self.finished_job_ttl]
+        expired += finished[len(expired):max(len(expired), len(finished) - self.max_finished_jobs)]
+        for job in expired:
+            del self.jobs[job.id]
+        if expired:
+            logger.debug(f"Forgot {len(expired)} finished jobs")
+
+    def _plan(self, job: Job):
+        request = job.request
+        try:
+            releases = resolveDependencies(
+                ota_device=request.device,
+                ota_carrier=request.carrier,
+                magisk_version=request.magisk_version,
+                avbroot_version=request.avbroot_version,
+                afsr_version=request.afsr_version,
+                custota_version=request.custota_version,
+            )
+            storage = StorageConfig(
+                download_dir=self.download_dir,
+                scratch_dir=os.path.join(job.work_dir, "patched"),
+                publish_dir=os.path.join(job.work_dir, "ota"),
+            )
+            plan = planBuild(releases, storage, extract=request.extract, modules=request.root == "magisk")
+        except Exception as e:
+            with self._lock:
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = "failed"
+                job.finished = time.time()
+                self.in_flight.pop(request.key, None)
+            logger.error(f"Planning job {job.id} failed: {job.error}\n{traceback.format_exc()}")
+            return
+        with self._changed:
+            job.releases = releases
+            job.plan = plan
+            job.status = "queued"
+            self._queue.append(job)
+            self._changed.notify()
+        logger.info(f"Queued job {job.id}, estimated {job.plan.estimated_seconds / 60:.1f} minutes")
+
+    def _fits(self, plan: BuildPlan) -> bool:
+        for volume in plan.volumes:
+            if volume.required + self._reserved.get(volume.device, 0) + default_reserve > freeSpace(volume.paths[0]):
+                return False
+        return True
+
+    def _next(self) -> Job | None:
+        """Longest queued job that fits on disk next to the running ones, called with the lock held"""
+        if self._collecting:
+            return None
+        queue = sorted(self._queue, key=lambda job: job.plan.estimated_seconds, reverse=True)
+        for job in queue:
+            if self._fits(job.plan):
+                return job
+        # a build that doesn't fit even on idle disks gets to try anyway, its own free space check has the last word
+        if queue and self.running == 0:
+            return queue[0]
+        return None
+
+    def _work(self):
+        while True:
+            with self._changed:
+                job = self._next()
+                while job is None:
+                    if self._stopping and not self._queue:
+                        return
+                    # space freed outside of the service only shows up on the next poll
+                    self._changed.wait(timeout=30)
+                    job = self._next()
+                # taken off the queue, reserved and counted as running in one go, so no other worker can see the
+                # disks as idle in between and start a second build that doesn't fit
+                self._queue.remove(job)
+                reservation = job.plan.diskByVolume()
+                for device, size in reservation.items():
+                    self._reserved[device] = self._reserved.get(device, 0) + size
+                job.status = "running"
+                job.started = time.time()
+                self.running += 1
+            try:
+                self._run(job)
+            finally:
+                with self._changed:
+                    for device, size in reservation.items():
+                        self._reserved[device] -= size
+                    self.running -= 1
+                    # decided under the same lock that starts builds, and _next holds every build back until it's done
+                    collect = self.running == 0 and not self._collecting
+                    self._collecting = collect
+                    self._changed.notify_all()
+                if collect:
+                    self._collectGarbage()
+
+    def _collectGarbage(self):
+        """Evict from the caches while no build is running, the caller has set _collecting"""
+        try:
+            collectGarbage(budgets=self.budgets, index=self.index)
+        except Exception as e:
+            logger.error(f"Garbage collection failed: {type(e).__name__}: {e}")
+        finally:
+            with self._changed:
+                self._collecting = False
+                self._changed.notify_all()
+
+    def _run(self, job: Job):
+        request = job.request
+        try:
+            with self._resolve_lock:
+                dependencies = downloadDependencies(job.releases, download_dir=self.download_dir)
+            config = BuildConfig(
+                download_dir=self.download_dir,
+                enable_magisk=request.root == "magisk",
+                extract_patched_ota=request.extract,
+                patched_dir=os.path.join(job.work_dir, "patched"),
+                ota_dir=os.path.join(job.work_dir, "ota"),
+                collect_garbage=False,
+            )
+            result = buildOTA(dependencies, config, artifact_index=self.index, signer=self.signer)
+            with self._lock:
+                job.result = result
+                job.status = "succeeded"
+            logger.info(f"Job {job.id} succeeded")
+        except Exception as e:
+            with self._lock:
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = "failed"
+            logger.error(f"Job {job.id} failed: {job.error}\n{traceback.format_exc()}")
+        finally:
+            with self._lock:
+                job.finished = time.time()
+                self.in_flight.pop(request.key, None)
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def describe(self, job: Job) -> dict:
+        """job.toDict() taken under the lock, so the status, result and error are from the same moment"""
+        with self._lock:
+            return job.toDict()
+
+    def shutdown(self):
+        """Wait for every submitted job to finish"""
+        self._planner.shutdown(wait=True)
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    service: BuildService = None
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _sendJSON(self, status: int, data):
+        body = json.dumps(data, indent=2).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/builds":
+            return self._sendJSON(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = BuildRequest(**json.loads(self.rfile.read(length) or b"{}"))
+        except (TypeError, ValueError, AssertionError) as e:
+            return self._sendJSON(400, {"error": str(e)})
+        job, deduplicated = self.service.submit(request)
+        self._sendJSON(200 if deduplicated else 202, dict(self.service.describe(job), deduplicated=deduplicated))
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        if parts == ["builds"]:
+            return self._sendJSON(200, [self.service.describe(job) for job in self.service.list()])
+        if len(parts) < 2 or parts[0] != "builds":
+            return self._sendJSON(404, {"error": "not found"})
+        job = self.service.get(parts[1])
+        if job is None:
+            return self._sendJSON(404, {"error": f"no job {parts[1]}"})
+        if len(parts) == 2:
+            return self._sendJSON(200, self.service.describe(job))
+        if len(parts) == 4 and parts[2] == "artifacts":
+            path = job.artifacts().get(parts[3])
+            if path is None:
+                return self._sendJSON(404, {"error": f"job {job.id} has no artifact {parts[3]}"})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.send_header("Content-Disposition", f"attachment; filename=\"{os.path.basename(path)}\"")
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+            return
+        self._sendJSON(404, {"error": "not found"})
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Long running OTA build service with a job queue")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", metavar="SOCKET", help="listen on a unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=2, help="number of builds that run at the same time")
+    parser.add_argument("--builds-dir", default="builds", help="where each job gets its own output directory")
+    parser.add_argument("--builds-budget", default="30G", help="disk budget for finished build outputs")
+    parser.add_argument("--listing-cache-ttl", type=float, default=600, help="seconds to reuse fetched release listings")
+    parser.add_argument("--finished-job-ttl", type=float, default=24 * 3600, help="seconds to keep finished jobs listed")
+    parser.add_argument("--signing-helper", action="store_true", help="decrypt the keys once at startup and sign every build through a helper process")
+    args = parser.parse_args()
+
+    assert os.getenv("PASSPHRASE_AVB") is not None, "PASSPHRASE_AVB environment variable is not set"
+    assert os.getenv("PASSPHRASE_OTA") is not None, "PASSPHRASE_OTA environment variable is not set"
+
+    signer = signingHelper().start() if args.signing_helper else None
+    if signer is not None:
+        # every build signs through the helper, nothing the service starts needs the passphrases from here on
+        signer.dropPassphrases()
+    BuildRequestHandler.service = BuildService(
+        workers=args.workers,
+        builds_dir=args.builds_dir,
+        listing_cache_ttl=args.listing_cache_ttl,
+        finished_job_ttl=args.finished_job_ttl,
+        builds_budget=parseSize(args.builds_budget),
+        signer=signer,
+    )
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = UnixHTTPServer(args.unix, BuildRequestHandler)
+        logger.info(f"Listening on unix socket {args.unix}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), BuildRequestHandler)
+        logger.info(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down, waiting for running builds")
+    finally:
+        server.server_close()
+        BuildRequestHandler.service.shutdown()
+        if signer is not None:
+            signer.stop()
@@ -0,0 +1,57 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deps.remote_cache import setRemoteCache
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: bytes):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {"content-length": str(len(body))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size: int = 1024):
+        for offset in range(0, len(self.body), chunk_size):
+            yield self.body[offset:offset + chunk_size]
+
+class FakeSession:
+    """Serves fixed bodies by URL, with range requests, and remembers every request"""
+
+    def __init__(self, files: dict[str, bytes]):
+        self.files = files
+        self.requests = []
+
+    def get(self, url: str, headers: dict = None, stream: bool = False, **kwargs) -> FakeResponse:
+        self.requests.append((url, headers))
+        body = self.files.get(url)
+        if body is None:
+            return FakeResponse(404, b"")
+        range_header = (headers or {}).get("Range")
+        if range_header is not None:
+            start, end = range_header.removeprefix("bytes=").split("-")
+            return FakeResponse(206, body[int(start):int(end) + 1])
+        return FakeResponse(200, body)
+
+    def head(self, url: str, **kwargs) -> FakeResponse:
+        response = self.get(url)
+        response.body = b""
+        return response
+
+@pytest.fixture(autouse=True)
+def noRemoteCache():
+    # tests never pick up PIXEL_OTA_REMOTE_CACHE from the environment
+    setRemoteCache(None)
+    yield
+    setRemoteCache(None)
@@ -0,0 +1,69 @@
+import json
+import os
+import random
+import pytest
+from deps.archive import _footer, footer_magic, packImages, readIndex, readRange, unpackImages
+
+chunk_size = 64 * 1024
+
+@pytest.fixture
+def images(tmp_path) -> str:
+    source_dir = tmp_path / "extracted"
+    (source_dir / "sub").mkdir(parents=True)
+    rng = random.Random(0)
+    # data, a zero run that becomes a hole, data, and a trailing hole
+    (source_dir / "boot.img").write_bytes(rng.randbytes(chunk_size + 100) + bytes(3 * chunk_size) + rng.randbytes(10) + bytes(chunk_size))
+    (source_dir / "sub" / "vbmeta.img").write_bytes(rng.randbytes(4096))
+    (source_dir / "empty.img").write_bytes(b"")
+    return str(source_dir)
+
+def rewriteIndex(archive_path: str, index: dict):
+    """Replace the index of an archive, the frames stay where they are"""
+    with open(archive_path, 'r+b') as f:
+        f.seek(-_footer.size, os.SEEK_END)
+        index_offset, _, _ = _footer.unpack(f.read(_footer.size))
+        f.seek(index_offset)
+        f.truncate()
+        data = json.dumps(index).encode()
+        f.write(data)
+        f.write(_footer.pack(index_offset, len(data), footer_magic))
+
+def test_round_trip(tmp_path, images):
+    archive_path = packImages(images, str(tmp_path / "images.zpack"), chunk_size=chunk_size, max_workers=2)
+    written = unpackImages(archive_path, str(tmp_path / "out"))
+    assert len(written) == 3
+    for name in ["boot.img", "sub/vbmeta.img", "empty.img"]:
+        with open(os.path.join(images, name), 'rb') as a, open(tmp_path / "out" / name, 'rb') as b:
+            assert a.read() == b.read()
+
+def test_zero_chunks_are_not_stored(tmp_path, images):
+    archive_path = packImages(images, str(tmp_path / "images.zpack"), chunk_size=chunk_size)
+    boot = next(entry for entry in readIndex(archive_path)["files"] if entry["name"] == "boot.img")
+    assert boot["chunks"][2] is None and boot["chunks"][3] is None and boot["chunks"][-1] is None
+
+def test_read_range_across_chunks(tmp_path, images):
+    archive_path = packImages(images, str(tmp_path / "images.zpack"), chunk_size=chunk_size)
+    with open(os.path.join(images, "boot.img"), 'rb') as f:
+        expected = f.read()
+    for offset, length in [(0, 10), (chunk_size - 5, 200), (2 * chunk_size, chunk_size * 3), (len(expected) - 3, 100)]:
+        assert readRange(archive_path, "boot.img", offset, length) == expected[offset:offset + length]
+
+@pytest.mark.parametrize("name", ["../evil.img", "sub/../../evil.img", "/tmp/evil.img"])
+def test_names_outside_the_output_dir_are_refused(tmp_path, images, name):
+    archive_path = packImages(images, str(tmp_path / "images.zpack"), chunk_size=chunk_size)
+    index = readIndex(archive_path)
+    index["files"][-1]["name"] = name
+    rewriteIndex(archive_path, index)
+    out_dir = tmp_path / "out"
+    with pytest.raises(ValueError):
+        unpackImages(archive_path, str(out_dir))
+    assert not (tmp_path / "evil.img").exists()
+    assert not out_dir.exists() or not any(out_dir.iterdir())
+
+def test_corrupt_chunk_is_detected(tmp_path, images):
+    archive_path = packImages(images, str(tmp_path / "images.zpack"), chunk_size=chunk_size)
+    index = readIndex(archive_path)
+    index["files"][0]["sha256"] = "0" * 64
+    rewriteIndex(archive_path, index)
+    with pytest.raises(ValueError):
+        unpackImages(archive_path, str(tmp_path / "out"))
@@ -0,0 +1,10 @@
+import hashlib
+import os
+from deps.digest import sha256File
+
+def test_matches_hashlib_across_chunks(tmp_path):
+    content = os.urandom(3 * 1000 + 7)
+    (tmp_path / "artifact").write_bytes(content)
+    assert sha256File(str(tmp_path / "artifact"), chunk_size=1000) == hashlib.sha256(content).hexdigest()
+    (tmp_path / "empty").write_bytes(b"")
+    assert sha256File(str(tmp_path / "empty")) == hashlib.sha256(b"").hexdigest()
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import time
+from deps.eviction import ArtifactIndex, collectGarbage, index_filename, tierBudgets
+from deps.storage import StorageConfig
+from main import BuildConfig
+
+def writeBlob(path, size: int, age: float):
+    path.write_bytes(os.urandom(size))
+    then = time.time() - age
+    os.utime(path, (then, then))
+
+def test_least_recently_used_blobs_go_first(tmp_path):
+    downloads = tmp_path / "cache"
+    downloads.mkdir()
+    for name, age in [("old.zip", 300), ("mid.zip", 200), ("new.zip", 100)]:
+        writeBlob(downloads / name, 64 * 1024, age)
+    index = ArtifactIndex(str(downloads / index_filename))
+    evicted = collectGarbage(budgets={str(downloads): 150 * 1024}, index=index)
+    assert [os.path.basename(blob.path) for blob in evicted] == ["old.zip"]
+    assert sorted(os.listdir(downloads)) == [index_filename, "mid.zip", "new.zip"]
+
+def test_pinned_and_bookkeeping_files_stay(tmp_path):
+    downloads = tmp_path / "cache"
+    downloads.mkdir()
+    writeBlob(downloads / "pinned.zip", 64 * 1024, 300)
+    writeBlob(downloads / "other.zip", 64 * 1024, 200)
+    writeBlob(downloads / "stage_history.json", 64 * 1024, 400)
+    index = ArtifactIndex(str(downloads / index_filename))
+    index.recordRelease("release", [str(downloads / "pinned.zip")])
+    collectGarbage(budgets={str(downloads): 0}, index=index)
+    assert sorted(os.listdir(downloads)) == [index_filename, "pinned.zip", "stage_history.json"]
+
+def test_index_survives_a_reload(tmp_path):
+    index_path = str(tmp_path / index_filename)
+    index = ArtifactIndex(index_path)
+    index.recordRelease("release", [str(tmp_path / "a.zip")])
+    index.save()
+    assert ArtifactIndex(index_path).pinned() == index.pinned()
+
+def test_tiers_follow_the_storage_config(tmp_path):
+    storage = StorageConfig(download_dir=str(tmp_path / "dl"), scratch_dir=str(tmp_path / "scratch"), publish_dir=str(tmp_path / "pub"))
+    config = BuildConfig.fromStorage(storage)
+    assert config.download_dir == storage.download_dir
+    budgets = tierBudgets(config.download_dir, config.patched_dir, None, config.ota_dir)
+    assert set(budgets) == {storage.download_dir, storage.scratch_dir, storage.publish_dir}
+
+def test_cli_follows_the_configured_tiers(tmp_path):
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    for name in ["download", "scratch", "extract", "publish"]:
+        (tmp_path / name).mkdir()
+        writeBlob(tmp_path / name / f"{name}.bin", 1024, 100)
+        env[f"PIXEL_OTA_{name.upper()}_DIR"] = str(tmp_path / name)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [repo_dir, env.get("PYTHONPATH")]))
+    # run somewhere without cwd relative tiers, every configured one is still collected
+    result = subprocess.run([sys.executable, "-m", "deps.eviction", "--global-budget", "0", "--dry-run"], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    for name in ["download", "scratch", "extract", "publish"]:
+        assert f"Would evict {tmp_path / name / name}.bin" in result.stderr
+
+def test_pins_hold_across_working_directories(tmp_path, monkeypatch):
+    downloads = tmp_path / "cache"
+    downloads.mkdir()
+    writeBlob(downloads / "pinned.zip", 64 * 1024, 300)
+    (tmp_path / "cli").mkdir()
+    (tmp_path / "srv" / "service").mkdir(parents=True)
+    # a CLI build records the release with relative paths from its own directory
+    monkeypatch.chdir(tmp_path / "cli")
+    index = ArtifactIndex(os.path.join("..", "cache", index_filename))
+    index.recordRelease("release", [os.path.join("..", "cache", "pinned.zip")])
+    index.save()
+    # the service collects from somewhere else
+    monkeypatch.chdir(tmp_path / "srv" / "service")
+    index = ArtifactIndex(str(downloads / index_filename))
+    assert collectGarbage(budgets={str(downloads): 0}, index=index) == []
+    assert (downloads / "pinned.zip").exists()
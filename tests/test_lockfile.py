@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pytest
+from conftest import FakeSession
+from deps.chenxiaolong.afsr import AfsrRelease
+from deps.chenxiaolong.avbroot import AvbrootRelease
+from deps.chenxiaolong.custota import CustotaRelease
+from deps.lockfile import LockedArtifact, fetchLocked, readLockfile, writeLockfile
+from deps.magisk import MagiskRelease
+from deps.ota import OTAInfo
+from deps.remote_cache import FilesystemCache, _blobKey, _refKey, publish, setRemoteCache
+
+magisk_url = "https://github.com/topjohnwu/Magisk/releases/download/v29.0/Magisk-v29.0.apk"
+
+def githubRelease(release_type, name: str):
+    return release_type("v1.0.0", f"{name} v1.0.0", False, False, f"{name}-1.0.0.zip", f"https://github.com/chenxiaolong/{name}/releases/download/v1.0.0/{name}-1.0.0.zip")
+
+@pytest.fixture
+def artifacts(tmp_path) -> dict[str, tuple[object, str]]:
+    download_dir = tmp_path / "downloads"
+    download_dir.mkdir()
+    ota_content = os.urandom(4096)
+    ota = OTAInfo("15.0.0", "BP1A.250101.001", "", "", "", None, None, "lynx", "https://dl.google.com/lynx-ota-BP1A.250101.001.zip", hashlib.sha256(ota_content).hexdigest())
+    releases = {
+        "ota": ota,
+        "magisk": MagiskRelease("v29.0", "Magisk v29.0", False, False, "Magisk-v29.0.apk", magisk_url),
+        "avbroot": githubRelease(AvbrootRelease, "avbroot"),
+        "afsr": githubRelease(AfsrRelease, "afsr"),
+        "custota": githubRelease(CustotaRelease, "custota"),
+    }
+    artifacts = {}
+    for name, release in releases.items():
+        path = download_dir / (release.filename if name != "ota" else ota.filename)
+        path.write_bytes(ota_content if name == "ota" else os.urandom(1024))
+        artifacts[name] = (release, str(path))
+    return artifacts
+
+def test_round_trip(tmp_path, artifacts):
+    lockfile_path = writeLockfile(artifacts, str(tmp_path / "pixel-ota.lock.json"))
+    locked = readLockfile(lockfile_path)
+    assert set(locked) == set(artifacts)
+    for name, (release, path) in artifacts.items():
+        assert locked[name].release == release
+        with open(path, 'rb') as f:
+            assert locked[name].sha256 == hashlib.sha256(f.read()).hexdigest()
+
+def test_missing_dependency_is_refused(tmp_path, artifacts):
+    del artifacts["afsr"]
+    with pytest.raises(AssertionError):
+        writeLockfile(artifacts, str(tmp_path / "pixel-ota.lock.json"))
+
+def test_cached_copy_is_used_without_requests(tmp_path, artifacts):
+    locked = readLockfile(writeLockfile(artifacts, str(tmp_path / "pixel-ota.lock.json")))
+    session = FakeSession({})
+    for name, (release, path) in artifacts.items():
+        assert fetchLocked(locked[name], os.path.dirname(path), session=session) == path
+    assert session.requests == []
+
+def test_corrupt_cached_copy_is_downloaded_again(tmp_path, artifacts):
+    release, path = artifacts["magisk"]
+    with open(path, 'rb') as f:
+        content = f.read()
+    locked = LockedArtifact(release, hashlib.sha256(content).hexdigest())
+    with open(path, 'wb') as f:
+        f.write(b"rotted")
+    session = FakeSession({magisk_url: content})
+    assert fetchLocked(locked, os.path.dirname(path), session=session) == path
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert [url for url, _ in session.requests] == [magisk_url]
+
+def test_digest_mismatch_is_refused(tmp_path, artifacts):
+    release, path = artifacts["magisk"]
+    with open(path, 'rb') as f:
+        locked = LockedArtifact(release, hashlib.sha256(f.read()).hexdigest())
+    os.remove(path)
+    # the URL now serves something other than what was locked
+    with pytest.raises(ValueError):
+        fetchLocked(locked, os.path.dirname(path), session=FakeSession({magisk_url: b"a different build"}))
+    assert not os.path.exists(path)
+
+def test_pinned_digest_comes_from_the_remote_cache(tmp_path, artifacts):
+    setRemoteCache(FilesystemCache(str(tmp_path / "cache")))
+    release, path = artifacts["magisk"]
+    publish(path)
+    with open(path, 'rb') as f:
+        content = f.read()
+    locked = LockedArtifact(release, hashlib.sha256(content).hexdigest())
+    os.remove(path)
+    session = FakeSession({})
+    assert fetchLocked(locked, os.path.dirname(path), session=session) == path
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert session.requests == []
+
+def test_pinned_magisk_is_published_by_digest_only(tmp_path, artifacts):
+    cache = FilesystemCache(str(tmp_path / "cache"))
+    setRemoteCache(cache)
+    release, path = artifacts["magisk"]
+    with open(path, 'rb') as f:
+        content = f.read()
+    locked = LockedArtifact(release, hashlib.sha256(content).hexdigest())
+    os.remove(path)
+    fetchLocked(locked, os.path.dirname(path), session=FakeSession({magisk_url: content}))
+    assert cache.size(_blobKey(locked.sha256)) == len(content)
+    assert cache.getBytes(_refKey(magisk_url)) is None
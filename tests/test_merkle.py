@@ -0,0 +1,87 @@
+import hashlib
+import os
+import random
+import pytest
+from conftest import FakeSession
+from deps.merkle import hashFile, merkleRoot, readSidecar, sidecarPath, writeSidecar, verifyChunks
+from deps.ota import OTAInfo
+
+chunk_size = 4 * 1024 * 1024
+url = "https://dl.google.com/dl/android/aosp/lynx-ota-test.zip"
+
+@pytest.fixture
+def content() -> bytes:
+    # three and a bit chunks, so the last one is short
+    return random.Random(0).randbytes(3 * chunk_size + 12345)
+
+def fakeOTA(content: bytes) -> OTAInfo:
+    return OTAInfo(
+        android_version="15.0.0",
+        build_id="TEST.250101.001",
+        build_branch="TEST",
+        build_date="250101",
+        build_number="001",
+        build_variant=None,
+        carrier=None,
+        device="lynx",
+        url=url,
+        checksum=hashlib.sha256(content).hexdigest(),
+    )
+
+def test_hash_file_matches_hashlib(tmp_path, content):
+    path = tmp_path / "file"
+    path.write_bytes(content)
+    sha256, chunks = hashFile(str(path))
+    assert sha256 == hashlib.sha256(content).hexdigest()
+    assert len(chunks) == 4
+    assert chunks[-1] == hashlib.sha256(content[3 * chunk_size:]).hexdigest()
+
+def test_merkle_root_carries_odd_node():
+    leaves = [hashlib.sha256(bytes([i])).hexdigest() for i in range(3)]
+    pair = hashlib.sha256(bytes.fromhex(leaves[0]) + bytes.fromhex(leaves[1])).digest()
+    assert merkleRoot(leaves) == hashlib.sha256(pair + bytes.fromhex(leaves[2])).hexdigest()
+
+def test_sidecar_for_other_content_is_ignored(tmp_path, content):
+    path = tmp_path / "file"
+    path.write_bytes(content)
+    sha256, chunks = hashFile(str(path))
+    writeSidecar(str(path), sha256, chunks)
+    assert readSidecar(str(path), sha256) is not None
+    assert readSidecar(str(path), "0" * 64) is None
+
+def test_download_writes_sidecar(tmp_path, content):
+    session = FakeSession({url: content})
+    out_path = fakeOTA(content).download(str(tmp_path), session=session)
+    with open(out_path, 'rb') as f:
+        assert f.read() == content
+    sidecar = readSidecar(out_path, fakeOTA(content).checksum)
+    assert sidecar is not None
+    assert verifyChunks(out_path, sidecar) == []
+
+def test_cached_ota_without_sidecar_gets_one(tmp_path, content):
+    ota = fakeOTA(content)
+    (tmp_path / ota.filename).write_bytes(content)
+    out_path = ota.download(str(tmp_path), session=FakeSession({}))
+    assert os.path.exists(sidecarPath(out_path))
+
+def test_cached_ota_is_repaired_with_range_requests(tmp_path, content):
+    session = FakeSession({url: content})
+    ota = fakeOTA(content)
+    out_path = ota.download(str(tmp_path), session=session)
+
+    # rot the second chunk
+    with open(out_path, 'r+b') as f:
+        f.seek(chunk_size + 100)
+        f.write(b"\0" * 64)
+    session.requests.clear()
+    ota.download(str(tmp_path), session=session)
+
+    with open(out_path, 'rb') as f:
+        assert f.read() == content
+    assert session.requests == [(url, {"Range": f"bytes={chunk_size}-{2 * chunk_size - 1}"})]
+
+def test_checksum_mismatch_removes_download(tmp_path, content):
+    ota = fakeOTA(content)
+    with pytest.raises(ValueError):
+        ota.download(str(tmp_path), session=FakeSession({url: content[:-1] + b"x"}))
+    assert not os.path.exists(tmp_path / ota.filename)
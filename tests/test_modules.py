@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import pytest
+import deps.modules
+from deps.modules import bundleModules, discoverModules, verifyModules
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+signed_module = "OEMUnlockOnBoot-1.3-release.zip"
+unsigned_module = "PlayIntegrityFork-v14-1.zip"
+
+@pytest.fixture
+def baseDir(tmp_path, monkeypatch) -> str:
+    if shutil.which("ssh-keygen") is None:
+        pytest.skip("ssh-keygen is needed to verify module signatures")
+    # verifySignature writes the trusted key to the working directory
+    monkeypatch.chdir(tmp_path)
+    base_dir = tmp_path / "base"
+    (base_dir / "modules").mkdir(parents=True)
+    for filename in [signed_module, signed_module + ".sig", unsigned_module]:
+        shutil.copy2(os.path.join(repo_dir, "modules", filename), base_dir / "modules" / filename)
+    (base_dir / "modules" / "notes.txt").write_text("not a module")
+    shutil.copytree(os.path.join(repo_dir, "lsposed"), base_dir / "lsposed")
+    return str(base_dir)
+
+def test_discover(baseDir):
+    found = {os.path.basename(path): (install_type, signature_path) for install_type, path, signature_path in discoverModules(baseDir)}
+    assert set(found) == {signed_module, unsigned_module, "FakeGAppsv6.6.apk"}
+    assert found[signed_module] == ("magisk", os.path.join(baseDir, "modules", signed_module + ".sig"))
+    assert found[unsigned_module] == ("magisk", None)
+    assert found["FakeGAppsv6.6.apk"][0] == "lsposed"
+
+def test_bundle(tmp_path, baseDir):
+    manifest_path = bundleModules(str(tmp_path / "bundle"), base_dir=baseDir, cache_path=str(tmp_path / "cache.json"))
+    with open(manifest_path) as f:
+        modules = {entry["filename"]: entry for entry in json.load(f)["modules"]}
+    assert modules[signed_module]["verified"] and modules[signed_module]["signed"]
+    assert not modules[unsigned_module]["verified"] and not modules[unsigned_module]["signed"]
+    for filename in modules:
+        with open(os.path.join(baseDir, "modules" if filename.endswith(".zip") else "lsposed", filename), 'rb') as a, open(tmp_path / "bundle" / filename, 'rb') as b:
+            assert a.read() == b.read()
+
+def test_tampered_module_is_refused(tmp_path, baseDir):
+    with open(os.path.join(baseDir, "modules", signed_module), 'r+b') as f:
+        f.seek(100)
+        byte = f.read(1)
+        f.seek(100)
+        f.write(bytes([byte[0] ^ 0xff]))
+    with pytest.raises(ValueError):
+        bundleModules(str(tmp_path / "bundle"), base_dir=baseDir, cache_path=str(tmp_path / "cache.json"))
+    assert not (tmp_path / "bundle").exists()
+
+def test_verification_is_cached(tmp_path, baseDir, monkeypatch):
+    cache_path = str(tmp_path / "cache.json")
+    verifyModules(base_dir=baseDir, cache_path=cache_path)
+
+    def unexpected(file_data, signature_path):
+        raise AssertionError(f"{signature_path} was verified again")
+
+    monkeypatch.setattr(deps.modules, "verifySignature", unexpected)
+    artifacts = {artifact.filename: artifact for artifact in verifyModules(base_dir=baseDir, cache_path=cache_path)}
+    assert artifacts[signed_module].verified
+    # the cache is keyed by content, a changed artifact is checked again
+    with open(os.path.join(baseDir, "modules", signed_module), 'ab') as f:
+        f.write(b"\0")
+    with pytest.raises(AssertionError):
+        verifyModules(base_dir=baseDir, cache_path=cache_path)
@@ -0,0 +1,113 @@
+import json
+import os
+import pytest
+from bench.pipeline import runBenchmark
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def workDir(tmp_path, monkeypatch) -> str:
+    # the keys and modules are found relative to the repository
+    monkeypatch.chdir(repo_dir)
+    if os.path.exists("downloads"):
+        pytest.skip("the repository has a downloads directory, the test can't tell whether the build wrote to it")
+    return str(tmp_path / "work")
+
+@pytest.mark.parametrize("enable_magisk", [True, False])
+def test_benchmark_build(workDir, enable_magisk):
+    report = runBenchmark(work_dir=workDir, ota_size=8 * 1024**2, extract_ratio=1.0, enable_magisk=enable_magisk)
+    assert [stage["name"] for stage in report["stages"]][:2] == ["patch", "extract"]
+    assert ("modules" in [stage["name"] for stage in report["stages"]]) == enable_magisk
+    # everything cached goes to the download directory of the work directory
+    assert not os.path.exists("downloads")
+
+    ota_dir = os.path.join(workDir, "build", "ota")
+    with open(os.path.join(ota_dir, "lynx.json")) as f:
+        update_info = json.load(f)
+    assert os.path.isfile(update_info["full"]["location_ota"])
+    assert os.path.isfile(os.path.join(ota_dir, "release_info"))
+    assert os.path.isfile(os.path.join(workDir, "downloads", "stage_history.json"))
+    assert os.path.isdir(os.path.join(workDir, "build", "patched", "modules")) == enable_magisk
+
+def test_published_outputs_are_pinned(workDir):
+    from deps.eviction import ArtifactIndex, collectGarbage, index_filename
+    runBenchmark(work_dir=workDir, ota_size=8 * 1024**2, extract_ratio=1.0)
+    build_dir = os.path.join(workDir, "build")
+    before = {root: sorted(os.listdir(os.path.join(build_dir, root))) for root in ["patched", "ota"]}
+    index = ArtifactIndex(os.path.join(workDir, "downloads", index_filename))
+    evicted = collectGarbage(budgets={os.path.join(build_dir, root): 0 for root in before}, global_budget=0, index=index)
+    assert evicted == []
+    assert {root: sorted(os.listdir(os.path.join(build_dir, root))) for root in before} == before
+    assert any(name.endswith(".zpack") for name in before["patched"])
+    assert {"avb_pkmd.bin", "modules"} <= set(before["patched"])
+    assert {"lynx.json", "release_info", "release_info-lynx"} <= set(before["ota"])
+
+def test_variants_publish_the_first_one_as_default(workDir, monkeypatch):
+    from bench.pipeline import makeSyntheticOTA, standinDependencies
+    from deps.eviction import ArtifactIndex, collectGarbage, index_filename
+    from main import BuildConfig, buildVariants, parseVariant
+    monkeypatch.setenv("PASSPHRASE_AVB", "bench")
+    monkeypatch.setenv("PASSPHRASE_OTA", "bench")
+    monkeypatch.setenv("STANDIN_EXTRACT_RATIO", "1.0")
+    os.makedirs(workDir)
+    dependencies = standinDependencies(makeSyntheticOTA(os.path.join(workDir, "lynx-ota-BENCH.250101.001.zip"), 8 * 1024**2), workDir)
+    ota_dir = os.path.join(workDir, "ota")
+    config = BuildConfig(
+        download_dir=os.path.join(workDir, "downloads"),
+        patched_dir=os.path.join(workDir, "patched"),
+        ota_dir=ota_dir,
+        extract_patched_ota=False,
+        collect_garbage=False,
+    )
+    results = buildVariants(dependencies, [parseVariant("rootless"), parseVariant("magisk")], config)
+
+    with open(os.path.join(ota_dir, "lynx.json")) as f:
+        assert json.load(f)["full"]["location_ota"] == results["rootless"].ota_path
+    with open(os.path.join(ota_dir, "lynx-magisk.json")) as f:
+        assert json.load(f)["full"]["location_ota"] == results["magisk"].ota_path
+    with open(os.path.join(ota_dir, "release_info")) as f:
+        assert "variant=rootless\n" in f.read()
+
+    published = sorted(os.listdir(ota_dir))
+    index = ArtifactIndex(os.path.join(workDir, "downloads", index_filename))
+    assert collectGarbage(budgets={ota_dir: 0}, global_budget=0, index=index, keep_releases=2) == []
+    assert sorted(os.listdir(ota_dir)) == published
+
+def test_variants_check_their_space_together(workDir, monkeypatch):
+    import errno
+    import deps.storage
+    import main
+    from bench.pipeline import makeSyntheticOTA, standinDependencies
+    from deps.storage import buildSpace, default_reserve
+    os.makedirs(workDir)
+    ota_path = makeSyntheticOTA(os.path.join(workDir, "lynx-ota-BENCH.250101.001.zip"), 1024**2)
+    dependencies = standinDependencies(ota_path, workDir)
+    # room for one variant but not for two
+    one_variant = sum(buildSpace(os.path.getsize(ota_path), "patched", "extracted", "ota").values())
+    monkeypatch.setattr(deps.storage, "freeSpace", lambda path: default_reserve + one_variant * 3 // 2)
+    started = []
+    monkeypatch.setattr(main, "buildOTA", lambda *args, **kwargs: started.append(args))
+    config = main.BuildConfig(
+        download_dir=os.path.join(workDir, "downloads"),
+        patched_dir=os.path.join(workDir, "patched"),
+        ota_dir=os.path.join(workDir, "ota"),
+        collect_garbage=False,
+    )
+    with pytest.raises(OSError) as e:
+        main.buildVariants(dependencies, [main.parseVariant("rootless"), main.parseVariant("magisk")], config)
+    assert e.value.errno == errno.ENOSPC
+    assert started == []
+
+def test_variant_magisk_is_resolved_without_downloading(monkeypatch):
+    import main
+    from deps.magisk import MagiskRelease
+
+    def release(tag: str, prerelease: bool = False) -> MagiskRelease:
+        return MagiskRelease(tag, f"Magisk {tag}", prerelease, False, f"Magisk-{tag}.apk", f"https://github.com/topjohnwu/Magisk/releases/download/{tag}/Magisk-{tag}.apk")
+
+    listings = []
+    monkeypatch.setattr(main, "fetchMagiskReleases", lambda session=None: listings.append(1) or [release("v29.0"), release("v28.1"), release("v30.0", True)])
+    variants = [main.parseVariant(spec) for spec in ["rootless", "magisk", "magisk:29.0", "magisk:28.1", "magisk:30.0:prerelease"]]
+    resolved = main.resolveVariantMagisk(release("v29.0"), variants)
+    assert {name: r.tag_name for name, r in resolved.items()} == {"magisk-28.1": "v28.1", "magisk-30.0-prerelease": "v30.0"}
+    assert len(listings) == 1
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import pytest
+from conftest import FakeSession
+from deps.chenxiaolong.avbroot import AvbrootRelease
+from deps.magisk import MagiskRelease
+from deps.ota import OTAInfo
+from deps.planner import default_stage_rates, default_stage_seconds, origin_rate, planBuild
+from deps.remote_cache import FilesystemCache, publish, setRemoteCache
+from deps.stages import StageRecord, history_filename, recordHistory
+from deps.storage import StorageConfig
+
+ota_size = 64 * 1024
+magisk_url = "https://github.com/topjohnwu/Magisk/releases/download/v29.0/Magisk-v29.0.apk"
+avbroot_url = "https://github.com/chenxiaolong/avbroot/releases/download/v3.0.0/avbroot-3.0.0.zip"
+
+@pytest.fixture
+def storage(tmp_path) -> StorageConfig:
+    return StorageConfig(
+        download_dir=str(tmp_path / "downloads"),
+        scratch_dir=str(tmp_path / "patched"),
+        publish_dir=str(tmp_path / "ota"),
+    )
+
+@pytest.fixture
+def releases(tmp_path, storage) -> dict:
+    ota_content = os.urandom(ota_size)
+    ota = OTAInfo("15.0.0", "BP1A.250101.001", "", "", "", None, None, "lynx", "https://dl.google.com/lynx-ota-BP1A.250101.001.zip", hashlib.sha256(ota_content).hexdigest())
+    os.makedirs(storage.download_dir)
+    with open(os.path.join(storage.download_dir, ota.filename), 'wb') as f:
+        f.write(ota_content)
+    return {
+        "ota": ota,
+        "magisk": MagiskRelease("v29.0", "Magisk v29.0", False, False, "Magisk-v29.0.apk", magisk_url),
+        "avbroot": AvbrootRelease("v3.0.0", "avbroot v3.0.0", False, False, "avbroot-3.0.0.zip", avbroot_url),
+    }
+
+def test_transfers(tmp_path, storage, releases):
+    setRemoteCache(FilesystemCache(str(tmp_path / "cache")))
+    (tmp_path / "avbroot.zip").write_bytes(os.urandom(3000))
+    publish(str(tmp_path / "avbroot.zip"), url=avbroot_url)
+    # Magisk is only looked up at its origin, even when the cache has an entry for its URL
+    (tmp_path / "magisk.apk").write_bytes(os.urandom(100))
+    publish(str(tmp_path / "magisk.apk"), url=magisk_url)
+    session = FakeSession({magisk_url: bytes(2000)})
+
+    plan = planBuild(releases, storage, session=session)
+    transfers = {t.name: t for t in plan.transfers}
+    assert (transfers["ota"].source, transfers["ota"].size) == ("local", ota_size)
+    assert (transfers["avbroot"].source, transfers["avbroot"].size) == ("remote-cache", 3000)
+    assert (transfers["magisk"].source, transfers["magisk"].size) == ("origin", 2000)
+    assert [url for url, _ in session.requests] == [magisk_url]
+    assert plan.ota_size == ota_size
+    assert plan.download_bytes == 5000
+    assert plan.download_seconds > 2000 / origin_rate
+
+def test_disk_per_directory(storage, releases):
+    plan = planBuild(releases, storage, variants=["rootless", "magisk"], session=FakeSession({magisk_url: bytes(2000)}))
+    assert plan.disk[storage.download_dir] == 2000
+    for variant in ["rootless", "magisk"]:
+        assert plan.disk[os.path.join(storage.scratch_dir, variant)] == 2 * ota_size
+        assert os.path.join(storage.scratch_dir, variant, "extracted") in plan.disk
+    # both variants publish to the same directory
+    assert plan.disk[storage.publish_dir] == 2 * ota_size
+    assert plan.fits
+    # nothing is downloaded or created
+    assert not os.path.exists(storage.scratch_dir) and not os.path.exists(storage.publish_dir)
+
+def test_rootless_builds_skip_the_modules_stage(storage, releases):
+    session = FakeSession({})
+    assert "modules" in [stage.name for stage in planBuild(releases, storage, session=session).stages]
+    stages = [stage.name for stage in planBuild(releases, storage, modules=False, extract=False, session=session).stages]
+    assert stages == ["patch", "publish", "gen-csig", "gen-update-info", "gc"]
+
+def test_history_replaces_the_defaults(storage, releases):
+    session = FakeSession({})
+    plan = planBuild(releases, storage, session=session)
+    stages = {stage.name: stage for stage in plan.stages}
+    assert not any(stage.from_history for stage in plan.stages)
+    assert stages["patch"].seconds == pytest.approx(default_stage_rates["patch"] * ota_size / 1024**3)
+    assert stages["modules"].seconds == default_stage_seconds["modules"]
+
+    # a past build with half the OTA size, seconds per byte scale to this one
+    history_path = os.path.join(storage.download_dir, history_filename)
+    recordHistory(history_path, [StageRecord("patch", 10.0, 0), StageRecord("modules", 3.0, 0)], ota_size // 2)
+    stages = {stage.name: stage for stage in planBuild(releases, storage, session=session).stages}
+    assert stages["patch"].from_history and stages["patch"].seconds == pytest.approx(20.0)
+    assert stages["modules"].from_history and stages["modules"].seconds == pytest.approx(3.0)
+    assert not stages["extract"].from_history
+
+def test_variant_magisk_releases_are_downloads_too(storage, releases):
+    variant_url = "https://github.com/topjohnwu/Magisk/releases/download/v28.1/Magisk-v28.1.apk"
+    variant_magisk = {"magisk-28.1": MagiskRelease("v28.1", "Magisk v28.1", False, False, "Magisk-v28.1.apk", variant_url)}
+    session = FakeSession({magisk_url: bytes(2000), variant_url: bytes(1500)})
+    plan = planBuild(releases, storage, variants=["magisk", "magisk-28.1"], variant_magisk=variant_magisk, session=session)
+    transfers = {t.name: t for t in plan.transfers}
+    assert (transfers["magisk:magisk-28.1"].source, transfers["magisk:magisk-28.1"].size) == ("origin", 1500)
+    assert plan.releases["magisk:magisk-28.1"] == "v28.1"
+    assert plan.download_bytes == 3500
+    assert plan.disk[storage.download_dir] == 3500
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+from conftest import FakeSession
+from deps.magisk import MagiskRelease
+from deps.remote_cache import FilesystemCache, _blobKey, _refKey, cachedSize, fetchDigest, fetchURL, publish, setRemoteCache
+
+url = "https://github.com/topjohnwu/Magisk/releases/download/v29.0/Magisk-v29.0.apk"
+
+def useCache(tmp_path) -> FilesystemCache:
+    cache = FilesystemCache(str(tmp_path / "cache"), part_size=1000, max_workers=4)
+    setRemoteCache(cache)
+    return cache
+
+def test_publish_and_fetch_by_digest(tmp_path):
+    useCache(tmp_path)
+    content = os.urandom(5555)
+    (tmp_path / "artifact").write_bytes(content)
+    digest = hashlib.sha256(content).hexdigest()
+    assert publish(str(tmp_path / "artifact"), url=url)
+    assert cachedSize(digest=digest) == len(content)
+    assert cachedSize(url=url) == len(content)
+    assert fetchDigest(digest, str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == content
+
+def test_corrupt_blob_is_a_miss(tmp_path):
+    cache = useCache(tmp_path)
+    content = os.urandom(2048)
+    (tmp_path / "artifact").write_bytes(content)
+    digest = hashlib.sha256(content).hexdigest()
+    publish(str(tmp_path / "artifact"))
+    cache.putBytes(_blobKey(digest), b"tampered")
+    assert not fetchDigest(digest, str(tmp_path / "copy"))
+    assert not (tmp_path / "copy").exists()
+
+def test_no_cache_is_a_miss(tmp_path):
+    setRemoteCache(None)
+    assert not fetchURL(url, str(tmp_path / "copy"))
+    assert cachedSize(url=url) is None
+
+def test_magisk_is_never_taken_from_the_cache_by_url(tmp_path):
+    cache = useCache(tmp_path)
+    # someone with write access to the cache points the Magisk URL at their own APK
+    poisoned = b"not magisk"
+    poisoned_digest = hashlib.sha256(poisoned).hexdigest()
+    cache.putBytes(_blobKey(poisoned_digest), poisoned)
+    cache.putBytes(_refKey(url), json.dumps({"url": url, "sha256": poisoned_digest, "size": len(poisoned)}).encode())
+
+    genuine = os.urandom(4096)
+    release = MagiskRelease("v29.0", "Magisk v29.0", False, False, "Magisk-v29.0.apk", url)
+    out_path = release.download(str(tmp_path / "downloads"), session=FakeSession({url: genuine}))
+    with open(out_path, 'rb') as f:
+        assert f.read() == genuine
+
+def test_unpinned_magisk_is_not_published(tmp_path):
+    cache = useCache(tmp_path)
+    release = MagiskRelease("v29.0", "Magisk v29.0", False, False, "Magisk-v29.0.apk", url)
+    release.download(str(tmp_path / "downloads"), session=FakeSession({url: os.urandom(4096)}))
+    assert cache.getBytes(_refKey(url)) is None
+    assert not os.path.exists(cache.root)
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from botocore.exceptions import ClientError
+from deps.remote_cache import S3Cache, _blobKey, fetchDigest, openRemoteCache, publish, setRemoteCache
+
+bucket = "pixel-ota-cache"
+
+@pytest.fixture
+def s3(monkeypatch):
+    # a MinIO style endpoint served in process, nothing leaves the machine
+    for name, value in [("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"), ("AWS_DEFAULT_REGION", "us-east-1")]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=bucket)
+        yield client
+
+@pytest.fixture
+def cache(s3) -> S3Cache:
+    return openRemoteCache(f"s3://{bucket}/runners/")
+
+def test_prefix(s3, cache):
+    assert (cache.bucket, cache.prefix) == (bucket, "runners")
+    cache.putBytes("urls/abc", b"{}")
+    assert [o["Key"] for o in s3.list_objects_v2(Bucket=bucket)["Contents"]] == ["runners/urls/abc"]
+
+def test_bytes(cache):
+    cache.putBytes("urls/abc", b"ref")
+    assert cache.getBytes("urls/abc") == b"ref"
+    assert cache.size("urls/abc") == 3
+
+def test_files(tmp_path, cache):
+    content = os.urandom(100 * 1024)
+    (tmp_path / "artifact").write_bytes(content)
+    cache.put("sha256/ab/abc", str(tmp_path / "artifact"))
+    assert cache.size("sha256/ab/abc") == len(content)
+    cache.get("sha256/ab/abc", str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == content
+
+def test_multipart(tmp_path, s3):
+    # S3's smallest part size, so the artifact goes up and comes back in three parts
+    cache = S3Cache(bucket, part_size=5 * 1024**2, max_workers=3)
+    content = os.urandom(12 * 1024**2)
+    (tmp_path / "artifact").write_bytes(content)
+    cache.put("sha256/ab/abc", str(tmp_path / "artifact"))
+    assert s3.head_object(Bucket=bucket, Key="sha256/ab/abc")["ETag"].strip('"').endswith("-3")
+    cache.get("sha256/ab/abc", str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == content
+
+def test_missing_key(tmp_path, cache):
+    assert cache.size("sha256/ab/missing") is None
+    assert cache.getBytes("urls/missing") is None
+    with pytest.raises(ClientError):
+        cache.get("sha256/ab/missing", str(tmp_path / "copy"))
+
+def test_other_errors_are_raised(s3):
+    # the bucket was never created, that's not a cache miss
+    cache = S3Cache("no-such-bucket")
+    with pytest.raises(ClientError):
+        cache.getBytes("urls/abc")
+
+def test_publish_and_fetch(tmp_path, cache):
+    setRemoteCache(cache)
+    content = os.urandom(4096)
+    (tmp_path / "artifact").write_bytes(content)
+    digest = hashlib.sha256(content).hexdigest()
+    assert publish(str(tmp_path / "artifact"))
+    assert cache.size(_blobKey(digest)) == len(content)
+    assert fetchDigest(digest, str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == content
+    assert not fetchDigest("0" * 64, str(tmp_path / "missing"))
@@ -0,0 +1,120 @@
+import threading
+import time
+import pytest
+import service
+from deps.planner import BuildPlan, VolumePlan
+from deps.storage import default_reserve, freeSpace, volumeOf
+
+def fakePlan(tmp_path, seconds: float, required: int) -> BuildPlan:
+    volume = VolumePlan(device=volumeOf(str(tmp_path)), paths=[str(tmp_path)], required=required, free=freeSpace(str(tmp_path)), fits=True)
+    return BuildPlan(
+        releases={}, variants=["default"], ota_size=0, transfers=[], download_bytes=0, download_seconds=seconds,
+        disk={str(tmp_path): required}, volumes=[volume], stages=[], build_seconds=0,
+    )
+
+@pytest.fixture
+def fakeBuilds(tmp_path, monkeypatch):
+    """Every device builds in 0.2 s, the plan of each comes from plans, returns the (event, device, time) log"""
+    plans = {}
+    log = []
+    log_lock = threading.Lock()
+
+    def fakeBuild(dependencies, config, artifact_index=None, signer=None):
+        with log_lock:
+            log.append(("start", dependencies, time.monotonic()))
+        time.sleep(0.2)
+        with log_lock:
+            log.append(("end", dependencies, time.monotonic()))
+
+    monkeypatch.setattr(service, "resolveDependencies", lambda **criteria: criteria["ota_device"])
+    monkeypatch.setattr(service, "planBuild", lambda releases, storage, **options: plans[releases])
+    monkeypatch.setattr(service, "downloadDependencies", lambda releases, download_dir: releases)
+    monkeypatch.setattr(service, "buildOTA", fakeBuild)
+    monkeypatch.setattr(service, "collectGarbage", lambda **kwargs: None)
+    return plans, log
+
+def runService(tmp_path, devices: list[str], workers: int):
+    build_service = service.BuildService(workers=workers, builds_dir=str(tmp_path / "builds"), download_dir=str(tmp_path / "downloads"))
+    for device in devices:
+        build_service.submit(service.BuildRequest(device=device))
+    build_service.shutdown()
+    return build_service
+
+def test_longest_job_runs_first(tmp_path, fakeBuilds):
+    plans, log = fakeBuilds
+    plans.update({"a": fakePlan(tmp_path, 1, 0), "b": fakePlan(tmp_path, 50, 0), "c": fakePlan(tmp_path, 10, 0)})
+    # a starts right away, c and b are queued while it runs
+    build_service = runService(tmp_path, ["a", "c", "b"], workers=1)
+    assert [device for event, device, _ in log if event == "start"] == ["a", "b", "c"]
+    assert all(job.status == "succeeded" for job in build_service.list())
+
+def test_jobs_that_dont_fit_together_never_overlap(tmp_path, fakeBuilds):
+    plans, log = fakeBuilds
+    # each one fits on its own but not next to another one
+    required = (freeSpace(str(tmp_path)) - default_reserve) * 2 // 3
+    plans.update({device: fakePlan(tmp_path, 1, required) for device in "xyz"})
+    runService(tmp_path, ["x", "y", "z"], workers=3)
+    events = sorted(log, key=lambda entry: entry[2])
+    running = 0
+    for event, _, _ in events:
+        running += 1 if event == "start" else -1
+        assert running <= 1
+
+def test_jobs_that_never_fit_run_alone(tmp_path, fakeBuilds):
+    plans, log = fakeBuilds
+    required = freeSpace(str(tmp_path)) * 2
+    plans.update({device: fakePlan(tmp_path, 1, required) for device in "xy"})
+    runService(tmp_path, ["x", "y"], workers=2)
+    (_, first, _), (_, second, second_start) = [entry for entry in log if entry[0] == "start"]
+    first_end = next(t for event, device, t in log if event == "end" and device == first)
+    assert second_start >= first_end
+
+def test_failed_plan_fails_the_job(tmp_path, fakeBuilds):
+    build_service = runService(tmp_path, ["missing"], workers=1)
+    job, = build_service.list()
+    assert job.status == "failed"
+    assert "KeyError" in job.error
+
+def test_garbage_is_collected_only_while_no_build_runs(tmp_path, fakeBuilds, monkeypatch):
+    plans, log = fakeBuilds
+    plans.update({device: fakePlan(tmp_path, 1, 0) for device in "abcd"})
+    collections = []
+
+    def fakeCollectGarbage(**kwargs):
+        start = time.monotonic()
+        time.sleep(0.1)
+        collections.append((start, time.monotonic()))
+
+    monkeypatch.setattr(service, "collectGarbage", fakeCollectGarbage)
+    runService(tmp_path, ["a", "b", "c", "d"], workers=2)
+    assert collections
+    builds = {}
+    for event, device, t in log:
+        builds.setdefault(device, []).append(t)
+    for gc_start, gc_end in collections:
+        for start, end in builds.values():
+            assert end <= gc_start or start >= gc_end
+
+def test_finished_jobs_are_forgotten(tmp_path, fakeBuilds):
+    plans, log = fakeBuilds
+    plans.update({device: fakePlan(tmp_path, 1, 0) for device in "ab"})
+    build_service = service.BuildService(workers=1, builds_dir=str(tmp_path / "builds"), download_dir=str(tmp_path / "downloads"), max_finished_jobs=1)
+    for device in "ab":
+        build_service.submit(service.BuildRequest(device=device))
+    build_service.shutdown()
+    assert len(build_service.list()) == 2
+    build_service._pruneJobs()
+    job, = build_service.list()
+    assert job.request.device == "b"
+    build_service.finished_job_ttl = 0
+    build_service._pruneJobs()
+    assert build_service.list() == []
+
+def test_only_the_service_directories_are_collected(tmp_path, fakeBuilds, monkeypatch):
+    plans, _ = fakeBuilds
+    plans["a"] = fakePlan(tmp_path, 1, 0)
+    collected = []
+    monkeypatch.setattr(service, "collectGarbage", lambda **kwargs: collected.append(kwargs["budgets"]))
+    runService(tmp_path, ["a"], workers=1)
+    # outputs of CLI builds in the working directory are left alone
+    assert collected and all(set(budgets) == {str(tmp_path / "downloads"), str(tmp_path / "builds")} for budgets in collected)
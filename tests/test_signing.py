@@ -0,0 +1,55 @@
+import hashlib
+import os
+import subprocess
+import sys
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from deps.signing import SigningHelper
+
+@pytest.fixture
+def signer(tmp_path, monkeypatch):
+    keys = {}
+    for name in ["avb", "ota"]:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        path = tmp_path / f"{name}.key"
+        path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.BestAvailableEncryption(b"secret")))
+        keys[name] = (str(path), f"TEST_PASSPHRASE_{name.upper()}")
+        monkeypatch.setenv(f"TEST_PASSPHRASE_{name.upper()}", "secret")
+    with SigningHelper(keys) as helper:
+        yield helper
+
+def padded(key_size: int) -> bytes:
+    # EMSA-PKCS1-v1_5 shaped, the helper signs whatever block it gets
+    digest = hashlib.sha256(b"payload").digest()
+    return b"\x00\x01" + b"\xff" * (key_size - len(digest) - 3) + b"\x00" + digest
+
+def sign(signer: SigningHelper, env: dict, algorithm: str, data: bytes) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, signer.client_path, algorithm, signer.publicKeyPath("avb")], input=data, env=env, capture_output=True)
+
+def test_signature_verifies_with_the_public_key(signer):
+    with open(signer.publicKeyPath("avb"), 'rb') as f:
+        public_numbers = serialization.load_pem_public_key(f.read()).public_numbers()
+    data = padded(256)
+    with signer.authorized() as env:
+        result = sign(signer, env, "SHA256_RSA2048", data)
+    assert result.returncode == 0, result.stderr
+    assert pow(int.from_bytes(result.stdout, "big"), public_numbers.e, public_numbers.n) == int.from_bytes(data, "big")
+
+def test_revoked_token_is_refused(signer):
+    with signer.authorized() as env:
+        pass
+    result = sign(signer, env, "SHA256_RSA2048", padded(256))
+    assert result.returncode == 1
+    assert b"not authorized" in result.stderr
+
+def test_algorithm_must_match_the_key_size(signer):
+    with signer.authorized() as env:
+        result = sign(signer, env, "SHA256_RSA4096", padded(256))
+    assert result.returncode == 1
+
+def test_child_environment_has_no_passphrases(signer):
+    with signer.authorized() as env:
+        assert "TEST_PASSPHRASE_AVB" not in env and "TEST_PASSPHRASE_OTA" not in env
+    signer.dropPassphrases()
+    assert "TEST_PASSPHRASE_AVB" not in os.environ and "TEST_PASSPHRASE_OTA" not in os.environ
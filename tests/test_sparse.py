@@ -0,0 +1,78 @@
+import os
+import random
+import pytest
+from deps.sparse import _SPARSE_HEADER_MAGIC, _CHUNK_TYPE_FILL, _CHUNK_TYPE_RAW, _chunk_header, _sparse_header, convertTreeToAndroidSparse, copySparse, isAndroidSparse, sparsifyFile, writeAndroidSparse
+
+block_size = 4096
+
+@pytest.fixture
+def image(tmp_path) -> str:
+    rng = random.Random(0)
+    path = tmp_path / "system.img"
+    # data, a zero run, a repeating pattern, data, and a partial trailing block
+    path.write_bytes(rng.randbytes(2 * block_size) + bytes(16 * block_size) + b"\xab\xcd\xef\x01" * (2 * block_size // 4) + rng.randbytes(block_size) + rng.randbytes(100))
+    return str(path)
+
+def readAndroidSparse(path: str) -> bytes:
+    """Expand an Android sparse image the way fastboot does"""
+    with open(path, 'rb') as f:
+        magic, major, _, header_size, chunk_header_size, image_block_size, total_blocks, chunks, _ = _sparse_header.unpack(f.read(_sparse_header.size))
+        assert magic == _SPARSE_HEADER_MAGIC and major == 1
+        assert header_size == _sparse_header.size and chunk_header_size == _chunk_header.size
+        out = bytearray()
+        for _ in range(chunks):
+            chunk_type, _, chunk_blocks, total_size = _chunk_header.unpack(f.read(_chunk_header.size))
+            body = f.read(total_size - _chunk_header.size)
+            if chunk_type == _CHUNK_TYPE_RAW:
+                assert len(body) == chunk_blocks * image_block_size
+                out += body
+            else:
+                assert chunk_type == _CHUNK_TYPE_FILL and len(body) == 4
+                out += body * (chunk_blocks * image_block_size // 4)
+        assert f.read() == b""
+    assert len(out) == total_blocks * image_block_size
+    return bytes(out)
+
+def test_sparsify_keeps_the_content(image):
+    with open(image, 'rb') as f:
+        before = f.read()
+    released = sparsifyFile(image, block_size)
+    with open(image, 'rb') as f:
+        assert f.read() == before
+    if released == 0:
+        pytest.skip("the filesystem does not support hole punching")
+    assert released >= 8 * block_size
+    assert os.stat(image).st_blocks * 512 < len(before)
+
+def test_copy_preserves_content_and_holes(tmp_path, image):
+    sparsifyFile(image, block_size)
+    copy = str(tmp_path / "copy.img")
+    copied = copySparse(image, copy)
+    with open(image, 'rb') as a, open(copy, 'rb') as b:
+        assert a.read() == b.read()
+    assert copied <= os.path.getsize(image)
+    assert os.stat(copy).st_blocks <= os.stat(image).st_blocks
+
+@pytest.mark.parametrize("punch_holes", [False, True])
+def test_android_sparse_round_trip(tmp_path, image, punch_holes):
+    if punch_holes:
+        sparsifyFile(image, block_size)
+    with open(image, 'rb') as f:
+        raw = f.read()
+    sparse = writeAndroidSparse(image, str(tmp_path / "system.sparse"), block_size)
+    assert isAndroidSparse(sparse) and not isAndroidSparse(image)
+    expanded = readAndroidSparse(sparse)
+    # the trailing partial block is padded with zeros
+    assert expanded[:len(raw)] == raw and expanded[len(raw):] == bytes(len(expanded) - len(raw))
+    assert os.path.getsize(sparse) < len(raw)
+
+def test_convert_tree_skips_images_that_grow(tmp_path, image):
+    (tmp_path / "vbmeta.img").write_bytes(random.Random(1).randbytes(block_size))
+    (tmp_path / "notes.txt").write_bytes(bytes(16 * block_size))
+    converted = convertTreeToAndroidSparse(str(tmp_path), block_size)
+    assert converted == [image]
+    assert isAndroidSparse(image)
+    assert not isAndroidSparse(str(tmp_path / "vbmeta.img"))
+    assert not os.path.exists(str(tmp_path / "vbmeta.img.sparse"))
+    # already converted images are left alone
+    assert convertTreeToAndroidSparse(str(tmp_path), block_size) == []
@@ -0,0 +1,44 @@
+import threading
+import pytest
+from deps.stages import StageHistory, StageRecord, StageRecorder, history_length, recordHistory
+
+def test_recorder_times_every_stage():
+    recorder = StageRecorder()
+    with recorder.stage("patch"):
+        pass
+    with pytest.raises(RuntimeError):
+        with recorder.stage("extract"):
+            raise RuntimeError("failed")
+    # a failed stage is still recorded
+    assert [record.name for record in recorder.records] == ["patch", "extract"]
+    assert recorder.total() == sum(record.seconds for record in recorder.records)
+
+def test_estimate(tmp_path):
+    history = StageHistory(str(tmp_path / "history.json"))
+    assert history.estimate("patch", 100) is None
+    history.add([StageRecord("patch", 10.0, 0), StageRecord("gc", 1.0, 0)], ota_size=100)
+    history.add([StageRecord("patch", 40.0, 0), StageRecord("gc", 3.0, 0)], ota_size=200)
+    history.add([StageRecord("patch", 90.0, 0), StageRecord("gc", 2.0, 0)], ota_size=300)
+    # the median rate is 0.2 seconds per byte, fixed stages ignore the OTA size
+    assert history.estimate("patch", 1000) == pytest.approx(200.0)
+    assert history.estimate("gc", 1000) == pytest.approx(2.0)
+
+def test_history_is_bounded(tmp_path):
+    history = StageHistory(str(tmp_path / "history.json"))
+    for i in range(history_length + 10):
+        history.add([StageRecord("patch", float(i), 0)], ota_size=1)
+    assert len(history.stages["patch"]) == history_length
+    assert history.stages["patch"][0]["seconds"] == 10.0
+
+def test_unreadable_history_is_ignored(tmp_path):
+    (tmp_path / "history.json").write_text("{not json")
+    assert StageHistory(str(tmp_path / "history.json")).stages == {}
+
+def test_concurrent_builds_keep_every_run(tmp_path):
+    path = str(tmp_path / "downloads" / "history.json")
+    threads = [threading.Thread(target=recordHistory, args=(path, [StageRecord("patch", 1.0, 0)], 1)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(StageHistory(path).stages["patch"]) == 8
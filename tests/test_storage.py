@@ -0,0 +1,53 @@
+import errno
+import os
+import pytest
+from deps.storage import StorageConfig, buildSpace, checkFreeSpace, freeSpace, groupByVolume, stageFile
+
+def test_config_from_env(monkeypatch):
+    monkeypatch.setenv("PIXEL_OTA_DOWNLOAD_DIR", "/cache/downloads")
+    monkeypatch.setenv("PIXEL_OTA_PUBLISH_DIR", "/srv/ota")
+    monkeypatch.delenv("PIXEL_OTA_SCRATCH_DIR", raising=False)
+    config = StorageConfig.fromEnv(publish_dir="/srv/other", scratch_dir=None)
+    assert config.download_dir == "/cache/downloads"
+    assert config.publish_dir == "/srv/other"
+    assert config.scratch_dir == StorageConfig.scratch_dir
+
+def test_paths_on_one_volume_are_added_up(tmp_path):
+    # neither directory exists yet, they are measured on the volume they will be created on
+    required = {str(tmp_path / "patched"): 100, str(tmp_path / "ota"): 50, str(tmp_path / "unused"): 0}
+    [(paths, total, free)] = groupByVolume(required)
+    assert sorted(paths) == sorted([str(tmp_path / "patched"), str(tmp_path / "ota")])
+    assert total == 150
+    assert free == freeSpace(str(tmp_path))
+
+def test_no_space(tmp_path):
+    checkFreeSpace({str(tmp_path): 1}, reserve=0)
+    with pytest.raises(OSError) as e:
+        checkFreeSpace({str(tmp_path / "a"): freeSpace(str(tmp_path)), str(tmp_path / "b"): 1}, reserve=0)
+    assert e.value.errno == errno.ENOSPC
+
+def test_build_space():
+    assert buildSpace(100, "patched", None, "ota") == {"patched": 100, "ota": 100}
+    extracted = buildSpace(100, "patched", "extracted", "ota")
+    assert extracted["patched"] == 200 and extracted["ota"] == 100 and extracted["extracted"] > 0
+    assert buildSpace(100, "patched", "extracted", "ota", package=False)["patched"] == 100
+    # tiers pointed at the same directory share one entry
+    assert buildSpace(100, "out", None, "out") == {"out": 200}
+
+@pytest.mark.parametrize("move", [False, True])
+def test_stage_file(tmp_path, move):
+    src = tmp_path / "build" / "lynx.zip"
+    src.parent.mkdir()
+    src.write_bytes(b"new" * 1000)
+    dst = tmp_path / "ota" / "lynx.zip"
+    dst.parent.mkdir()
+    dst.write_bytes(b"old")
+    assert stageFile(str(src), str(dst), move=move) == str(dst)
+    assert dst.read_bytes() == b"new" * 1000
+    assert src.exists() != move
+    assert not (tmp_path / "ota" / "lynx.zip.part").exists()
+    if not move:
+        # a copy is independent of the source, rewriting it leaves the published file alone
+        src.write_bytes(b"rebuilt")
+        assert dst.read_bytes() == b"new" * 1000
+        assert os.stat(src).st_ino != os.stat(dst).st_ino
@@ -0,0 +1,63 @@
+import os
+import pytest
+from conftest import FakeSession
+from deps.remote_cache import FilesystemCache, publish, setRemoteCache
+from deps.transport import createSession, default_timeout, downloadFile, getListing, getSession, host_pool_sizes, setListingCacheTTL
+
+url = "https://github.com/chenxiaolong/avbroot/releases/download/v3.0.0/avbroot-3.0.0.zip"
+listing_url = "https://api.github.com/repos/chenxiaolong/avbroot/releases"
+
+@pytest.fixture
+def noListingCache():
+    # a BuildService created by another test leaves its TTL behind
+    setListingCacheTTL(0)
+    yield
+    setListingCacheTTL(0)
+
+def test_session_pools_per_host():
+    session = createSession()
+    adapter = session.get_adapter("https://dl.google.com/dl/android/aosp/lynx-ota.zip")
+    assert adapter._pool_maxsize == host_pool_sizes["dl.google.com"]
+    assert adapter.timeout == default_timeout
+    assert session.get_adapter("https://example.com/") is not adapter
+    assert getSession() is getSession()
+
+def test_download(tmp_path):
+    content = os.urandom(3 * 1024**2 + 5)
+    session = FakeSession({url: content})
+    assert downloadFile(url, str(tmp_path / "avbroot.zip"), session=session) == len(content)
+    assert (tmp_path / "avbroot.zip").read_bytes() == content
+
+def test_download_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        downloadFile(url, str(tmp_path / "avbroot.zip"), session=FakeSession({}))
+
+@pytest.mark.parametrize("from_cache", [False, True])
+def test_cache_by_url_is_opt_in(tmp_path, from_cache):
+    setRemoteCache(FilesystemCache(str(tmp_path / "cache")))
+    (tmp_path / "cached.zip").write_bytes(b"cached")
+    publish(str(tmp_path / "cached.zip"), url=url)
+    session = FakeSession({url: b"origin"})
+    downloadFile(url, str(tmp_path / "avbroot.zip"), session=session, from_cache=from_cache)
+    assert (tmp_path / "avbroot.zip").read_bytes() == (b"cached" if from_cache else b"origin")
+    assert len(session.requests) == (0 if from_cache else 1)
+
+def test_listing_is_fetched_every_time_by_default(noListingCache):
+    session = FakeSession({listing_url: b"[]"})
+    getListing(listing_url, session=session)
+    getListing(listing_url, session=session)
+    assert len(session.requests) == 2
+
+def test_listing_cache(noListingCache):
+    setListingCacheTTL(60)
+    session = FakeSession({listing_url: b"[]"})
+    first = getListing(listing_url, session=session)
+    assert getListing(listing_url, session=session) is first
+    # different headers are a different listing
+    getListing(listing_url, session=session, headers={"Authorization": "token"})
+    assert len(session.requests) == 2
+    # failed requests aren't cached
+    missing = listing_url + "/missing"
+    getListing(missing, session=session)
+    getListing(missing, session=session)
+    assert len(session.requests) == 4
@@ -0,0 +1,76 @@
+import json
+import os
+import zipfile
+import pytest
+from deps.update_info import PublishedOTA, generateBatch, metadata_entry, readOtaMetadata, readZipEntry, renderUpdateInfo, writeUpdateInfo
+
+metadata = "post-build=google/lynx/lynx:15/TEST/1:user/release-keys\npost-security-patch-level=2025-01-01\npost-timestamp=1735689600\npost-sdk-level=35\npre-device=lynx\n"
+
+def makeOTA(path, compression: int = zipfile.ZIP_STORED, payload_size: int = 1024**2, extra_entries: int = 0) -> str:
+    with zipfile.ZipFile(path, 'w', compression=compression) as z:
+        z.writestr("payload.bin", os.urandom(payload_size))
+        for i in range(extra_entries):
+            z.writestr(f"filler/{i}", b"")
+        z.writestr(metadata_entry, metadata)
+    return str(path)
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_read_entry_matches_zipfile(tmp_path, compression):
+    path = makeOTA(tmp_path / "ota.zip", compression)
+    with zipfile.ZipFile(path) as z:
+        for name in z.namelist():
+            assert readZipEntry(path, name) == z.read(name)
+
+def test_zip64_central_directory(tmp_path):
+    # more entries than the classic end of central directory record can count
+    path = makeOTA(tmp_path / "ota.zip", payload_size=10, extra_entries=0x10000)
+    assert readZipEntry(path, metadata_entry) == metadata.encode()
+
+def test_missing_entry(tmp_path):
+    path = makeOTA(tmp_path / "ota.zip")
+    with pytest.raises(KeyError):
+        readZipEntry(path, "META-INF/missing")
+
+def test_not_a_zip(tmp_path):
+    (tmp_path / "ota.zip").write_bytes(b"not a zip" * 100)
+    with pytest.raises(ValueError):
+        readZipEntry(str(tmp_path / "ota.zip"), metadata_entry)
+
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+def test_update_info_matches_serde_json_pretty(tmp_path):
+    # serde_json's to_string_pretty as custota-tool writes it, two space indents and a trailing newline
+    path = writeUpdateInfo(str(tmp_path / "lynx.json"), "lynx-ota-BP1A.250105.004-magisk-v29.0.zip")
+    with open(path, 'rb') as a, open(os.path.join(golden_dir, "lynx.json"), 'rb') as b:
+        assert a.read() == b.read()
+
+def test_non_ascii_locations_are_not_escaped():
+    # serde_json writes UTF-8 as is, only quotes, backslashes and control characters are escaped
+    assert renderUpdateInfo("ota/Prüfung \"1\".zip").splitlines()[3] == '    "location_ota": "ota/Prüfung \\"1\\".zip",'
+
+def test_update_info_structure():
+    assert json.loads(renderUpdateInfo("lynx.zip")) == {
+        "version": 2,
+        "full": {"location_ota": "lynx.zip", "location_csig": "lynx.zip.csig"},
+    }
+
+def test_batch(tmp_path):
+    published = []
+    for variant in ["rootless", "magisk"]:
+        ota_path = makeOTA(tmp_path / f"lynx-{variant}.zip")
+        published.append(PublishedOTA(
+            ota_path=ota_path,
+            update_info_path=str(tmp_path / f"lynx-{variant}.json"),
+            release_info_path=str(tmp_path / f"release_info-lynx-{variant}"),
+            location=os.path.basename(ota_path),
+            release_fields={"device": "lynx", "variant": variant},
+        ))
+    generateBatch(published)
+    for entry in published:
+        with open(entry.update_info_path) as f:
+            assert json.load(f)["full"]["location_ota"] == entry.location
+        with open(entry.release_info_path) as f:
+            fields = dict(line.split("=", 1) for line in f.read().splitlines())
+        assert fields["variant"] == entry.release_fields["variant"]
+        assert fields["fingerprint"] == readOtaMetadata(entry.ota_path)["post-build"]
+        assert fields["timestamp"] == "1735689600"